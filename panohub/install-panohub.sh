@@ -26,10 +26,10 @@ echo "$STATUS panosend-install.sh ver $ver"
 echo "-----------------------------------------------"
 echo "$STATUS Download GitHub Files"
 if $is_upgrade ; then
-    installFiles=("panohub.py" "panohub.sh" \
+    installFiles=("panohub.py" "panohub.sh" "panostitch.py" "panobench.py" \
                   "webserver.py" "webserver.sh" "image-stitching")
 else
-    installFiles=("panohub.py" "panohub.sh" "panohub.yaml" \
+    installFiles=("panohub.py" "panohub.sh" "panohub.yaml" "panostitch.py" "panobench.py" \
                   "webserver.py" "webserver.sh" "image-stitching" "config.cfg")
 fi
 
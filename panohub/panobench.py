@@ -0,0 +1,541 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+'''
+panobench.py -- written by Claude Pageau https://github.com/pageauc/panopi
+
+Description:
+Measure panohub.py throughput without a rack of RPI cameras.
+hub mode runs panohub.py as a child process with a generated settings
+file in a work folder and replays jpeg frames to it from virtual
+panosend cameras speaking the same imagezmq protocol 2 over localhost.
+Source images eg the bundled pano-tl-*.jpg samples are split into
+overlapping crops, one per virtual camera. The report shows sequence
+latency, hub cpu, write bandwidth and stitch time percentiles from the
+panohub sequence manifest.
+stitch mode runs the opencv stitch engine standalone on a fixed frame set.
+
+Stop panohub.py first since the benchmark hub listens on the same port.
+
+    ./panobench.py hub --cams 3 --interval 5 --duration 120
+    ./panobench.py stitch --repeat 50
+'''
+
+from __future__ import print_function
+import os
+import sys
+import argparse
+import glob
+import json
+import shutil
+import signal
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+import numpy as np
+import cv2
+import yaml
+import zmq
+
+try:
+    import imagezmq
+except ImportError:
+    print('panobench.py: ERROR imagezmq Not Installed. To install')
+    print('              sudo pip3 install imagezmq')
+    sys.exit(1)
+
+import panostitch
+
+PROG_VER = '0.10'
+PROG_NAME = os.path.basename(__file__)
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PANOHUB_PATH = os.path.join(BASE_DIR, 'panohub.py')
+PANOHUB_YAML_PATH = os.path.join(BASE_DIR, 'panohub.yaml')
+YAML_PANOHUB_SECTION_NAME = 'panohub_settings'
+ZMQ_HUB = 'tcp://127.0.0.1:5555'
+PANOHUB_PROTOCOL = 2
+PANOHUB_READY_SEC = 30  # wait this long for the benchmark hub to start listening
+PERCENTILES = (50, 90, 99)
+
+#---------------------------------------------------------------
+def percentiles(values):
+    ''' Return a dict of nearest rank PERCENTILES of values or None '''
+    if not values:
+        return None
+    values = sorted(values)
+    result = {'p%i' % pct: values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+              for pct in PERCENTILES}
+    result['mean'] = sum(values) / float(len(values))
+    result['count'] = len(values)
+    return result
+
+#---------------------------------------------------------------
+def format_ms(stats):
+    ''' Return percentile seconds stats as a millisecond report line '''
+    if stats is None:
+        return 'n/a'
+    return '  '.join(['%s %.1f ms' % (key, stats[key] * 1000)
+                      for key in ['p%i' % pct for pct in PERCENTILES] + ['mean']] +
+                     ['n=%i' % stats['count']])
+
+#---------------------------------------------------------------
+def load_source_images(source):
+    ''' Return images read from a jpeg file, folder or glob pattern '''
+    if os.path.isdir(source):
+        paths = sorted(glob.glob(os.path.join(source, '*.jpg')) +
+                       glob.glob(os.path.join(source, '*.jpeg')))
+    else:
+        paths = sorted(glob.glob(source))
+    images = []
+    for path in paths:
+        image = cv2.imread(path)
+        if image is None:
+            print('panobench.py: WARN Could Not Read %s' % path)
+            continue
+        images.append(image)
+    if not images:
+        print('panobench.py: ERROR No Source Images Found %s' % source)
+        sys.exit(1)
+    print('panobench.py: Read %i Source Images %s' % (len(images), source))
+    return images
+
+#---------------------------------------------------------------
+def split_image(image, cams, width, height, overlap):
+    '''
+    Return cams left to right crops of image that overlap their
+    neighbours by the overlap fraction, each resized to width x height.
+    '''
+    image_width = image.shape[1]
+    crop_width = int(image_width / (cams - (cams - 1) * overlap))
+    step = 0 if cams == 1 else (image_width - crop_width) / float(cams - 1)
+    return [cv2.resize(image[:, int(cam_num * step):int(cam_num * step) + crop_width],
+                       (width, height), interpolation=cv2.INTER_AREA)
+            for cam_num in range(cams)]
+
+#---------------------------------------------------------------
+def make_frame_sets(args):
+    '''
+    Return a list per virtual camera of jpeg frames to replay and
+    the mean encode seconds. Each source image gives one sequence.
+    '''
+    frame_sets = [[] for cam_num in range(args.cams)]
+    encode_sec = []
+    for image in load_source_images(args.source):
+        for cam_num, crop in enumerate(split_image(image, args.cams, args.width,
+                                                   args.height, args.overlap)):
+            start_time = time.monotonic()
+            ret_code, jpg_buffer = cv2.imencode('.jpg', crop, [int(cv2.IMWRITE_JPEG_QUALITY),
+                                                               args.quality])
+            encode_sec.append(time.monotonic() - start_time)
+            frame_sets[cam_num].append(jpg_buffer.tobytes())
+    frame_bytes = sum(len(frame) for frames in frame_sets for frame in frames)
+    print('panobench.py: %i Cameras x %i Frames %ix%i  Mean Frame %i KB' %
+          (args.cams, len(frame_sets[0]), args.width, args.height,
+           frame_bytes // (args.cams * len(frame_sets[0])) // 1024))
+    return frame_sets, sum(encode_sec) / len(encode_sec)
+
+#---------------------------------------------------------------
+class VirtualCamera(threading.Thread):
+    '''
+    Simulated panosend sender. Waits for each trigger from the hub
+    reply, then sends the next replayed frame with the same protocol 2
+    message panosend sends. A missed reply reconnects like panosend.
+    '''
+    def __init__(self, name, frames, encode_sec, timeout_sec, stop_event):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.frames = frames
+        self.encode_sec = encode_sec
+        self.timeout_ms = int(timeout_sec * 1000)
+        self.stop_event = stop_event
+        self.frames_sent = 0
+        self.timeouts = 0
+        self.rtts = []
+
+    def connect(self):
+        sender = imagezmq.ImageSender(connect_to=ZMQ_HUB)
+        sender.zmq_socket.setsockopt(zmq.LINGER, 0)
+        sender.zmq_socket.setsockopt(zmq.SNDTIMEO, self.timeout_ms)
+        sender.zmq_socket.setsockopt(zmq.RCVTIMEO, self.timeout_ms)
+        return sender
+
+    def run(self):
+        sender = self.connect()
+        next_trigger = None  # hub clock. None sends the first frame right away
+        best_rtt, clock_offset = None, 0.0
+        while not self.stop_event.is_set():
+            if next_trigger is not None:
+                sleep_sec = next_trigger - clock_offset - time.time()
+                if sleep_sec > 0 and self.stop_event.wait(sleep_sec):
+                    break
+            capture_time = time.time() + clock_offset
+            msg = {'name': self.name,
+                   'proto': PANOHUB_PROTOCOL,
+                   'capture_time': capture_time,
+                   'trigger': next_trigger,
+                   'skew': None if next_trigger is None else capture_time - next_trigger,
+                   'clock_offset': clock_offset,
+                   'rtt': best_rtt,
+                   'send_time': capture_time,
+                   'stats': {'capture_sec': 0.0,
+                             'encode_sec': self.encode_sec,
+                             'send_sec': self.rtts[-1] if self.rtts else None,
+                             'frames_sent': self.frames_sent,
+                             'timeouts': self.timeouts,
+                             'spooled': 0,
+                             'full_kept': 0}}
+            send_time = time.time()
+            try:
+                hub_reply = sender.send_jpg(msg, self.frames[self.frames_sent % len(self.frames)])
+            except zmq.Again:
+                self.timeouts += 1
+                sender.zmq_socket.close()
+                sender = self.connect()
+                next_trigger = None
+                continue
+            recv_time = time.time()
+            reply = json.loads(hub_reply.decode('utf-8'))
+            rtt = recv_time - send_time
+            if best_rtt is None or rtt < best_rtt:
+                best_rtt = rtt
+                clock_offset = reply['hub_time'] - (send_time + recv_time) / 2.0
+            if next_trigger is not None:
+                # the first frame only gets the schedule
+                self.frames_sent += 1
+                self.rtts.append(rtt)
+            next_trigger = reply['trigger']
+        sender.zmq_socket.close()
+
+#---------------------------------------------------------------
+def write_bench_config(work_dir, cam_names, args):
+    '''
+    Write a panohub.yaml for the benchmark hub to work_dir based on
+    the installed panohub.yaml. Relative media paths end up in work_dir.
+    '''
+    with open(PANOHUB_YAML_PATH) as yaml_file:
+        config = yaml.safe_load(yaml_file)
+    settings = config[YAML_PANOHUB_SECTION_NAME]
+    settings.update({'CAM_HOST_NAMES': [cam_name + '.local' for cam_name in cam_names],
+                     'TIMELAPSE_TIMER': args.interval,
+                     'STITCH_ENGINE': args.engine,
+                     'STITCH_CAMERA_HFOV': args.hfov,
+                     'STITCH_TILE_WORKERS': args.tile_workers,
+                     'IMAGE_KEEP_RAW': args.keep_raw,
+                     'RECV_SEQ_TIMEOUT': args.seq_timeout,
+                     'METRICS_ON': False,
+                     'VIDEO_ON': False,
+                     # keep everything the hub writes inside work_dir
+                     'STITCH_CALIB_FILEPATH': './panohub-calib.yaml',
+                     'STITCH_TABLES_DIR': './panohub-tables',
+                     'IMAGE_DIR': './media/timelapse',
+                     'IMAGE_PANO_DIR': './media/pano-images',
+                     'RETAIN_ARCHIVE_DIR': './media/archive',
+                     'PREVIEW_REQUEST_DIR': './fullres-requests',
+                     'HUB_STATUS_FILEPATH': './panohub-status.json',
+                     'SEQ_MANIFEST_FILEPATH': './panohub-manifest.db'})
+    if args.engine == 'openpano':
+        for file_name in ('image-stitching', 'config.cfg'):
+            if os.path.exists(os.path.join(BASE_DIR, file_name)):
+                os.symlink(os.path.join(BASE_DIR, file_name), os.path.join(work_dir, file_name))
+    config_path = os.path.join(work_dir, 'panohub.yaml')
+    with open(config_path, 'w') as yaml_file:
+        yaml.safe_dump(config, yaml_file, default_flow_style=False)
+    return config_path, settings
+
+#---------------------------------------------------------------
+def read_proc_io(pid):
+    ''' Return the /proc io counters of a process as a dict '''
+    io_counters = {}
+    try:
+        with open('/proc/%i/io' % pid) as io_file:
+            for line in io_file:
+                name, value = line.split(':')
+                io_counters[name] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return io_counters
+
+#---------------------------------------------------------------
+def wait_for_hub(proc, log_path, timeout_sec):
+    ''' Return True once the benchmark hub is listening for frames '''
+    end_time = time.time() + timeout_sec
+    while time.time() < end_time:
+        if proc.poll() is not None:
+            return False
+        with open(log_path) as log_file:
+            if 'Listening for panosend Images' in log_file.read():
+                return True
+        time.sleep(0.2)
+    return False
+
+#---------------------------------------------------------------
+def wait_for_stitches(manifest_path, timeout_sec):
+    ''' Wait until every queued sequence in the manifest has a full stitch '''
+    end_time = time.time() + timeout_sec
+    while time.time() < end_time:
+        try:
+            db = sqlite3.connect('file:%s?mode=ro' % manifest_path, uri=True)
+            try:
+                waiting = db.execute(
+                    'SELECT COUNT(*) FROM sequences WHERE queued AND id NOT IN'
+                    ' (SELECT sequence_id FROM stitches WHERE NOT preview)').fetchone()[0]
+            finally:
+                db.close()
+            if waiting == 0:
+                return True
+        except sqlite3.Error:
+            pass
+        time.sleep(0.5)
+    return False
+
+#---------------------------------------------------------------
+def read_manifest_results(manifest_path, warmup):
+    '''
+    Return sequence and stitch timings from the benchmark hub manifest.
+    The first warmup sequences are skipped since the opencv engine
+    calibrates the camera rig on the first sequence.
+    '''
+    db = sqlite3.connect('file:%s?mode=ro' % manifest_path, uri=True)
+    try:
+        sequences = db.execute('SELECT id, trigger_time, partial, queued FROM sequences'
+                               ' ORDER BY id').fetchall()[warmup:]
+        receive_sec, pano_sec, stitch_sec = [], [], []
+        stitch_failed, stitch_skipped = 0, 0
+        for seq_id, trigger_time, partial, queued in sequences:
+            last_recv = db.execute('SELECT MAX(recv_time) FROM frames WHERE sequence_id=?',
+                                   (seq_id,)).fetchone()[0]
+            if last_recv is not None:
+                receive_sec.append(last_recv - trigger_time)
+            for sec, stitch_ok, stitch_time, skip_reason in db.execute(
+                    'SELECT stitch_sec, stitch_ok, stitch_time, skip_reason FROM stitches'
+                    ' WHERE sequence_id=? AND NOT preview', (seq_id,)):
+                if stitch_ok:
+                    stitch_sec.append(sec)
+                    pano_sec.append(stitch_time - trigger_time)
+                elif skip_reason:
+                    stitch_skipped += 1
+                else:
+                    stitch_failed += 1
+    finally:
+        db.close()
+    return {'sequences': len(sequences),
+            'partial_sequences': sum(1 for seq in sequences if seq[2]),
+            'stitch_failed': stitch_failed,
+            'stitch_skipped': stitch_skipped,
+            'receive_sec': percentiles(receive_sec),
+            'end_to_end_sec': percentiles(pano_sec),
+            'stitch_sec': percentiles(stitch_sec)}
+
+#---------------------------------------------------------------
+def run_hub_bench(args):
+    '''
+    Run panohub.py with virtual cameras for args.duration seconds
+    then stop it and report hub resource use and sequence timings.
+    '''
+    frame_sets, encode_sec = make_frame_sets(args)
+    cam_names = ['bench-%i' % cam_num for cam_num in range(args.cams)]
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='bench-', dir=BASE_DIR)
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    config_path, settings = write_bench_config(work_dir, cam_names, args)
+    log_path = os.path.join(work_dir, 'panohub.log')
+    print('panobench.py: Start panohub.py in %s  Log %s' % (work_dir, log_path))
+    with open(log_path, 'w') as log_file:
+        proc = subprocess.Popen([sys.executable, '-u', PANOHUB_PATH,
+                                 '--config', config_path, '--no-notify'],
+                                cwd=work_dir, stdout=log_file, stderr=subprocess.STDOUT)
+    results = None
+    try:
+        if not wait_for_hub(proc, log_path, PANOHUB_READY_SEC):
+            print('panobench.py: ERROR panohub.py Did Not Start. Is panohub.py already running?')
+            print('              See %s' % log_path)
+            return None
+        start_time = time.time()
+        stop_event = threading.Event()
+        cameras = [VirtualCamera(cam_name, frames, encode_sec, args.reply_timeout, stop_event)
+                   for cam_name, frames in zip(cam_names, frame_sets)]
+        for camera in cameras:
+            camera.start()
+        print('panobench.py: %i Virtual Cameras Sending Every %s sec for %i sec ...' %
+              (args.cams, args.interval, args.duration))
+        time.sleep(args.duration)
+        stop_event.set()
+        for camera in cameras:
+            camera.join(args.reply_timeout + 1)
+        manifest_path = os.path.join(work_dir, settings['SEQ_MANIFEST_FILEPATH'])
+        if not wait_for_stitches(manifest_path, args.drain):
+            print('panobench.py: WARN Stitch Queue Not Drained after %i sec' % args.drain)
+        io_counters = read_proc_io(proc.pid)
+        wall_sec = time.time() - start_time
+        proc.send_signal(signal.SIGINT)
+        pid, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = status
+        # rusage covers the hub exit eg its frame writer flush plus its
+        # reaped child processes eg openpano, so rate it over the time to exit
+        exit_sec = time.time() - start_time
+        results = read_manifest_results(manifest_path, args.warmup)
+        results.update({'mode': 'hub',
+                        'cams': args.cams,
+                        'interval_sec': args.interval,
+                        'frame_size': [args.width, args.height],
+                        'wall_sec': wall_sec,
+                        'frames_sent': sum(camera.frames_sent for camera in cameras),
+                        'send_timeouts': sum(camera.timeouts for camera in cameras),
+                        'round_trip_sec': percentiles([rtt for camera in cameras
+                                                       for rtt in camera.rtts]),
+                        'hub_cpu_sec': rusage.ru_utime + rusage.ru_stime,
+                        'hub_cpu_pct': 100.0 * (rusage.ru_utime + rusage.ru_stime) / exit_sec,
+                        'hub_max_rss_mb': rusage.ru_maxrss / 1024.0,
+                        'hub_write_mb_sec': rusage.ru_oublock * 512 / exit_sec / 1e6,
+                        'hub_wchar_mb_sec': io_counters.get('wchar', 0) / wall_sec / 1e6})
+    finally:
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGINT)
+            try:
+                proc.wait(30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if not args.keep and not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    print('panobench.py: ------------- Hub Benchmark -------------------')
+    print('panobench.py: Frames Sent       %i  Reply Timeouts %i' %
+          (results['frames_sent'], results['send_timeouts']))
+    print('panobench.py: Sequences         %i  Partial %i  Stitch Failed %i  Skipped %i'
+          '  (%i warmup left out)' %
+          (results['sequences'], results['partial_sequences'], results['stitch_failed'],
+           results['stitch_skipped'], args.warmup))
+    print('panobench.py: Send Round Trip   %s' % format_ms(results['round_trip_sec']))
+    print('panobench.py: Trigger to Frames %s' % format_ms(results['receive_sec']))
+    print('panobench.py: Trigger to Pano   %s' % format_ms(results['end_to_end_sec']))
+    print('panobench.py: Stitch            %s' % format_ms(results['stitch_sec']))
+    print('panobench.py: Hub CPU           %.1f sec  %.0f%% of one core  Max RSS %.0f MB' %
+          (results['hub_cpu_sec'], results['hub_cpu_pct'], results['hub_max_rss_mb']))
+    print('panobench.py: Hub Writes        %.2f MB/sec to disk incl. exit and child processes' %
+          results['hub_write_mb_sec'])
+    print('panobench.py:                   %.2f MB/sec written by panohub.py before exit' %
+          results['hub_wchar_mb_sec'])
+    return results
+
+#---------------------------------------------------------------
+def run_stitch_bench(args):
+    '''
+    Stitch the same frame set args.repeat times with the opencv engine
+    in a temporary folder. The first stitch calibrates the rig and is
+    reported separately.
+    '''
+    frame_sets, encode_sec = make_frame_sets(args)
+    cam_names = ['bench-%i' % cam_num for cam_num in range(args.cams)]
+    jpg_frames = [frames[0] for frames in frame_sets]
+    tile_workers = args.tile_workers or os.cpu_count() or 1
+    tile_pool = None
+    if tile_workers > 1:
+        tile_pool = panostitch.TilePool(tile_workers)
+    work_dir = tempfile.mkdtemp(prefix='bench-stitch-')
+    engine = None
+    try:
+        engine = panostitch.StitchEngine(os.path.join(work_dir, 'calib.yaml'),
+                                         os.path.join(work_dir, 'tables'),
+                                         hfov_deg=args.hfov,
+                                         gain_alpha=args.gain_alpha,
+                                         tile_pool=tile_pool)
+        pano_path = os.path.join(work_dir, 'pano.jpg')
+        decode_sec, stitch_sec = [], []
+        calib_sec = None
+        for run_num in range(args.repeat + 1):
+            start_time = time.monotonic()
+            images = [cv2.imdecode(np.frombuffer(jpg_buffer, dtype=np.uint8), cv2.IMREAD_COLOR)
+                      for jpg_buffer in jpg_frames]
+            decoded_time = time.monotonic()
+            if not engine.stitch(cam_names, images, pano_path):
+                print('panobench.py: ERROR Stitch Failed. Try --hfov or --overlap')
+                return None
+            if run_num == 0:
+                calib_sec = time.monotonic() - decoded_time
+            else:
+                decode_sec.append(decoded_time - start_time)
+                stitch_sec.append(time.monotonic() - decoded_time)
+        pano_size = cv2.imread(pano_path).shape[1::-1]
+    finally:
+        if engine is not None:
+            engine.close()
+        if tile_pool is not None:
+            tile_pool.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    results = {'mode': 'stitch',
+               'cams': args.cams,
+               'frame_size': [args.width, args.height],
+               'pano_size': list(pano_size),
+               'tile_workers': tile_workers,
+               'calibrate_sec': calib_sec,
+               'decode_sec': percentiles(decode_sec),
+               'stitch_sec': percentiles(stitch_sec)}
+    print('panobench.py: ------------- Stitch Benchmark ----------------')
+    print('panobench.py: Pano %ix%i from %i Cameras %ix%i  %i Tile Workers' %
+          (pano_size[0], pano_size[1], args.cams, args.width, args.height, tile_workers))
+    print('panobench.py: Calibrate + First Stitch %.1f ms' % (calib_sec * 1000))
+    print('panobench.py: Decode  %s' % format_ms(results['decode_sec']))
+    print('panobench.py: Stitch  %s' % format_ms(results['stitch_sec']))
+    return results
+
+#---------------------------------------------------------------
+def get_default_source():
+    ''' Return the bundled sample panos if found '''
+    for source_dir in (BASE_DIR, os.path.dirname(BASE_DIR)):
+        if glob.glob(os.path.join(source_dir, 'pano-tl-*.jpg')):
+            return os.path.join(source_dir, 'pano-tl-*.jpg')
+    return os.path.join(BASE_DIR, 'media', 'pano-images', '*.jpg')
+
+#---------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark panohub.py with virtual panosend cameras')
+    parser.add_argument('mode', nargs='?', choices=('hub', 'stitch'), default='hub',
+                        help='hub= run panohub.py with virtual cameras  stitch= stitch engine only')
+    parser.add_argument('--source', default=get_default_source(),
+                        help='jpeg file, folder or glob of images split into camera frames')
+    parser.add_argument('--cams', type=int, default=3, help='number of virtual cameras')
+    parser.add_argument('--width', type=int, default=1280, help='camera frame width')
+    parser.add_argument('--height', type=int, default=720, help='camera frame height')
+    parser.add_argument('--quality', type=int, default=85, help='camera frame jpeg quality')
+    parser.add_argument('--overlap', type=float, default=0.5,
+                        help='fraction of each frame overlapping its neighbour')
+    parser.add_argument('--hfov', type=float, default=40.0,
+                        help='STITCH_CAMERA_HFOV for the crops. Sample crops are narrower than a camera')
+    parser.add_argument('--interval', type=float, default=5, help='TIMELAPSE_TIMER seconds')
+    parser.add_argument('--duration', type=int, default=60, help='seconds to send frames')
+    parser.add_argument('--engine', choices=('opencv', 'openpano'), default='opencv',
+                        help='hub STITCH_ENGINE')
+    parser.add_argument('--seq-timeout', type=float, default=5, help='hub RECV_SEQ_TIMEOUT')
+    parser.add_argument('--reply-timeout', type=float, default=10,
+                        help='virtual camera HUB_REPLY_TIMEOUT_SEC')
+    parser.add_argument('--warmup', type=int, default=1,
+                        help='first sequences left out of the results eg calibration')
+    parser.add_argument('--drain', type=int, default=120,
+                        help='seconds to wait for queued stitches after sending stops')
+    parser.add_argument('--repeat', type=int, default=20, help='stitch mode stitches')
+    parser.add_argument('--keep-raw', choices=('all', 'on_failure', 'none'), default='all',
+                        help='hub mode IMAGE_KEEP_RAW raw camera frames saved to disk')
+    parser.add_argument('--tile-workers', type=int, default=0,
+                        help='STITCH_TILE_WORKERS warp and blend processes. 0= one per cpu core')
+    parser.add_argument('--gain-alpha', type=float, default=0.3,
+                        help='stitch mode camera gain smoothing. 0= no gain compensation')
+    parser.add_argument('--work-dir', default=None,
+                        help='hub mode folder for settings and media. default a temporary '
+                             'folder beside panohub.py removed after the run')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary work folder')
+    parser.add_argument('--json', default=None, help='save results to this json file')
+    ARGS = parser.parse_args()
+
+    print('-----------------------------------------------------------')
+    print('%s ver %s written by Claude Pageau' % (PROG_NAME, PROG_VER))
+    print('-----------------------------------------------------------')
+    if ARGS.mode == 'stitch':
+        RESULTS = run_stitch_bench(ARGS)
+    else:
+        RESULTS = run_hub_bench(ARGS)
+    if RESULTS is None:
+        sys.exit(1)
+    if ARGS.json:
+        with open(ARGS.json, 'w') as json_file:
+            json.dump(RESULTS, json_file, indent=2)
+        print('panobench.py: Saved Results to %s' % ARGS.json)
@@ -4,7 +4,7 @@
 panohub.py -- written by Claude Pageau https://github.com/pageauc/panopi
 
 Description:
-A simple program that uses imagezmq to receive images from
+A simple program that receives imagezmq images from
 multiple network computers running panosend.py and stitch images
 to produce a stitched panoramic image. Camera resolution setting
 is configured in the panohub.yaml file.
@@ -19,11 +19,25 @@ import os
 PROG_NAME = os.path.basename(__file__)
 print('%s ver %s Loading ...' % (PROG_NAME, PROG_VER))
 import sys
+import argparse
 import socket
 import time
 import datetime
 import subprocess
+import shlex
+import threading
+import collections
+import json
+import shutil
+import tempfile
+import sqlite3
+import concurrent.futures
+import http.server
 import numpy as np
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 try:
     import zmq
@@ -59,17 +73,7 @@ except ImportError:
     ''')
     sys.exit(1)
 
-try:
-    import imagezmq
-except ImportError:
-    print('''panohub.py: You need to install imagezmq python library per
-
-    sudo pip install imagezmq
-    sudo pip3 install imagezmq
-
-    Note you may need stretch or buster for python3 install
-    ''')
-    sys.exit(1)
+import panostitch
 
 # System Calculated Settings
 # --------------------------
@@ -82,7 +86,1015 @@ YAML_PANOSEND_SECTION_NAME = 'panosend_settings'
 MY_PATH = os.path.abspath(__file__)
 BASE_DIR = os.path.dirname(MY_PATH)
 BASE_FILENAME = os.path.splitext(os.path.basename(MY_PATH))[0]
-TIMELAPSE_SEQ_COUNTER_PATH = os.path.join(BASE_DIR, BASE_FILENAME + '.dat')
+ZMQ_HUB_OPEN_PORT = 'tcp://*:5555'  # imagezmq ImageHub default that panosend connects to
+
+# Default Settings. These are overridden by panohub.yaml panohub_settings
+# so an older panohub.yaml without newer variables will still work.
+IMAGE_PASSTHROUGH_ON = True
+IMAGE_WRITE_BUFFER_SIZE = 262144
+IMAGE_WRITE_QUEUE_MAX = 100
+IMAGE_KEEP_RAW = 'all'
+STITCH_WORKERS = 1
+STITCH_QUEUE_MAX = 2
+STITCH_QUEUE_OVERFLOW = 'drop_oldest'
+STITCH_EXIT_WAIT_SEC = 60
+STITCH_ENGINE = 'openpano'
+STITCH_CALIB_FILEPATH = './panohub-calib.yaml'
+STITCH_TABLES_DIR = './panohub-tables'
+STITCH_STAGING_DIR = '/dev/shm/panohub-staging'
+STITCH_CAMERA_HFOV = 62.2
+STITCH_JPEG_QUALITY = 95
+STITCH_GAIN_ON = True
+STITCH_GAIN_ALPHA = 0.3
+STITCH_TILE_WORKERS = 0
+STITCH_CHECK_ON = True
+STITCH_CHECK_WIDTH = 320
+STITCH_CHECK_MIN_MATCHES = 20
+STITCH_CHECK_MIN_OVERLAP = 0.1
+STITCH_CHECK_SEC = 3600
+STITCH_CHECK_FAIL = 'skip'
+STITCH_CHECK_DEFER_MAX = 20
+RECV_SEQ_TIMEOUT = 10
+RECV_SEQ_TOLERANCE = 2
+RECV_SEQ_MIN_FRAMES = 2
+RECV_CATCHUP_TIMEOUT = 120
+RECV_RECENT_SEQS = 50
+NOTIFY_TIMEOUT_SEC = 3
+NOTIFY_RETRIES = 3
+NOTIFY_BACKOFF_SEC = 0.5
+PREVIEW_FULLRES_MODE = 'always'
+PREVIEW_REQUEST_DIR = './fullres-requests'
+HUB_STATUS_FILEPATH = './panohub-status.json'
+SEQ_MANIFEST_FILEPATH = './panohub-manifest.db'
+METRICS_ON = True
+METRICS_BIND_ADDR = '127.0.0.1'
+METRICS_PORT = 9108
+METRICS_WINDOW = 500
+VIDEO_ON = False
+VIDEO_DIR = './media/videos'
+VIDEO_PREFIX = 'pano-video-'
+VIDEO_WIDTH = 1920
+VIDEO_HEIGHT = 640
+VIDEO_FPS = 10
+VIDEO_FOURCC = 'mp4v'
+VIDEO_EXT = '.mp4'
+VIDEO_SEGMENT_FRAMES = 1000
+VIDEO_SEGMENT_SEC = 86400
+VIDEO_FROM_PREVIEWS = False
+VIDEO_QUEUE_MAX = 20
+MEDIA_LAYOUT = 'flat'
+MEDIA_SEQ_BUCKET = 1000
+RETAIN_RAW_AFTER_STITCH = 'keep'
+RETAIN_ARCHIVE_DIR = './media/archive'
+RETAIN_MAX_AGE_DAYS = 0
+RETAIN_MAX_PANOS = 0
+RETAIN_MAX_FRAMES = 0
+RETAIN_MIN_FREE_MB = 0
+RETAIN_CHECK_SEC = 600
+
+HOST_IP_CACHE = {}  # host name: ip address
+
+IMAGE_KEEP_RAW_ACTIONS = ('all', 'on_failure', 'none')
+STITCH_OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+STITCH_CHECK_FAIL_ACTIONS = ('skip', 'defer')
+PREVIEW_FULLRES_MODES = ('always', 'on_demand')
+PREVIEW_SUFFIX = '-preview'  # added to preview frame and pano file names
+MEDIA_LAYOUTS = ('flat', 'date', 'seq')
+RETAIN_RAW_ACTIONS = ('keep', 'delete', 'archive')
+RETAIN_EMPTY_DIR_SEC = 3600  # empty bucket folders older than this are removed
+
+#---------------------------------------------------------------
+class FrameWriter(object):
+    '''
+    Save received jpeg buffers to disk using a background thread
+    so the receive loop does not wait on slow SD card writes.
+    At most queue_max frames wait in memory. When writes fall behind
+    write() waits for room so memory use stays bounded.
+    Call flush() to wait until all queued frames are on disk.
+    '''
+    def __init__(self, buffer_size=IMAGE_WRITE_BUFFER_SIZE, queue_max=IMAGE_WRITE_QUEUE_MAX):
+        self.buffer_size = buffer_size
+        self.write_queue = queue.Queue(max(0, queue_max))
+        self.behind = False
+        self.thread = threading.Thread(target=self._run, name='FrameWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            image_path, jpg_buffer = self.write_queue.get()
+            start_time = time.monotonic()
+            try:
+                with open(image_path, 'wb', self.buffer_size) as image_file:
+                    image_file.write(jpg_buffer)
+                HUB_METRICS.observe('panohub_write_seconds', time.monotonic() - start_time)
+            except (IOError, OSError) as err_msg:
+                print('panohub.py: ERROR Could Not Write %s %s' % (image_path, err_msg))
+            finally:
+                self.write_queue.task_done()
+
+    def write(self, image_path, jpg_buffer):
+        ''' Queue a jpeg buffer to be saved as-is to image_path '''
+        try:
+            self.write_queue.put_nowait((image_path, jpg_buffer))
+            self.behind = False
+            return
+        except queue.Full:
+            pass
+        if not self.behind:
+            print('panohub.py: WARN Frame Writes Falling Behind. %i Frames Waiting' %
+                  self.write_queue.qsize())
+            self.behind = True
+        self.write_queue.put((image_path, jpg_buffer))
+
+    def pending(self):
+        ''' Return number of frames not yet written '''
+        return self.write_queue.unfinished_tasks
+
+    def flush(self, timeout=None):
+        '''
+        Block until all queued frames have been written.
+        Return False if timeout seconds expired first.
+        '''
+        if timeout is None:
+            self.write_queue.join()
+            return True
+        end_time = time.time() + timeout
+        with self.write_queue.all_tasks_done:
+            while self.write_queue.unfinished_tasks:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    return False
+                self.write_queue.all_tasks_done.wait(remaining)
+        return True
+
+#---------------------------------------------------------------
+class StitchQueue(object):
+    '''
+    Run stitch jobs on a pool of worker threads so receiving the next
+    sequence overlaps with stitching the previous one. Each job is a
+    tuple of arguments passed to stitch_func. When max_depth jobs are
+    already waiting the overflow policy decides what happens
+    drop_oldest= discard oldest waiting job, drop_newest= discard new job,
+    block= wait in put() until a worker takes a job.
+    Background jobs eg deferred full resolution stitches only run when
+    no normal job is waiting and the oldest is dropped when full.
+    Jobs are kept with the time they were queued to measure queue wait.
+    on_drop is called with each dropped job eg to save its frames.
+    abandon() hands back unfinished jobs when the hub exits.
+    '''
+    def __init__(self, stitch_func, workers=1, max_depth=2, overflow='drop_oldest'):
+        if overflow not in STITCH_OVERFLOW_POLICIES:
+            print('panohub.py: WARN STITCH_QUEUE_OVERFLOW=%s Not Valid. Using drop_oldest' %
+                  overflow)
+            overflow = 'drop_oldest'
+        self.stitch_func = stitch_func
+        self.max_depth = max(1, max_depth)
+        self.overflow = overflow
+        self.jobs = collections.deque()
+        self.background_jobs = collections.deque()
+        self.cond = threading.Condition()
+        self.active = 0
+        self.running = []
+        self.dropped = 0
+        self.on_drop = None
+        self.threads = []
+        for worker_num in range(max(1, workers)):
+            thread = threading.Thread(target=self._run, name='Stitch-%i' % worker_num)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.jobs and not self.background_jobs:
+                    self.cond.wait()
+                if self.jobs:
+                    queued_time, job = self.jobs.popleft()
+                else:
+                    queued_time, job = self.background_jobs.popleft()
+                self.active += 1
+                self.running.append(job)
+                self.cond.notify_all()
+            HUB_METRICS.observe('panohub_stitch_queue_wait_seconds',
+                                time.monotonic() - queued_time)
+            try:
+                self.stitch_func(*job)
+            except Exception as err_msg:
+                print('panohub.py: ERROR Stitch Job %s Failed %s' % (job[0], err_msg))
+            finally:
+                with self.cond:
+                    self.active -= 1
+                    self.running.remove(job)
+                    self.cond.notify_all()
+
+    def put(self, *job):
+        '''
+        Add a stitch job to the queue per the overflow policy.
+        Return False if the new job was dropped.
+        '''
+        dropped_job = None
+        with self.cond:
+            if len(self.jobs) >= self.max_depth:
+                if self.overflow == 'block':
+                    print('panohub.py: Seq %s Stitch Queue Full. Waiting ...' % job[0])
+                    while len(self.jobs) >= self.max_depth:
+                        self.cond.wait()
+                elif self.overflow == 'drop_newest':
+                    dropped_job = job
+                else:
+                    queued_time, dropped_job = self.jobs.popleft()
+            if dropped_job is not None:
+                self.dropped += 1
+                print('panohub.py: WARN Stitch Queue Full. Dropped Seq %s' % dropped_job[0])
+            if dropped_job is not job:
+                self.jobs.append((time.monotonic(), job))
+                self.cond.notify_all()
+        if dropped_job is not None and self.on_drop is not None:
+            self.on_drop(dropped_job)
+        return dropped_job is not job
+
+    def put_background(self, *job):
+        ''' Add a low priority stitch job. Return False if the queue was full '''
+        with self.cond:
+            dropped = len(self.background_jobs) >= self.max_depth
+            if dropped:
+                queued_time, old_job = self.background_jobs.popleft()
+                self.dropped += 1
+                print('panohub.py: WARN Background Stitch Queue Full. Dropped Seq %s' %
+                      old_job[0])
+            self.background_jobs.append((time.monotonic(), job))
+            self.cond.notify_all()
+        if dropped and self.on_drop is not None:
+            self.on_drop(old_job)
+        return not dropped
+
+    def depth(self):
+        ''' Return number of jobs waiting for a stitch worker '''
+        with self.cond:
+            return len(self.jobs) + len(self.background_jobs)
+
+    def background_depth(self):
+        ''' Return number of background jobs waiting for a stitch worker '''
+        with self.cond:
+            return len(self.background_jobs)
+
+    def pending(self):
+        ''' Return number of jobs waiting or running '''
+        with self.cond:
+            return len(self.jobs) + len(self.background_jobs) + self.active
+
+    def join(self, timeout=None):
+        '''
+        Wait until all queued and running jobs are finished.
+        Return False if timeout seconds expired first.
+        '''
+        end_time = None
+        if timeout is not None:
+            end_time = time.time() + timeout
+        with self.cond:
+            while self.jobs or self.background_jobs or self.active:
+                if end_time is None:
+                    self.cond.wait()
+                else:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.cond.wait(remaining)
+        return True
+
+    def abandon(self):
+        '''
+        Remove all waiting jobs and return them with the jobs still
+        running eg so their frames can be saved before exit.
+        '''
+        with self.cond:
+            jobs = ([job for queued_time, job in self.jobs] +
+                    [job for queued_time, job in self.background_jobs] +
+                    list(self.running))
+            self.jobs.clear()
+            self.background_jobs.clear()
+            self.cond.notify_all()
+        return jobs
+
+#---------------------------------------------------------------
+class TimelapseScheduler(object):
+    '''
+    Timelapse trigger schedule based on the monotonic clock so wall clock
+    changes do not affect it. Deadlines are a fixed interval apart and do
+    not drift with processing time. The receive loop sleeps in its poll
+    for time_to_next() instead of polling the clock. Deadlines already
+    passed when a trigger fires are skipped and counted as missed triggers.
+    '''
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_deadline = time.monotonic() + interval
+        self.fired = 0
+        self.missed = 0
+        self.last_lag = 0.0
+
+    def time_to_next(self):
+        ''' Return seconds remaining until the next trigger deadline '''
+        return max(0.0, self.next_deadline - time.monotonic())
+
+    def next_wall_time(self):
+        ''' Return the next trigger deadline as a wall clock timestamp '''
+        return time.time() + (self.next_deadline - time.monotonic())
+
+    def fire(self):
+        '''
+        Record a trigger and advance to the next deadline.
+        Return seconds the trigger fired after its deadline.
+        '''
+        now = time.monotonic()
+        self.last_lag = now - self.next_deadline
+        self.fired += 1
+        self.next_deadline += self.interval
+        if self.next_deadline <= now:
+            missed = int((now - self.next_deadline) // self.interval) + 1
+            self.missed += missed
+            self.next_deadline += missed * self.interval
+            print('panohub.py: WARN Missed %i Timelapse Trigger(s). Total Missed %i' %
+                  (missed, self.missed))
+        return self.last_lag
+
+    def status(self):
+        ''' Return a dict of the current schedule for inspection '''
+        return {'next_trigger': timestamp_to_string(self.next_wall_time()),
+                'next_trigger_sec': round(self.time_to_next(), 3),
+                'interval_sec': self.interval,
+                'last_lag_sec': round(self.last_lag, 3),
+                'fired': self.fired,
+                'missed': self.missed}
+
+#---------------------------------------------------------------
+class StitchCheck(object):
+    '''
+    Quick overlap check of neighbouring cameras on reduced size frames
+    before a stitch so a misaligned rig does not burn a full stitch run
+    every sequence. A rig that passes is trusted for recheck_sec or until
+    a stitch fails. A rig that fails is checked again each sequence and
+    stitches are skipped meanwhile. Partial sequences use the result of
+    the last full sequence since their cameras may not be neighbours.
+    Skipped jobs can be kept with defer(). Once the check recovers they
+    are queued one at a time as background stitches after each successful
+    stitch so they do not overflow the background queue.
+    '''
+    def __init__(self, work_width, min_matches, min_overlap, recheck_sec, defer_max):
+        self.work_width = work_width
+        self.min_matches = min_matches
+        self.min_overlap = min_overlap
+        self.recheck_sec = recheck_sec
+        self.stitch_queue = None
+        self.lock = threading.Lock()
+        self.results = {}  # rig camera names: (reason or None, next check monotonic time)
+        self.last_rig = None
+        self.deferred = collections.deque(maxlen=defer_max)
+
+    def read_image(self, image_path, jpg_buffer):
+        ''' Return the frame decoded at a reduced size no smaller than work_width '''
+        image = read_frame(image_path, jpg_buffer, cv2.IMREAD_REDUCED_COLOR_4)
+        if image is not None and image.shape[1] < self.work_width:
+            image = read_frame(image_path, jpg_buffer)
+        return image
+
+    def check(self, cam_names, seq_frames, partial=False):
+        ''' Return the reason a stitch of these frames should be skipped or None '''
+        rig = tuple(cam_names)
+        with self.lock:
+            if partial:
+                return self.results.get(self.last_rig, (None, 0))[0]
+            reason, next_check = self.results.get(rig, (None, 0))
+            if reason is None and time.monotonic() < next_check:
+                return None
+        start_time = time.monotonic()
+        images = [self.read_image(image_path, jpg_buffer)
+                  for rpi_name, image_path, jpg_buffer in seq_frames]
+        if any(image is None for image in images):
+            return None  # the stitch reports unreadable frames
+        pairs = panostitch.check_overlap(cam_names, images, STITCH_CAMERA_HFOV,
+                                         work_width=self.work_width)
+        HUB_METRICS.observe('panohub_stitch_check_seconds', time.monotonic() - start_time)
+        problems = []
+        for pair in pairs:
+            pair_name = '%s-%s' % (pair['left'], pair['right'])
+            HUB_METRICS.set('panohub_overlap_matches', pair['matches'], pair=pair_name)
+            HUB_METRICS.set('panohub_overlap_fraction', round(pair['overlap'], 3), pair=pair_name)
+            if pair['matches'] < self.min_matches:
+                problems.append('%s %i matches' % (pair_name, pair['matches']))
+            elif pair['overlap'] < self.min_overlap:
+                problems.append('%s %.0f%% overlap' % (pair_name, pair['overlap'] * 100))
+        reason = None
+        if problems:
+            reason = 'Overlap Check Failed %s' % ', '.join(problems)
+        with self.lock:
+            recovered = reason is None and self.results.get(rig, (None, 0))[0] is not None
+            self.results[rig] = (reason, time.monotonic() + self.recheck_sec)
+            self.last_rig = rig
+        # plain python values for the json status file
+        HUB_STATUS.update(stitch_check={'ok': reason is None,
+                                        'reason': reason,
+                                        'time': time.time(),
+                                        'pairs': [{'left': str(pair['left']),
+                                                   'right': str(pair['right']),
+                                                   'matches': int(pair['matches']),
+                                                   'overlap': (round(float(pair['overlap']), 3)
+                                                               if np.isfinite(pair['overlap'])
+                                                               else None)}
+                                                  for pair in pairs]})
+        if recovered:
+            print('panohub.py: Overlap Check Recovered for %s. Stitching Resumed' %
+                  ', '.join(cam_names))
+            self.queue_deferred()
+        return reason
+
+    def defer(self, job):
+        ''' Keep a skipped stitch job to queue when the check recovers '''
+        with self.lock:
+            self.deferred.append(job)
+
+    def queue_deferred(self):
+        ''' Queue the oldest deferred job if the rig is healthy and there is room '''
+        with self.lock:
+            if (not self.deferred or self.results.get(self.last_rig, (None, 0))[0] is not None or
+                    self.stitch_queue.background_depth() >= self.stitch_queue.max_depth):
+                return
+            job = self.deferred.popleft()
+            remaining = len(self.deferred)
+        self.stitch_queue.put_background(*job)
+        print('panohub.py: Seq %s Deferred Stitch Queued. %i Remaining' % (job[0], remaining))
+
+    def stitch_failed(self, cam_names):
+        ''' Check the rig again on its next sequence '''
+        with self.lock:
+            reason, next_check = self.results.get(tuple(cam_names), (None, 0))
+            self.results[tuple(cam_names)] = (reason, 0)
+
+#---------------------------------------------------------------
+class VideoBuilder(object):
+    '''
+    Append each stitched pano to a running timelapse video on a
+    background thread so the movie never has to be encoded in one
+    batch. Panos are letterboxed to a fixed width x height canvas since
+    their size can change eg after recalibration or a partial sequence.
+    A segment is finished after max_frames frames or max_sec seconds.
+    It is encoded to a hidden .name file and renamed when finished, so
+    the webserver only lists complete segments.
+    '''
+    def __init__(self, video_dir, width, height, fps=10, fourcc='mp4v',
+                 max_frames=1000, max_sec=86400, queue_max=20):
+        self.video_dir = video_dir
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.fourcc = cv2.VideoWriter_fourcc(*fourcc)
+        self.max_frames = max_frames
+        self.max_sec = max_sec
+        self.pano_queue = queue.Queue(max(1, queue_max))
+        self.writer = None
+        self.part_path = None
+        self.segment_path = None
+        self.segment_frames = 0
+        self.segment_start = None
+        if not os.path.isdir(video_dir):
+            os.makedirs(video_dir)
+        for file_name in os.listdir(video_dir):
+            if file_name.startswith('.' + VIDEO_PREFIX):
+                # not finalized when panohub stopped so not playable
+                print('panohub.py: WARN Removing Unfinished Video Segment %s' % file_name)
+                os.remove(os.path.join(video_dir, file_name))
+        self.thread = threading.Thread(target=self._run, name='VideoBuilder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            timeout = None
+            if self.writer is not None and self.max_sec > 0:
+                timeout = max(0.0, self.segment_start + self.max_sec - time.time())
+            try:
+                pano_path = self.pano_queue.get(timeout=timeout)
+            except queue.Empty:
+                self.finish_segment()  # segment time is up with no new pano
+                continue
+            try:
+                if pano_path is None:
+                    self.finish_segment()
+                    return
+                self.append(pano_path)
+            except Exception as err_msg:
+                print('panohub.py: ERROR Video Append %s Failed %s' % (pano_path, err_msg))
+            finally:
+                self.pano_queue.task_done()
+
+    def add(self, pano_path):
+        ''' Queue a stitched pano to append. Skipped if the queue is full '''
+        try:
+            self.pano_queue.put_nowait(pano_path)
+        except queue.Full:
+            print('panohub.py: WARN Video Queue Full. Skipped %s' % pano_path)
+
+    def letterbox(self, image):
+        ''' Return image scaled to fit the video canvas and centered on black '''
+        height, width = image.shape[:2]
+        scale = min(self.width / float(width), self.height / float(height))
+        fit_width = max(1, min(self.width, int(round(width * scale))))
+        fit_height = max(1, min(self.height, int(round(height * scale))))
+        canvas = np.zeros((self.height, self.width, 3), np.uint8)
+        left = (self.width - fit_width) // 2
+        top = (self.height - fit_height) // 2
+        canvas[top:top + fit_height, left:left + fit_width] = cv2.resize(
+            image, (fit_width, fit_height),
+            interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+        return canvas
+
+    def append(self, pano_path):
+        ''' Add one pano image as the next video frame '''
+        image = cv2.imread(pano_path)
+        if image is None:
+            print('panohub.py: WARN Video Could Not Read %s' % pano_path)
+            return
+        if self.writer is not None and self.max_sec > 0:
+            if time.time() - self.segment_start >= self.max_sec:
+                self.finish_segment()
+        if self.writer is None:
+            self.start_segment()
+        self.writer.write(self.letterbox(image))
+        self.segment_frames += 1
+        if self.segment_frames >= self.max_frames:
+            self.finish_segment()
+
+    def start_segment(self):
+        ''' Open a new hidden video segment file '''
+        self.segment_start = time.time()
+        segment_name = (VIDEO_PREFIX +
+                        datetime.datetime.fromtimestamp(self.segment_start).strftime('%Y%m%d-%H%M%S') +
+                        VIDEO_EXT)
+        self.segment_path = os.path.join(self.video_dir, segment_name)
+        self.part_path = os.path.join(self.video_dir, '.' + segment_name)
+        self.writer = cv2.VideoWriter(self.part_path, self.fourcc, self.fps,
+                                      (self.width, self.height))
+        if not self.writer.isOpened():
+            self.writer = None
+            raise IOError('Could not open video writer for %s' % self.part_path)
+        self.segment_frames = 0
+        print('panohub.py: Started Video Segment %s' % self.segment_path)
+
+    def finish_segment(self):
+        ''' Finalize the current segment and rename it to its listed name '''
+        if self.writer is None:
+            return
+        self.writer.release()
+        self.writer = None
+        os.replace(self.part_path, self.segment_path)
+        print('panohub.py: Finished Video Segment %s  %i Frames' %
+              (self.segment_path, self.segment_frames))
+
+    def close(self, timeout=None):
+        ''' Append queued panos, finish the current segment and stop '''
+        self.pano_queue.put(None)
+        self.thread.join(timeout)
+
+#---------------------------------------------------------------
+class RetentionEngine(object):
+    '''
+    Limit media disk use for long running timelapses. Raw frames of a
+    successful stitch with all cameras are deleted or archived right
+    away per RETAIN_RAW_AFTER_STITCH. Frames of partial sequences are
+    kept since a late frame can reopen the sequence. A background sweep
+    every RETAIN_CHECK_SEC removes media older than RETAIN_MAX_AGE_DAYS,
+    all but the newest RETAIN_MAX_PANOS panos and RETAIN_MAX_FRAMES
+    frames, then the oldest media until RETAIN_MIN_FREE_MB is free.
+    '''
+    def __init__(self):
+        self.raw_action = RETAIN_RAW_AFTER_STITCH
+        if self.raw_action not in RETAIN_RAW_ACTIONS:
+            print('panohub.py: WARN RETAIN_RAW_AFTER_STITCH=%s Not Valid. Using keep' %
+                  self.raw_action)
+            self.raw_action = 'keep'
+        self.media_dirs = [IMAGE_DIR, IMAGE_PANO_DIR]
+        if self.raw_action == 'archive':
+            self.media_dirs.append(RETAIN_ARCHIVE_DIR)
+        self.sweep_on = (RETAIN_MAX_AGE_DAYS > 0 or RETAIN_MAX_PANOS > 0 or
+                         RETAIN_MAX_FRAMES > 0 or RETAIN_MIN_FREE_MB > 0)
+        if self.sweep_on:
+            self.thread = threading.Thread(target=self._run, name='Retention')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as err_msg:
+                print('panohub.py: ERROR Retention Sweep Failed %s' % err_msg)
+            time.sleep(max(10, RETAIN_CHECK_SEC))
+
+    def after_stitch(self, image_paths, partial):
+        ''' Delete or archive the raw frames of a successful stitch '''
+        if self.raw_action == 'keep' or partial or not image_paths:
+            return
+        FRAME_WRITER.flush()  # frames are saved in the background
+        for image_path in image_paths:
+            try:
+                if self.raw_action == 'delete':
+                    os.remove(image_path)
+                else:
+                    archive_path = os.path.join(RETAIN_ARCHIVE_DIR,
+                                                os.path.relpath(image_path, IMAGE_DIR))
+                    archive_dir = os.path.dirname(archive_path)
+                    if not os.path.isdir(archive_dir):
+                        os.makedirs(archive_dir)
+                    shutil.move(image_path, archive_path)
+            except (IOError, OSError) as err_msg:
+                print('panohub.py: WARN Could Not %s %s %s' %
+                      (self.raw_action.title(), image_path, err_msg))
+
+    def sweep(self):
+        ''' Apply age, count and free space limits. Oldest media is removed first '''
+        media_files = {}  # media dir: [(mtime, bytes, path)] oldest first
+        for media_dir in self.media_dirs:
+            media_files[media_dir] = list_media_files(media_dir)
+        remove_paths = set()
+        if RETAIN_MAX_AGE_DAYS > 0:
+            oldest_time = time.time() - RETAIN_MAX_AGE_DAYS * 86400
+            for files in media_files.values():
+                remove_paths.update(path for mtime, size, path in files if mtime < oldest_time)
+        for media_dir, max_files in ((IMAGE_PANO_DIR, RETAIN_MAX_PANOS),
+                                     (IMAGE_DIR, RETAIN_MAX_FRAMES)):
+            if max_files > 0 and len(media_files[media_dir]) > max_files:
+                remove_paths.update(path for mtime, size, path in
+                                    media_files[media_dir][:-max_files])
+        removed_bytes = sum(size for files in media_files.values()
+                            for mtime, size, path in files if path in remove_paths)
+        if RETAIN_MIN_FREE_MB > 0:
+            stat = os.statvfs(IMAGE_DIR)
+            free_bytes = stat.f_bavail * stat.f_frsize + removed_bytes
+            need_bytes = RETAIN_MIN_FREE_MB * 1024 * 1024
+            all_files = sorted(media_file for files in media_files.values() for media_file in files)
+            for mtime, size, path in all_files:
+                if free_bytes >= need_bytes:
+                    break
+                if path not in remove_paths:
+                    remove_paths.add(path)
+                    free_bytes += size
+                    removed_bytes += size
+        for path in remove_paths:
+            try:
+                os.remove(path)
+            except OSError as err_msg:
+                print('panohub.py: WARN Could Not Remove %s %s' % (path, err_msg))
+        for media_dir in self.media_dirs:
+            remove_empty_dirs(media_dir, RETAIN_EMPTY_DIR_SEC)
+        if remove_paths:
+            print('panohub.py: Retention Removed %i Media Files %.1f MB' %
+                  (len(remove_paths), removed_bytes / 1048576.0))
+
+#---------------------------------------------------------------
+def list_media_files(media_dir):
+    ''' Return mtime, bytes, path of files under media_dir oldest first '''
+    media_files = []
+    for dir_path, dir_names, file_names in os.walk(media_dir):
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            media_files.append((stat.st_mtime, stat.st_size, path))
+    media_files.sort()
+    return media_files
+
+#---------------------------------------------------------------
+def remove_empty_dirs(media_dir, min_age_sec=0):
+    '''
+    Remove empty bucket folders under media_dir not changed for
+    min_age_sec so a folder about to get new frames is kept.
+    '''
+    for dir_path, dir_names, file_names in os.walk(media_dir, topdown=False):
+        if dir_path == media_dir or file_names:
+            continue
+        try:
+            if time.time() - os.stat(dir_path).st_mtime >= min_age_sec:
+                os.rmdir(dir_path)  # fails if not empty eg sub folder kept
+        except OSError:
+            pass
+
+#---------------------------------------------------------------
+def get_media_dir(base_dir, seq_num, timestamp):
+    '''
+    Return the folder for media of a sequence per MEDIA_LAYOUT.
+    flat= base_dir  date= base_dir/YYYY-MM-DD of timestamp
+    seq= base_dir/first seq num of its MEDIA_SEQ_BUCKET sized bucket.
+    The folder is created if needed.
+    '''
+    if MEDIA_LAYOUT == 'date':
+        media_dir = os.path.join(base_dir,
+                                 datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d'))
+    elif MEDIA_LAYOUT == 'seq':
+        media_dir = os.path.join(base_dir, str(seq_num // MEDIA_SEQ_BUCKET * MEDIA_SEQ_BUCKET))
+    else:
+        return base_dir
+    if not os.path.isdir(media_dir):
+        os.makedirs(media_dir)
+    return media_dir
+
+#---------------------------------------------------------------
+def get_media_seq_num(file_name):
+    ''' Return the seq num in a panohub frame or pano file name or None '''
+    name_root = os.path.splitext(file_name)[0]
+    if not name_root.startswith(IMAGE_PREFIX):
+        return None
+    if name_root.endswith(PREVIEW_SUFFIX):
+        name_root = name_root[:-len(PREVIEW_SUFFIX)]
+    seq_num = name_root[len(IMAGE_PREFIX):].rpartition('-')[2]
+    if seq_num.isdigit():
+        return int(seq_num)
+    return None
+
+#---------------------------------------------------------------
+def migrate_media():
+    '''
+    Move existing frames and panos into the folders of the current
+    MEDIA_LAYOUT. date uses the file modified time. Files already in
+    place or without a seq num in their name for the seq layout stay.
+    '''
+    moved = 0
+    for base_dir in (IMAGE_DIR, IMAGE_PANO_DIR):
+        if not os.path.isdir(base_dir):
+            continue
+        print('panohub.py: Migrate %s to MEDIA_LAYOUT %s' % (base_dir, MEDIA_LAYOUT))
+        for mtime, size, path in list_media_files(base_dir):
+            file_name = os.path.basename(path)
+            seq_num = get_media_seq_num(file_name)
+            if MEDIA_LAYOUT == 'seq' and seq_num is None:
+                continue
+            new_path = os.path.join(get_media_dir(base_dir, seq_num or 0, mtime), file_name)
+            if new_path == path:
+                continue
+            if os.path.exists(new_path):
+                print('panohub.py: WARN Not Moved %s. %s Exists' % (path, new_path))
+                continue
+            os.rename(path, new_path)
+            moved += 1
+        remove_empty_dirs(base_dir)
+    print('panohub.py: Moved %i Media Files' % moved)
+
+#---------------------------------------------------------------
+class HubStatus(object):
+    '''
+    Hub state shared with webserver.py through a json file. Each update
+    rewrites the whole file with a rename so readers never see a partial
+    file. Updates come from the receive loop and stitch worker threads.
+    '''
+    def __init__(self, status_path):
+        self.status_path = status_path
+        self.stitch_queue = None
+        self.lock = threading.Lock()
+        self.values = {'pid': os.getpid(),
+                       'started': time.time(),
+                       'version': PROG_VER}
+
+    def update(self, **values):
+        '''
+        Save changed status values with the current stitch queue depth.
+        Values that can not be saved as json are logged and the previous
+        values kept so a status write never fails the caller.
+        '''
+        with self.lock:
+            old_values = dict(self.values)
+            self.values.update(values)
+            if self.stitch_queue is not None:
+                self.values['stitch_queue_depth'] = self.stitch_queue.depth()
+            self.values['updated'] = time.time()
+            tmp_path = self.status_path + '.tmp'
+            try:
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.values, f, allow_nan=False)
+                os.replace(tmp_path, self.status_path)
+            except (IOError, OSError) as err_msg:
+                print('panohub.py: WARN Could Not Save Status %s %s' % (self.status_path, err_msg))
+            except (TypeError, ValueError) as err_msg:
+                print('panohub.py: WARN Status %s Not Saved %s' % (', '.join(sorted(values)), err_msg))
+                self.values = old_values
+
+#---------------------------------------------------------------
+class HubMetrics(object):
+    '''
+    Counters, gauges and stage timings of the hub and its senders in
+    Prometheus text format. Timings are summaries with quantiles of the
+    last METRICS_WINDOW samples plus running sum and count. Sender
+    stage timings and counters arrive in the stats dict of each frame.
+    Updates come from the receive loop, frame writer and stitch threads.
+    '''
+    # name: (type, help). Metrics are listed in this order
+    METRICS = collections.OrderedDict([
+        ('panohub_triggers_total', ('counter', 'Timelapse triggers fired')),
+        ('panohub_missed_triggers_total', ('counter', 'Timelapse triggers skipped since the hub was late')),
+        ('panohub_pings_total', ('counter', 'Clock sync pings answered')),
+        ('panohub_frames_received_total', ('counter', 'Frames received by camera and rendition')),
+        ('panohub_frame_bytes_total', ('counter', 'Jpeg bytes received by camera')),
+        ('panohub_duplicate_frames_total', ('counter', 'Duplicate frames answered but not saved')),
+        ('panohub_sync_only_frames_total', ('counter', 'Frames not part of a sequence')),
+        ('panohub_sequences_total', ('counter', 'Closed sequences by result complete, partial, degraded or empty')),
+        ('panohub_stitches_total', ('counter', 'Stitch jobs by result ok, failed or skipped and rendition')),
+        ('panohub_stitch_dropped_total', ('counter', 'Stitch jobs dropped since the stitch queue was full')),
+        ('panohub_stitch_queue_depth', ('gauge', 'Stitch jobs waiting for a worker')),
+        ('panohub_open_sequences', ('gauge', 'Sequences waiting for frames')),
+        ('panohub_transmit_seconds', ('summary', 'Sender send to hub receive time of frames')),
+        ('panohub_frame_latency_seconds', ('summary', 'Capture to hub receive time of frames')),
+        ('panohub_write_seconds', ('summary', 'Time to write a received frame to disk')),
+        ('panohub_sequence_seconds', ('summary', 'Trigger to last frame received time of closed sequences')),
+        ('panohub_stitch_queue_wait_seconds', ('summary', 'Time stitch jobs waited for a worker')),
+        ('panohub_decode_seconds', ('summary', 'Time to read and decode the frames of a stitch')),
+        ('panohub_stitch_seconds', ('summary', 'Stitch job time by rendition')),
+        ('panohub_stitch_check_seconds', ('summary', 'Pre-stitch overlap check time')),
+        ('panohub_overlap_matches', ('gauge', 'Feature matches between neighbour cameras at the last overlap check')),
+        ('panohub_overlap_fraction', ('gauge', 'Frame width shared by neighbour cameras at the last overlap check')),
+        ('panosend_capture_seconds', ('summary', 'Sender camera capture time')),
+        ('panosend_encode_seconds', ('summary', 'Sender jpeg encode time')),
+        ('panosend_round_trip_seconds', ('summary', 'Sender frame send and hub reply time')),
+        ('panosend_frames_sent_total', ('counter', 'Frames sent as reported by each sender')),
+        ('panosend_timeouts_total', ('counter', 'Hub reply timeouts as reported by each sender')),
+        ('panosend_spooled_frames', ('gauge', 'Frames waiting in each sender spool')),
+        ('panosend_full_frames_kept', ('gauge', 'Full resolution frames kept by each sender for previews')),
+        ('panosend_clock_offset_seconds', ('gauge', 'Sender estimate of hub clock minus sender clock')),
+    ])
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, window=500):
+        self.window = window
+        self.stitch_queue = None
+        self.lock = threading.Lock()
+        self.values = {}  # (name, labels): counter or gauge value
+        self.summaries = {}  # (name, labels): [recent samples deque, sum, count]
+
+    def inc(self, name, amount=1, **labels):
+        ''' Add amount to a counter '''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        ''' Set a gauge or a counter kept elsewhere eg by a sender '''
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, seconds, **labels):
+        ''' Add a stage timing sample to a summary '''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            summary = self.summaries.get(key)
+            if summary is None:
+                summary = self.summaries[key] = [collections.deque(maxlen=self.window), 0.0, 0]
+            summary[0].append(seconds)
+            summary[1] += seconds
+            summary[2] += 1
+
+    def add_frame(self, info):
+        ''' Record a received frame and the sender stats it carries '''
+        camera = info['name']
+        rendition = info.get('rendition', 'full')
+        self.inc('panohub_frames_received_total', camera=camera, rendition=rendition)
+        self.inc('panohub_frame_bytes_total', info.get('bytes', 0), camera=camera)
+        if info.get('send_time') is not None:
+            self.observe('panohub_transmit_seconds', info['recv_time'] - info['send_time'],
+                         camera=camera)
+        stats = info.get('stats')
+        if not isinstance(stats, dict) or info.get('spooled') or info.get('deferred'):
+            return  # stats of spooled and deferred frames are out of date
+        self.observe('panohub_frame_latency_seconds',
+                     info['recv_time'] - info['capture_time'], camera=camera)
+        for stat, name in (('capture_sec', 'panosend_capture_seconds'),
+                           ('encode_sec', 'panosend_encode_seconds'),
+                           ('send_sec', 'panosend_round_trip_seconds')):
+            if stats.get(stat) is not None:
+                self.observe(name, stats[stat], camera=camera)
+        for stat, name in (('frames_sent', 'panosend_frames_sent_total'),
+                           ('timeouts', 'panosend_timeouts_total'),
+                           ('spooled', 'panosend_spooled_frames'),
+                           ('full_kept', 'panosend_full_frames_kept')):
+            if stats.get(stat) is not None:
+                self.set(name, stats[stat], camera=camera)
+        if info.get('clock_offset') is not None:
+            self.set('panosend_clock_offset_seconds', info['clock_offset'], camera=camera)
+
+    def render(self):
+        ''' Return all metrics in Prometheus text exposition format '''
+        if self.stitch_queue is not None:
+            self.set('panohub_stitch_queue_depth', self.stitch_queue.depth())
+            self.set('panohub_stitch_dropped_total', self.stitch_queue.dropped)
+        with self.lock:
+            values = sorted(self.values.items())
+            summaries = sorted((key, sorted(summary[0]), summary[1], summary[2])
+                               for key, summary in self.summaries.items())
+        lines = []
+        for name, (metric_type, help_text) in self.METRICS.items():
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for (value_name, labels), value in values:
+                if value_name == name:
+                    lines.append('%s%s %s' % (name, format_labels(labels), value))
+            for (summary_name, labels), samples, total, count in summaries:
+                if summary_name != name:
+                    continue
+                for quantile in self.QUANTILES:
+                    lines.append('%s%s %.6f' % (name, format_labels(labels + (('quantile', quantile),)),
+                                                samples[min(len(samples) - 1,
+                                                            int(quantile * len(samples)))]))
+                lines.append('%s_sum%s %.6f' % (name, format_labels(labels), total))
+                lines.append('%s_count%s %i' % (name, format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+#---------------------------------------------------------------
+def format_labels(labels):
+    ''' Return Prometheus label text for label name, value pairs '''
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for label, value in labels)
+
+#---------------------------------------------------------------
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    ''' Serve HUB_METRICS at /metrics for Prometheus or curl '''
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404, 'Try /metrics')
+            return
+        body = HUB_METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes every few seconds would flood the hub log
+
+#---------------------------------------------------------------
+def start_metrics_server(bind_addr, port):
+    ''' Serve metrics from a daemon thread. Return the server or None '''
+    try:
+        server = http.server.ThreadingHTTPServer((bind_addr, port), MetricsHandler)
+    except (OSError, socket.error) as err_msg:
+        print('panohub.py: WARN Could Not Start Metrics Server on Port %i %s' % (port, err_msg))
+        return None
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='Metrics')
+    thread.daemon = True
+    thread.start()
+    print('panohub.py: Metrics at http://%s:%i/metrics' % (bind_addr or '0.0.0.0', port))
+    return server
+
+#---------------------------------------------------------------
+def decode_jpg(jpg_buffer):
+    '''
+    Decode a received jpeg buffer into an opencv BGR image.
+    Only call this when a stage actually needs the pixels.
+    '''
+    return cv2.imdecode(np.frombuffer(jpg_buffer, dtype='uint8'), -1)
+
+#---------------------------------------------------------------
+def read_frame(image_path, jpg_buffer, flags=cv2.IMREAD_COLOR):
+    '''
+    Return a sequence frame as an opencv BGR image. Frames still held
+    in memory are decoded from their received jpeg buffer, otherwise
+    the saved image_path is read.
+    '''
+    if jpg_buffer is not None:
+        return cv2.imdecode(np.frombuffer(jpg_buffer, dtype='uint8'), flags)
+    return cv2.imread(image_path, flags)
+
+#---------------------------------------------------------------
+def save_raw_frame(image_path, jpg_buffer):
+    ''' Save a received jpeg per IMAGE_PASSTHROUGH_ON '''
+    if IMAGE_PASSTHROUGH_ON:
+        # save received jpeg bytes as-is. No decode or re-encode
+        FRAME_WRITER.write(image_path, jpg_buffer)
+    else:
+        # decode and re-encode image file from a camera node
+        cv2.imwrite(image_path, decode_jpg(jpg_buffer))
+
+#---------------------------------------------------------------
+def keep_raw_frames(seq_frames):
+    '''
+    Save the in-memory frames of a failed, skipped, dropped or abandoned
+    stitch when IMAGE_KEEP_RAW is on_failure. Return the frames with their
+    buffers released if the frames are saved on disk.
+    '''
+    if IMAGE_KEEP_RAW == 'none':
+        return seq_frames
+    if IMAGE_KEEP_RAW == 'on_failure':
+        for rpi_name, image_path, jpg_buffer in seq_frames:
+            if jpg_buffer is not None:
+                save_raw_frame(image_path, jpg_buffer)
+    return [(rpi_name, image_path, None) for rpi_name, image_path, jpg_buffer in seq_frames]
+
+#---------------------------------------------------------------
+def keep_dropped_frames(job):
+    ''' StitchQueue on_drop hook. Save frames of a dropped or abandoned stitch job '''
+    keep_raw_frames(job[1])
 
 #---------------------------------------------------------------
 def get_panosend_yaml_stream(yaml_file_path, yaml_section_name):
@@ -108,34 +1120,63 @@ def get_panosend_yaml_stream(yaml_file_path, yaml_section_name):
         sys.exit(1)
 
 #---------------------------------------------------------------
-def get_remote_host_ip(remote_host_name):
+def get_remote_host_ip(remote_host_name, use_cache=True):
     '''
     Get ip address of a fully qualified hostname and
     return the ip address of the host. Return None if
     there is a socket error and print warning message.
+    Resolved addresses are cached since zeroconf lookups are slow.
     '''
+    if use_cache and remote_host_name in HOST_IP_CACHE:
+        return HOST_IP_CACHE[remote_host_name]
     try:
         ip = socket.gethostbyname(remote_host_name)
+        HOST_IP_CACHE[remote_host_name] = ip
     except socket.error as err_msg:
         print("panohub.py: WARN hostname: %s  %s" %(remote_host_name, err_msg))
         ip = None
     return ip
 
 #---------------------------------------------------------------
-def get_senders(host_list):
+def notify_sender(context, host_name, yaml_data):
     '''
-    Take a list of host names, get associated ip address
-    for for valid hostnames and return a dictionary with
-    hostname as key and ip address and tcp port list as value.
+    Send yaml_data to panowatch.py on host_name and wait for its ip
+    address reply. Each attempt waits NOTIFY_TIMEOUT_SEC and failed
+    attempts are retried NOTIFY_RETRIES times with a doubling delay.
+    Return a result string ok, unresolved, timeout or bad reply.
     '''
-    host_dict = {}
-    for hostname in host_list:
-        ip_addr = get_remote_host_ip(hostname)
-        if ip_addr is not None:
-            host_dict.update({hostname:[ip_addr, ZMQ_WATCH_PORT]})
-            print('panohub.py: %s is connected to zmq tcp://%s:%s' %
-                  (hostname, ip_addr, ZMQ_WATCH_PORT))
-    return host_dict
+    result = 'unresolved'
+    for attempt in range(NOTIFY_RETRIES + 1):
+        if attempt:
+            time.sleep(NOTIFY_BACKOFF_SEC * 2 ** (attempt - 1))
+        # Look up the address again if the cached one did not answer
+        ip = get_remote_host_ip(host_name, use_cache=(result != 'timeout'))
+        if ip is None:
+            result = 'unresolved'
+            continue
+        ip_addr = ip.encode('utf-8')
+        sender = context.socket(zmq.REQ)
+        sender.setsockopt(zmq.LINGER, 0)
+        sender.connect(ZMQ_PROTOCOL + ip + ":" + str(ZMQ_WATCH_PORT))
+        print('panohub.py: %s Send yaml data to tcp://%s:%s Attempt %i' %
+              (host_name, ip, ZMQ_WATCH_PORT, attempt + 1))
+        sender.send(yaml_data)
+        if sender.poll(int(NOTIFY_TIMEOUT_SEC * 1000)):
+            reply_from = sender.recv()
+            if reply_from == ip_addr:
+                result = 'ok'
+            else:
+                result = 'bad reply'
+                print('panohub.py: %s Reply from %s instead of %s' %
+                      (host_name, reply_from, ip_addr))
+        else:
+            result = 'timeout'
+            print('panohub.py: %s No Reply after %s sec' % (host_name, NOTIFY_TIMEOUT_SEC))
+        sender.close()  # a REQ socket can not be reused after a timeout
+        if result == 'ok':
+            print('panohub.py: %s Successful Reply from %s' % (host_name, ip))
+            break
+    return result
 
 #---------------------------------------------------------------
 def notify_senders(host_list, restart=True):
@@ -143,6 +1184,8 @@ def notify_senders(host_list, restart=True):
     Notify watcher.py per list of host, send yaml settings data
     to each host and restart or stop panosend.py as appropriate
     This will ensure panosend is always started after panohub.py
+    All hosts are notified at the same time using one shared zmq context.
+    Return a dict with each host name and its result.
     '''
 
     if restart:
@@ -152,31 +1195,14 @@ def notify_senders(host_list, restart=True):
         yaml_data = b'stop'
         print('panohub.py: Kill panosend.py on remote hosts')
 
-    pano_senders = get_senders(host_list)
-
-    for key, val in pano_senders.items():
-        host_name = pano_senders[key]
-        ip, port = val  # Read sender connection details
-        ip_addr = ip.encode('utf-8')
-        print('panohub.py: %s Connect at tcp://%s:%s' % (key, ip, port))
-        context = zmq.Context()
-        sender = context.socket(zmq.REQ)
-        sender.connect(ZMQ_PROTOCOL + ip + ":" + port)
-        print('panohub.py: %s Send yaml data to tcp://%s:%s' %
-              (key, ip, port))
-        reply_from = b''
-        retries = 0
-        while not (reply_from == ip_addr):
-            sender.send(yaml_data)
-            reply_from = sender.recv()
-            if reply_from == ip_addr:
-                print('panohub.py: %s Successful Reply from %s' %
-                      (key, reply_from))
-            else:
-                retries += 1
-                print('panohub.py: %s Reply %i from %s instead of %s' %
-                      (key, retries, reply_from, ip_addr))
-            time.sleep(0.2)  # Allow short delay before retry.
+    context = zmq.Context.instance()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(host_list))) as pool:
+        futures = dict((host_name, pool.submit(notify_sender, context, host_name, yaml_data))
+                       for host_name in host_list)
+    results = dict((host_name, future.result()) for host_name, future in futures.items())
+    for host_name in host_list:
+        print('panohub.py: %s Notify Result %s' % (host_name, results[host_name]))
+    return results
 
 #---------------------------------------------------------------
 def read_yaml_vars(yaml_file_path, yaml_section_name):
@@ -217,82 +1243,192 @@ def make_ip_dict(host_list):
     return host_dict
 
 #---------------------------------------------------------------
-def write_seq_num(counter, counter_path):
-    '''
-    Save the current sequence number to a .dat
-    file to allow continuing sequence after restart.
-    '''
-    if not os.path.isfile(counter_path):
-        print('panohub.py: Create New Counter File SEQ_NUM=%s %s' %
-              (counter, counter_path))
-        open(counter_path, 'w').close()
-    f = open(counter_path, 'w+')
-    f.write(str(counter))
-    f.close()
-    print('panohub.py: Next SEQ_NUM=%s %s' % (counter, counter_path))
-
-#---------------------------------------------------------------
-def get_saved_seq_num(number_path, number_start):
-    ''' Create a .dat file to store currentCount
-        or read file if it already Exists.  Fix
-        corrupt integer entry in .dat file if it cannot
-        be recognized as an integer.
-    '''
-    if not os.path.isfile(number_path):
-        # Create numberPath file if it does not exist
-        print('panohub.py: Creating New File %s numberstart= %s' %
-               (number_path, number_start))
-        open(number_path, 'w').close()
-        f = open(number_path, 'w+')
-        f.write(str(number_start))
-        f.close()
-    # Read the numberPath file to get the last sequence number
-    with open(number_path, 'r') as f:
-        write_count = f.read()
-        f.closed
+class SeqManifest(object):
+    '''
+    Sqlite index of received sequences shared with webserver.py and
+    tools. Holds the next seq num plus the frames and stitch results
+    of each sequence. Each closed sequence is saved in one transaction
+    so a crash can not leave the counter and sequence rows out of step.
+    seq nums recycle per TIMELAPSE_SEQ_NUM_RECYCLE_ON so rows are keyed
+    by an id rather than seq_num. Updates come from the receive loop
+    and stitch worker threads.
+    '''
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS counter (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            next_seq_num INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS sequences (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            seq_num INTEGER NOT NULL,
+            trigger_time REAL NOT NULL,
+            closed_time REAL,
+            frame_count INTEGER,
+            cams_in_net INTEGER,
+            partial INTEGER,
+            preview INTEGER,
+            queued INTEGER);
+        CREATE TABLE IF NOT EXISTS frames (
+            sequence_id INTEGER NOT NULL REFERENCES sequences(id),
+            camera TEXT NOT NULL,
+            rendition TEXT NOT NULL,
+            capture_time REAL,
+            recv_time REAL,
+            skew REAL,
+            bytes INTEGER,
+            image_path TEXT);
+        CREATE TABLE IF NOT EXISTS stitches (
+            sequence_id INTEGER NOT NULL REFERENCES sequences(id),
+            pano_path TEXT,
+            preview INTEGER,
+            partial INTEGER,
+            stitch_sec REAL,
+            stitch_ok INTEGER,
+            stitch_time REAL,
+            skip_reason TEXT);
+        CREATE INDEX IF NOT EXISTS sequences_seq_num ON sequences (seq_num);
+        CREATE INDEX IF NOT EXISTS sequences_trigger_time ON sequences (trigger_time);
+        CREATE INDEX IF NOT EXISTS frames_sequence_id ON frames (sequence_id);
+        CREATE INDEX IF NOT EXISTS stitches_sequence_id ON stitches (sequence_id);
+    '''
+
+    def __init__(self, db_path, counter_path, seq_num_start):
+        self.db_path = db_path
+        self.lock = threading.Lock()
         try:
-            number_counter = int(write_count)
-        # Found Corrupt dat file since cannot convert to integer
-        except ValueError:
-            # Try to determine if this is motion or timelapse
-            if number_path.find(IMAGE_PREFIX) > 0:
-                file_path = IMAGE_DIR + "/*" + IMAGE_FORMAT
-                fprefix = IMAGE_DIR + IMAGE_PREFIX
+            self.db = self.open_db()
+        except sqlite3.DatabaseError as err_msg:
+            corrupt_path = '%s.corrupt-%i' % (db_path, time.time())
+            print('panohub.py: WARN Manifest %s Corrupt %s. Moved to %s' %
+                  (db_path, err_msg, corrupt_path))
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_path + suffix):
+                    os.replace(db_path + suffix, corrupt_path + suffix)
+            self.db = self.open_db()
+        if self.db.execute('SELECT next_seq_num FROM counter').fetchone() is None:
+            seq_num = self.recover_seq_num(counter_path, seq_num_start)
+            with self.db:
+                self.db.execute('INSERT INTO counter (id, next_seq_num) VALUES (1, ?)',
+                                (seq_num,))
+            print('panohub.py: Create New Manifest SEQ_NUM=%i %s' % (seq_num, db_path))
 
-            try:
-               # Scan image folder for most recent file
-               # and try to extract most recent number counter
-                newest = max(glob.iglob(filePath), key=os.path.getctime)
-                write_count = newest[len(fprefix) + 1:newest.find(IMAGE_FORMAT)]
-            except:
-                write_count = number_start
+    def open_db(self):
+        ''' Open the manifest and create its tables if needed '''
+        db = sqlite3.connect(self.db_path, check_same_thread=False)
+        try:
+            if db.execute('PRAGMA quick_check').fetchone()[0] != 'ok':
+                raise sqlite3.DatabaseError('quick_check failed')
+            db.execute('PRAGMA journal_mode=WAL')  # webserver can read while hub writes
+            db.execute('PRAGMA synchronous=FULL')  # fsync each commit
+            db.executescript(self.SCHEMA)
+            columns = [row[1] for row in db.execute('PRAGMA table_info(stitches)')]
+            if 'skip_reason' not in columns:
+                db.execute('ALTER TABLE stitches ADD COLUMN skip_reason TEXT')
+        except sqlite3.DatabaseError:
+            db.close()
+            raise
+        return db
 
-            try:
-                number_counter = int(write_count) + 1
-            except ValueError:
-                number_counter = number_start
-            print('panohub.py: Found Invalid Data in %s Resetting Counter to %s' %
-                  (number_path, number_counter))
-        f = open(number_path, 'w+')
-        f.write(str(number_counter))
-        f.close()
-        f = open(number_path, 'r')
-        write_count = f.read()
-        f.close()
-        number_counter = int(write_count)
-    return number_counter
+    def recover_seq_num(self, counter_path, seq_num_start):
+        '''
+        Return the seq num to start a new manifest at. Carries on from
+        the panohub.dat counter file of older versions if it is valid,
+        otherwise from the newest seq num found in the media folders.
+        The counter file is renamed once migrated so it is not reused.
+        '''
+        try:
+            with open(counter_path) as f:
+                seq_num = int(f.read())
+            os.replace(counter_path, counter_path + '.migrated')
+            print('panohub.py: Manifest SEQ_NUM=%i Migrated from %s' % (seq_num, counter_path))
+            return seq_num
+        except (IOError, OSError, ValueError):
+            pass
+        media_files = list_media_files(IMAGE_DIR) + list_media_files(IMAGE_PANO_DIR)
+        media_files.sort()
+        for mtime, size, path in reversed(media_files):
+            seq_num = get_media_seq_num(os.path.basename(path))
+            if seq_num is not None:
+                seq_num = get_next_seq_num(seq_num)
+                print('panohub.py: Manifest SEQ_NUM=%i Recovered from %s' % (seq_num, path))
+                return seq_num
+        return seq_num_start
 
-#---------------------------------------------------------------
-def timelapse_check(timelapse_start):
-    '''
-    Check if timelapse timer has expired
-    '''
-    timelapse_found = False
-    right_now = datetime.datetime.now()
-    time_diff = (right_now - timelapse_start).total_seconds()
-    if time_diff > TIMELAPSE_TIMER:
-        timelapse_found = True
-    return timelapse_found
+    def next_seq_num(self):
+        ''' Return the saved seq num to continue from after a restart '''
+        with self.lock:
+            return self.db.execute('SELECT next_seq_num FROM counter').fetchone()[0]
+
+    def record_sequence(self, seq, next_seq_num, cams_in_net, partial, queued):
+        '''
+        Save a closed sequence with its frames and the next seq num in
+        one transaction. A sequence reopened by late frames already has
+        a manifest_id so its row and frames are replaced.
+        '''
+        values = (seq.seq_num, seq.trigger_time, time.time(), len(seq.frames),
+                  cams_in_net, partial, seq.preview, queued)
+        try:
+            with self.lock, self.db:
+                if seq.manifest_id is None:
+                    cursor = self.db.execute(
+                        'INSERT INTO sequences (seq_num, trigger_time, closed_time, frame_count,'
+                        ' cams_in_net, partial, preview, queued) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        values)
+                    seq.manifest_id = cursor.lastrowid
+                else:
+                    self.db.execute(
+                        'UPDATE sequences SET seq_num=?, trigger_time=?, closed_time=?,'
+                        ' frame_count=?, cams_in_net=?, partial=?, preview=?, queued=?'
+                        ' WHERE id=?', values + (seq.manifest_id,))
+                    self.db.execute('DELETE FROM frames WHERE sequence_id=?',
+                                    (seq.manifest_id,))
+                self.insert_frames(seq)
+                self.db.execute('UPDATE counter SET next_seq_num=? WHERE id=1',
+                                (next_seq_num,))
+        except sqlite3.Error as err_msg:
+            print('panohub.py: WARN Seq %i Could Not Save to Manifest %s' %
+                  (seq.seq_num, err_msg))
+
+    def record_full_frames(self, seq):
+        ''' Save the deferred full resolution frames of a preview sequence '''
+        try:
+            with self.lock, self.db:
+                self.db.execute("DELETE FROM frames WHERE sequence_id=? AND rendition='full'",
+                                (seq.manifest_id,))
+                self.insert_frames(seq, preview_frames=False)
+        except sqlite3.Error as err_msg:
+            print('panohub.py: WARN Seq %i Could Not Save to Manifest %s' %
+                  (seq.seq_num, err_msg))
+
+    def insert_frames(self, seq, preview_frames=True):
+        ''' Insert frame rows of seq. Caller holds the lock and transaction '''
+        frames = []
+        if preview_frames:
+            frames = [(seq.frames, 'preview' if seq.preview else 'full')]
+        frames.append((seq.full_frames, 'full'))
+        self.db.executemany(
+            'INSERT INTO frames (sequence_id, camera, rendition, capture_time,'
+            ' recv_time, skew, bytes, image_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(seq.manifest_id, rpi_name, rendition, info.get('capture_time'),
+              info.get('recv_time'), info.get('skew'), info.get('bytes'),
+              info.get('image_path'))
+             for seq_frames, rendition in frames
+             for rpi_name, info in sorted(seq_frames.items())])
+
+    def record_stitch(self, manifest_id, pano_path, preview, partial, stitch_sec, stitch_ok,
+                      skip_reason=None):
+        ''' Save the outcome of a stitch job or why it was skipped '''
+        if manifest_id is None:
+            return
+        try:
+            with self.lock, self.db:
+                self.db.execute(
+                    'INSERT INTO stitches (sequence_id, pano_path, preview, partial,'
+                    ' stitch_sec, stitch_ok, stitch_time, skip_reason)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (manifest_id, pano_path, preview, partial, stitch_sec, stitch_ok,
+                     time.time(), skip_reason))
+        except sqlite3.Error as err_msg:
+            print('panohub.py: WARN Could Not Save Stitch to Manifest %s' % err_msg)
 
 #---------------------------------------------------------------
 def timestamp_to_string(my_time):
@@ -304,133 +1440,811 @@ def timestamp_to_string(my_time):
 #---------------------------------------------------------------
 def stitch_images(image_seq_num, stitch_cmd):
     '''
-    Run a subprocess to run stitch command
+    Run a subprocess to run stitch command. stitch_cmd is an argument
+    list so paths are passed as-is without a shell.
     '''
+    cmd_line = ' '.join(shlex.quote(arg) for arg in stitch_cmd)
     print('panohub.py: Seq %i Working ......' % image_seq_num)
-    print('panohub.py: Seq %i %s' % (image_seq_num, stitch_cmd))
+    print('panohub.py: Seq %i %s' % (image_seq_num, cmd_line))
     try:
         print('panohub.py:  ------------- Start Stitching -----------------------')
-        proc = subprocess.call(stitch_cmd, shell=True, stdin=None,
+        proc = subprocess.call(stitch_cmd, stdin=None,
                                 stdout=None, stderr=None, close_fds=True)
         print('panohub.py: -------------- End Stitching ------------------------')
-        time.sleep(1)
-    except IOError:
-        print('panohub.py: IOError subprocess %s' % stitch_cmd)
+    except (IOError, OSError) as err_msg:
+        print('panohub.py: IOError subprocess %s %s' % (cmd_line, err_msg))
 
 #---------------------------------------------------------------
-def do_pano_hub():
+def get_cam_order(rpi_name):
     '''
-    Read images sent from pano-send.py via ZMQ and reply with
-    the next timelapse timestamp. Once all images are received,ne
-    attempt to stitch them into a panoramic image.
-    Note images need to overlap properly.
-    '''
-
-    image_hub = imagezmq.ImageHub()  # Initialize image hub instance
-    CAMS_IN_NET = len(CAM_HOST_NAMES)
-    image_seq_num = get_saved_seq_num(TIMELAPSE_SEQ_COUNTER_PATH,
-                                      TIMELAPSE_SEQ_NUM_START)
-    stitch_filename = IMAGE_PREFIX + str(image_seq_num) + '.jpg'
-    stitch_path = os.path.join(IMAGE_PANO_DIR, stitch_filename)
-    stitch_cmd = STITCH_PROGRAM + ' ' + stitch_path
-    cam_recv_cnt = 0
-    timelapse_counter = TIMELAPSE_TIMER
-    timelapse_start = datetime.datetime.now()
-    timelapse_time = time.time() + TIMELAPSE_TIMER
-    next_timelapse_message = timestamp_to_string(timelapse_time)
-    first_timelapse = True
-    print('panohub.py: Time Now is %s' % datetime.datetime.now())
-    print('panohub.py: Next timelapse is at %s in %i sec' %
-          (next_timelapse_message, TIMELAPSE_TIMER))
-    print('panohub.py: Seq %i Listening for panosend Images ...' % image_seq_num)
-    while True:  # process sent images until Ctrl-C pressed
-        pano_send_recv = []  # Blank list to keep track sending nodes
-        take_timelapse = timelapse_check(timelapse_start)
-        if take_timelapse:
-            timelapse_start = datetime.datetime.now()
-            timelapse_time = time.time() + TIMELAPSE_TIMER
-            next_timelapse_message = timestamp_to_string(timelapse_time)
-            print('panohub.py: Seq %i Next timelapse is at %s' %
-                  (image_seq_num, next_timelapse_message))
-            first_timelapse = False
-
-        if (not first_timelapse) and take_timelapse:
-            # Receive images from the specified camera nodes
-            while cam_recv_cnt < CAMS_IN_NET:
-                rpi_name, jpg_buffer = image_hub.recv_jpg()
-                if rpi_name in pano_send_recv:
-                    image_hub.send_reply(next_timelapse_message.encode('utf-8'))
-                else:
-                    pano_send_recv.append(rpi_name)
-                    cam_recv_cnt += 1
-                    image_filename = (IMAGE_PREFIX + rpi_name + '-' +
-                                      str(image_seq_num) + IMAGE_FORMAT)
-                    image_path = os.path.join(IMAGE_DIR, image_filename)
-                    print('panohub.py: Seq %i Image %i/%i Processing %s' %
-                          (image_seq_num, cam_recv_cnt, CAMS_IN_NET, image_path))
-
-                    #decode and save image file from a camera node
-                    image = cv2.imdecode(np.frombuffer(jpg_buffer, dtype='uint8'), -1)
-                    cv2.imwrite(image_path, image)
-                    # send message back to sender confirming receipt of image
-                    image_hub.send_reply(next_timelapse_message.encode('utf-8'))
-                    # append next image path to stitch command
-                    stitch_cmd += ' ' + image_path
-
-        # Does number of images received equal number of sender hosts
-        if cam_recv_cnt == CAMS_IN_NET:
-            stitch_images(image_seq_num, stitch_cmd)
-            if os.path.isfile(stitch_path):
-                print('panohub.py: Seq %i Saved Pano Image to %s' % (image_seq_num, stitch_path))
-            else:
-                print('panohub.py: WARN - Problem with stitching. Try realigning camera overlap.')
+    Return the left to right position of a sender per CAM_HOST_NAMES.
+    Senders report their hostname without the .local zeroconf suffix.
+    '''
+    cam_names = [host_name.split('.')[0] for host_name in CAM_HOST_NAMES]
+    if rpi_name in cam_names:
+        return cam_names.index(rpi_name)
+    return len(cam_names)
+
+#---------------------------------------------------------------
+def stitch_opencv(image_seq_num, cam_names, seq_frames, stitch_path,
+                  partial=False, preview=False):
+    '''
+    Stitch images in-process with the panostitch engine
+    using the saved camera calibration. Preview frames have
+    their own calibration since their frame size differs.
+    Frames are decoded straight from their received buffers.
+    '''
+    print('panohub.py: Seq %i Working ......' % image_seq_num)
+    start_time = time.monotonic()
+    images = [read_frame(image_path, jpg_buffer)
+              for rpi_name, image_path, jpg_buffer in seq_frames]
+    HUB_METRICS.observe('panohub_decode_seconds', time.monotonic() - start_time)
+    if any(image is None for image in images):
+        print('panohub.py: ERROR Seq %i Could Not Read All Images' % image_seq_num)
+        return
+    if preview:
+        STITCH_PREVIEW_ENGINE_INSTANCE.stitch(cam_names, images, stitch_path, partial)
+    else:
+        STITCH_ENGINE_INSTANCE.stitch(cam_names, images, stitch_path, partial)
 
-            # create next stitch_path and stitch_cmd initial command string
-            image_seq_num += 1
-            if TIMELAPSE_SEQ_NUM_MAX == 0:
+#---------------------------------------------------------------
+def stitch_openpano(image_seq_num, seq_frames, stitch_path):
+    '''
+    Run STITCH_PROGRAM on the sequence frames. Frames held in memory
+    are staged as files in STITCH_STAGING_DIR, normally on tmpfs, so
+    they are not written to and read back from the SD card.
+    '''
+    image_paths = []
+    staged_paths = []
+    try:
+        for rpi_name, image_path, jpg_buffer in seq_frames:
+            if jpg_buffer is None:
+                image_paths.append(image_path)
+                continue
+            staged_path = os.path.join(STITCH_STAGING_DIR, os.path.basename(image_path))
+            with open(staged_path, 'wb') as staged_file:
+                staged_file.write(jpg_buffer)
+            staged_paths.append(staged_path)
+            image_paths.append(staged_path)
+        stitch_cmd = shlex.split(STITCH_PROGRAM) + [stitch_path] + image_paths
+        stitch_images(image_seq_num, stitch_cmd)
+    finally:
+        for staged_path in staged_paths:
+            try:
+                os.remove(staged_path)
+            except OSError:
                 pass
-            elif (image_seq_num > (TIMELAPSE_SEQ_NUM_START + TIMELAPSE_SEQ_NUM_MAX)
-                and TIMELAPSE_SEQ_NUM_RECYCLE_ON):
-                image_seq_num = TIMELAPSE_SEQ_NUM_START
-                print('panohub.py: Recycle Enabled. Restart SEQ at %i' %
-                      TIMELAPSE_SEQ_NUM_START)
-            else:
-                if image_seq_num > (TIMELAPSE_SEQ_NUM_START + TIMELAPSE_SEQ_NUM_MAX):
-                    print('panohub.py: Exit Program: SEQ_MAX=%i and RECYCLE_ON=%s' %
-                          (TIMELAPSE_SEQ_NUM_MAX, TIMELAPSE_SEQ_NUM_RECYCLE_ON))
-                    sys.exit(1)
-            write_seq_num(image_seq_num, TIMELAPSE_SEQ_COUNTER_PATH)
-            stitch_filename = IMAGE_PREFIX + str(image_seq_num) + '.jpg'
-            stitch_path = os.path.join(IMAGE_PANO_DIR, stitch_filename)
-            stitch_cmd = STITCH_PROGRAM + ' ' + stitch_path
-            cam_recv_cnt = 0
-            print('panohub.py: Time Now is %s' % datetime.datetime.now())
-            print('panohub.py: Next timelapse is at %s in %i sec' %
-                  (next_timelapse_message, TIMELAPSE_TIMER))
-            print('panohub.py: Seq %i Listening for panosend Images ...' % image_seq_num)
+
+#---------------------------------------------------------------
+def stitch_job(image_seq_num, seq_frames, stitch_path, partial=False, preview=False,
+               manifest_id=None):
+    '''
+    Stitch queue worker job. Stitch a received sequence of
+    rpi_name, image_path, jpg_buffer items ordered left to right and
+    report whether a pano image was produced. jpg_buffer is None once
+    the frame is only on disk. Frames are saved per IMAGE_KEEP_RAW
+    if the stitch fails or is skipped. partial is True
+    when some cameras did not send a frame for the sequence.
+    preview is True for low resolution preview frames.
+    The outcome is saved to the manifest row manifest_id.
+    '''
+    start_time = time.time()
+    HUB_STATUS.update(stitching_seq=image_seq_num)
+    cam_names = [rpi_name for rpi_name, image_path, jpg_buffer in seq_frames]
+    rendition = 'preview' if preview else 'full'
+    if any(jpg_buffer is None for rpi_name, image_path, jpg_buffer in seq_frames):
+        FRAME_WRITER.flush()  # frames read back from disk may still be queued
+    skip_reason = None
+    if STITCH_CHECK is not None:
+        skip_reason = STITCH_CHECK.check(cam_names, seq_frames, partial)
+    if skip_reason is not None:
+        print('panohub.py: WARN Seq %i Stitch Skipped. %s' % (image_seq_num, skip_reason))
+        seq_frames = keep_raw_frames(seq_frames)
+        if STITCH_CHECK_FAIL == 'defer':
+            STITCH_CHECK.defer((image_seq_num, seq_frames, stitch_path, partial, preview,
+                                manifest_id))
+        SEQ_MANIFEST.record_stitch(manifest_id, stitch_path, preview, partial,
+                                   time.time() - start_time, False, skip_reason)
+        HUB_METRICS.inc('panohub_stitches_total', result='skipped', rendition=rendition)
+        HUB_STATUS.update(stitching_seq=None,
+                          last_stitch_seq=image_seq_num,
+                          last_stitch_ok=False,
+                          last_stitch_skipped=skip_reason,
+                          last_stitch_time=time.time())
+        return
+    if os.path.isfile(stitch_path):
+        # An older pano eg from a reopened or recycled seq num is not this stitch
+        try:
+            os.remove(stitch_path)
+        except OSError as err_msg:
+            print('panohub.py: WARN Seq %i Could Not Remove Old %s %s' %
+                  (image_seq_num, stitch_path, err_msg))
+    if STITCH_ENGINE == 'opencv':
+        stitch_opencv(image_seq_num, cam_names, seq_frames, stitch_path, partial, preview)
+    else:
+        stitch_openpano(image_seq_num, seq_frames, stitch_path)
+    # mtime check in case an old pano could not be removed. FAT has 2 sec timestamps
+    stitch_ok = (os.path.isfile(stitch_path) and
+                 os.path.getmtime(stitch_path) >= start_time - 2)
+    stitch_sec = time.time() - start_time
+    if stitch_ok:
+        print('panohub.py: Seq %i Saved %s Image to %s in %.1f sec' %
+              (image_seq_num, 'Preview Pano' if preview else 'Pano',
+               stitch_path, stitch_sec))
+    else:
+        print('panohub.py: WARN - Seq %i Problem with stitching. Try realigning camera overlap.' %
+              image_seq_num)
+        if STITCH_CHECK is not None and not partial:
+            STITCH_CHECK.stitch_failed(cam_names)
+        keep_raw_frames(seq_frames)
+    if stitch_ok and VIDEO_BUILDER is not None and preview == VIDEO_FROM_PREVIEWS:
+        VIDEO_BUILDER.add(stitch_path)
+    if stitch_ok:
+        RETENTION.after_stitch([image_path for rpi_name, image_path, jpg_buffer in seq_frames
+                                if IMAGE_KEEP_RAW == 'all' or jpg_buffer is None], partial)
+        if STITCH_CHECK is not None:
+            STITCH_CHECK.queue_deferred()
+    SEQ_MANIFEST.record_stitch(manifest_id, stitch_path, preview, partial,
+                               stitch_sec, stitch_ok)
+    HUB_METRICS.observe('panohub_stitch_seconds', stitch_sec, rendition=rendition)
+    HUB_METRICS.inc('panohub_stitches_total', result='ok' if stitch_ok else 'failed',
+                    rendition=rendition)
+    HUB_STATUS.update(stitching_seq=None,
+                      last_stitch_seq=image_seq_num,
+                      last_stitch_sec=round(stitch_sec, 3),
+                      last_stitch_ok=stitch_ok,
+                      last_stitch_preview=preview,
+                      last_stitch_skipped=None,
+                      last_stitch_time=time.time())
+
+#---------------------------------------------------------------
+def get_next_seq_num(image_seq_num):
+    '''
+    Return the sequence number following image_seq_num per the
+    TIMELAPSE_SEQ_NUM_MAX and TIMELAPSE_SEQ_NUM_RECYCLE_ON settings.
+    '''
+    image_seq_num += 1
+    if TIMELAPSE_SEQ_NUM_MAX == 0:
+        pass
+    elif (image_seq_num > (TIMELAPSE_SEQ_NUM_START + TIMELAPSE_SEQ_NUM_MAX)
+          and TIMELAPSE_SEQ_NUM_RECYCLE_ON):
+        image_seq_num = TIMELAPSE_SEQ_NUM_START
+        print('panohub.py: Recycle Enabled. Restart SEQ at %i' %
+              TIMELAPSE_SEQ_NUM_START)
+    else:
+        if image_seq_num > (TIMELAPSE_SEQ_NUM_START + TIMELAPSE_SEQ_NUM_MAX):
+            print('panohub.py: Exit Program: SEQ_MAX=%i and RECYCLE_ON=%s' %
+                  (TIMELAPSE_SEQ_NUM_MAX, TIMELAPSE_SEQ_NUM_RECYCLE_ON))
+            sys.exit(1)
+    return image_seq_num
+
+#---------------------------------------------------------------
+def parse_sender_msg(msg, recv_time):
+    '''
+    Return a dict of frame details from an imagezmq sender message.
+    Older panosend versions only send their host name as a string.
+    Newer versions send a dict with name and capture_time.
+    '''
+    if isinstance(msg, dict):
+        info = dict(msg)
+    else:
+        info = {'name': str(msg)}
+    info['recv_time'] = recv_time
+    return info
+
+#---------------------------------------------------------------
+class FrameReceiver(object):
+    '''
+    Receive frames from all panosend senders at once on a zmq ROUTER
+    socket. panosend uses an imagezmq ImageSender REQ socket so each
+    message arrives as identity, empty delimiter, json metadata and
+    jpeg frames. Replies are routed back to the sender by identity so
+    frames from other senders can be handled while one is outstanding.
+    '''
+    def __init__(self, open_port=ZMQ_HUB_OPEN_PORT):
+        self.context = zmq.Context.instance()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.bind(open_port)
+        self.poller = zmq.Poller()
+        self.poller.register(self.socket, zmq.POLLIN)
+
+    def recv(self, timeout_sec):
+        '''
+        Wait up to timeout_sec for frames then return a list of all
+        waiting (identity, info, jpg_buffer) messages.
+        '''
+        messages = []
+        if not self.poller.poll(max(0, int(timeout_sec * 1000))):
+            return messages
+        while True:
+            try:
+                parts = self.socket.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                break
+            identity = parts[0].bytes
+            try:
+                metadata = json.loads(parts[2].bytes.decode('utf-8'))
+                info = parse_sender_msg(metadata['msg'], time.time())
+                jpg_buffer = parts[3].buffer
+            except (IndexError, ValueError, KeyError) as err_msg:
+                print('panohub.py: WARN Ignoring Invalid Sender Message %s' % err_msg)
+                info, jpg_buffer = None, None
+            messages.append((identity, info, jpg_buffer))
+        return messages
+
+    def reply(self, identity, reply_msg):
+        ''' Send reply_msg bytes to the sender with identity '''
+        self.socket.send_multipart([identity, b'', reply_msg])
+
+#---------------------------------------------------------------
+class Sequence(object):
+    '''
+    Frames received from panosend cameras for one timelapse trigger.
+    trigger_time is wall clock time and close_deadline is on the
+    monotonic clock. seq_num is assigned when the first frame arrives.
+    preview is True when the frames are panosend preview renditions.
+    Their full resolution frames are collected in full_frames.
+    '''
+    def __init__(self, trigger_time, close_deadline):
+        self.trigger_time = trigger_time
+        self.close_deadline = close_deadline
+        self.seq_num = None
+        self.preview = False
+        self.frames = {}  # rpi_name: frame info dict
+        self.full_frames = {}  # rpi_name: deferred full resolution frame info dict
+        self.full_queued = False
+        self.manifest_id = None  # SEQ_MANIFEST sequences row once closed
+
+    def ordered_frames(self, frames=None):
+        ''' Return rpi_name, image_path, jpg_buffer items ordered left to right '''
+        if frames is None:
+            frames = self.frames
+        return sorted([(rpi_name, frame['image_path'], frame['jpg_buffer'])
+                       for rpi_name, frame in frames.items()],
+                      key=lambda item: get_cam_order(item[0]))
+
+    def release_buffers(self, frames=None):
+        ''' Drop received jpeg buffers once they are queued or saved '''
+        if frames is None:
+            frames = self.frames
+        for frame in frames.values():
+            frame['jpg_buffer'] = None
+
+    def frames_on_disk(self):
+        ''' Return True if every frame can be read back from its image_path '''
+        return all(frame['jpg_buffer'] is not None or IMAGE_KEEP_RAW == 'all' or
+                   os.path.isfile(frame['image_path']) for frame in self.frames.values())
+
+#---------------------------------------------------------------
+class ReceiveEngine(object):
+    '''
+    Receive frames from all senders concurrently, group them into
+    sequences by capture time and close each sequence when all cameras
+    have sent a frame or RECV_SEQ_TIMEOUT seconds after its trigger.
+    A sequence missing cameras is stitched as a partial sequence if it
+    has at least RECV_SEQ_MIN_FRAMES frames, otherwise it is skipped, so
+    one slow or dead sender can not stall the timelapse.
+    Preview sequences are stitched first. Their full resolution frames
+    are requested in replies per PREVIEW_FULLRES_MODE and stitched as
+    background jobs once all have arrived.
+    Received jpeg buffers are kept with their frame info and handed to
+    the stitch queue in memory. They are saved to IMAGE_DIR in the
+    background when IMAGE_KEEP_RAW is all, otherwise only by the
+    stitch job if the stitch fails. Closed sequences only keep frame
+    info, so a late frame reopens one only if its frames were saved.
+    '''
+    def __init__(self, stitch_queue, image_seq_num):
+        self.receiver = FrameReceiver(ZMQ_HUB_OPEN_PORT)
+        self.scheduler = TimelapseScheduler(TIMELAPSE_TIMER)
+        self.stitch_queue = stitch_queue
+        self.image_seq_num = image_seq_num
+        self.cams_in_net = len(CAM_HOST_NAMES)
+        self.open_seqs = []
+        self.early_deadline = None  # scheduler deadline whose sequence a frame opened early
+        self.recent_seqs = collections.OrderedDict()  # trigger_time: closed Sequence
+        self.full_wanted = {}  # trigger_time: rpi_names to request full resolution frames from
+        if PREVIEW_FULLRES_MODE not in PREVIEW_FULLRES_MODES:
+            print('panohub.py: WARN PREVIEW_FULLRES_MODE=%s Not Valid. Using always' %
+                  PREVIEW_FULLRES_MODE)
+        self.fullres_on_demand = PREVIEW_FULLRES_MODE == 'on_demand'
+
+    def next_reply(self, info=None):
+        '''
+        Return the reply message with the next trigger time. Senders
+        using protocol 2 get a json reply with a sub-second trigger
+        timestamp and the hub clock time used for clock offset estimates.
+        Older senders get the trigger time as a string in whole seconds.
+        full lists triggers of preview frames the sender should now
+        send at full resolution.
+        '''
+        if info is not None and info.get('proto', 1) >= 2:
+            rpi_name = info.get('name')
+            return json.dumps({'trigger': self.scheduler.next_wall_time(),
+                               'interval': TIMELAPSE_TIMER,
+                               'hub_time': time.time(),
+                               'full': sorted(trigger_time for trigger_time, rpi_names
+                                              in self.full_wanted.items()
+                                              if rpi_name in rpi_names)}).encode('utf-8')
+        return timestamp_to_string(self.scheduler.next_wall_time()).encode('utf-8')
+
+    def trigger(self):
+        '''
+        Fire the timelapse trigger and open a sequence for it unless
+        a frame taken for this trigger already opened it early.
+        '''
+        trigger_time = self.scheduler.next_wall_time()
+        if self.early_deadline != self.scheduler.next_deadline:
+            self.open_seqs.append(Sequence(trigger_time, time.monotonic() + RECV_SEQ_TIMEOUT))
+        self.early_deadline = None
+        self.scheduler.fire()
+        print('panohub.py: Trigger at %s  Next timelapse is at %s  Schedule %s' %
+              (timestamp_to_string(trigger_time),
+               timestamp_to_string(self.scheduler.next_wall_time()),
+               self.scheduler.status()))
+        HUB_STATUS.update(image_seq_num=self.image_seq_num,
+                          open_seqs=len(self.open_seqs),
+                          schedule=self.scheduler.status())
+        HUB_METRICS.set('panohub_triggers_total', self.scheduler.fired)
+        HUB_METRICS.set('panohub_missed_triggers_total', self.scheduler.missed)
+        HUB_METRICS.set('panohub_open_sequences', len(self.open_seqs))
+        self.check_fullres_requests()
+
+    def check_fullres_requests(self):
+        '''
+        Request full resolution frames for preview sequences asked for
+        from the webserver. Each request is a file in PREVIEW_REQUEST_DIR
+        named by seq num. Also forget wanted frames of sequences no
+        longer kept in recent_seqs.
+        '''
+        known_seqs = self.open_seqs + list(self.recent_seqs.values())
+        known_triggers = set(seq.trigger_time for seq in known_seqs)
+        for trigger_time in list(self.full_wanted):
+            if trigger_time not in known_triggers:
+                del self.full_wanted[trigger_time]
+        if not os.path.isdir(PREVIEW_REQUEST_DIR):
+            return
+        for request_name in os.listdir(PREVIEW_REQUEST_DIR):
+            try:
+                os.remove(os.path.join(PREVIEW_REQUEST_DIR, request_name))
+            except OSError:
+                continue
+            seqs = [seq for seq in known_seqs
+                    if seq.preview and str(seq.seq_num) == request_name]
+            if not seqs:
+                print('panohub.py: WARN Full Resolution Request for Seq %s. Not a Recent Preview' %
+                      request_name)
+                continue
+            rpi_names = set(seqs[0].frames) - set(seqs[0].full_frames)
+            if rpi_names:
+                self.full_wanted[seqs[0].trigger_time] = rpi_names
+                print('panohub.py: Seq %s Full Resolution Requested from %s' %
+                      (request_name, ', '.join(sorted(rpi_names))))
+
+    def find_sequence(self, info):
+        '''
+        Return the sequence this frame belongs to or None.
+        Protocol 2 frames carry the trigger they were taken for. Older
+        frames carry a capture_time. Either goes to the open sequence
+        with the nearest trigger time within RECV_SEQ_TOLERANCE. A frame
+        taken for the upcoming trigger eg from a sender with its clock a
+        little ahead opens that sequence early. The trigger still fires
+        on schedule. Frames from older
+        senders without capture_time go to the newest open sequence.
+        Late frames reopen their recently closed sequence. Frames spooled
+        by panosend while the hub was unreachable start a catch-up sequence.
+        '''
+        if info.get('proto', 1) >= 2:
+            capture_time = info.get('trigger')
+            if capture_time is None:
+                return None  # first frame sent before a trigger was known
+        else:
+            capture_time = info.get('capture_time')
+            if capture_time is None:
+                return self.open_seqs[-1] if self.open_seqs else None
+        if (self.early_deadline != self.scheduler.next_deadline and
+                abs(capture_time - self.scheduler.next_wall_time()) <= RECV_SEQ_TOLERANCE):
+            self.early_deadline = self.scheduler.next_deadline
+            self.open_seqs.append(Sequence(self.scheduler.next_wall_time(),
+                                           self.scheduler.next_deadline + RECV_SEQ_TIMEOUT))
+        seq = self.nearest_sequence(self.open_seqs, capture_time)
+        if seq is not None:
+            return seq
+        seq = self.nearest_sequence(self.recent_seqs.values(), capture_time)
+        if seq is not None:
+            if info['name'] in seq.frames:
+                return seq  # duplicate frame. No need to reopen
+            if not seq.frames_on_disk():
+                print('panohub.py: WARN Seq %s Late Frame from %s Not Stitched. '
+                      'Frames Not Saved per IMAGE_KEEP_RAW=%s' %
+                      (seq.seq_num, info['name'], IMAGE_KEEP_RAW))
+                return None
+            del self.recent_seqs[seq.trigger_time]
+            print('panohub.py: Seq %s Reopened for Late Frame from %s' %
+                  (seq.seq_num, info['name']))
+        elif info.get('spooled') and capture_time < time.time():
+            seq = Sequence(capture_time, 0)
+            print('panohub.py: Catch-up Sequence for Trigger at %s from %s' %
+                  (timestamp_to_string(capture_time), info['name']))
+        else:
+            return None
+        seq.close_deadline = time.monotonic() + RECV_CATCHUP_TIMEOUT
+        self.open_seqs.append(seq)
+        return seq
+
+    def nearest_sequence(self, sequences, capture_time):
+        ''' Return the sequence with trigger nearest capture_time within RECV_SEQ_TOLERANCE '''
+        best_seq = None
+        for seq in sequences:
+            diff = abs(capture_time - seq.trigger_time)
+            if diff <= RECV_SEQ_TOLERANCE and (best_seq is None or
+                                               diff < abs(capture_time - best_seq.trigger_time)):
+                best_seq = seq
+        return best_seq
+
+    def add_frame(self, identity, info, jpg_buffer):
+        ''' Save a received frame to its sequence and reply to the sender '''
+        if info is None or info.get('type') == 'ping':
+            # clock sync ping from panosend. Reply right away with hub time
+            self.receiver.reply(identity, self.next_reply(info))
+            HUB_METRICS.inc('panohub_pings_total')
+            return
+        info['bytes'] = len(jpg_buffer)
+        HUB_METRICS.add_frame(info)
+        if info.get('deferred'):
+            # full resolution frame following its preview
+            self.add_full_frame(info, jpg_buffer)
+            self.receiver.reply(identity, self.next_reply(info))
+            return
+        rpi_name = info['name']
+        seq = self.find_sequence(info)
+        if seq is None:
+            # Not part of a sequence eg first frame after panosend starts
+            print('panohub.py: %s Sync Only. Frame Not Part of a Sequence' % rpi_name)
+            HUB_METRICS.inc('panohub_sync_only_frames_total', camera=rpi_name)
+        elif rpi_name in seq.frames:
+            print('panohub.py: %s Duplicate Frame for Seq %s' % (rpi_name, seq.seq_num))
+            HUB_METRICS.inc('panohub_duplicate_frames_total', camera=rpi_name)
+        else:
+            if seq.seq_num is None:
+                seq.seq_num = self.image_seq_num
+                seq.preview = info.get('rendition') == 'preview'
+                self.image_seq_num = get_next_seq_num(self.image_seq_num)
+            image_path = self.frame_path(rpi_name, seq, seq.preview)
+            info['image_path'] = image_path
+            info['jpg_buffer'] = jpg_buffer
+            seq.frames[rpi_name] = info
+            print('panohub.py: Seq %i Image %i/%i Processing %s' %
+                  (seq.seq_num, len(seq.frames), self.cams_in_net, image_path))
+            self.save_frame(image_path, jpg_buffer)
+            if seq.preview and not self.fullres_on_demand:
+                self.full_wanted.setdefault(seq.trigger_time, set()).add(rpi_name)
+        # send message back to sender confirming receipt of image
+        self.receiver.reply(identity, self.next_reply(info))
+
+    def add_full_frame(self, info, jpg_buffer):
+        ''' Save a deferred full resolution frame to its preview sequence '''
+        rpi_name = info['name']
+        seq = None
+        if info.get('trigger') is not None:
+            seq = self.nearest_sequence(self.open_seqs + list(self.recent_seqs.values()),
+                                        info['trigger'])
+        if seq is None or not seq.preview or rpi_name not in seq.frames:
+            print('panohub.py: %s Full Resolution Frame Not Part of a Preview Sequence' %
+                  rpi_name)
+            return
+        rpi_names = self.full_wanted.get(seq.trigger_time)
+        if rpi_names is not None:
+            rpi_names.discard(rpi_name)
+            if not rpi_names:
+                del self.full_wanted[seq.trigger_time]
+        if rpi_name in seq.full_frames:
+            print('panohub.py: %s Duplicate Full Resolution Frame for Seq %s' %
+                  (rpi_name, seq.seq_num))
+            HUB_METRICS.inc('panohub_duplicate_frames_total', camera=rpi_name)
+            return
+        image_path = self.frame_path(rpi_name, seq)
+        info['image_path'] = image_path
+        info['jpg_buffer'] = jpg_buffer
+        seq.full_frames[rpi_name] = info
+        print('panohub.py: Seq %i Full Resolution Image %i/%i Processing %s' %
+              (seq.seq_num, len(seq.full_frames), len(seq.frames), image_path))
+        self.save_frame(image_path, jpg_buffer)
+        self.queue_full_stitch(seq)
+
+    def frame_path(self, rpi_name, seq, preview=False):
+        ''' Return the image path of a sequence frame from rpi_name '''
+        image_filename = (IMAGE_PREFIX + rpi_name + '-' + str(seq.seq_num) +
+                          (PREVIEW_SUFFIX if preview else '') + IMAGE_FORMAT)
+        return os.path.join(get_media_dir(IMAGE_DIR, seq.seq_num, seq.trigger_time),
+                            image_filename)
+
+    def pano_path(self, seq, preview=False):
+        ''' Return the stitched pano image path of a sequence '''
+        stitch_filename = (IMAGE_PREFIX + str(seq.seq_num) +
+                           (PREVIEW_SUFFIX if preview else '') + '.jpg')
+        return os.path.join(get_media_dir(IMAGE_PANO_DIR, seq.seq_num, seq.trigger_time),
+                            stitch_filename)
+
+    def save_frame(self, image_path, jpg_buffer):
+        ''' Save a received frame now if IMAGE_KEEP_RAW is all '''
+        if IMAGE_KEEP_RAW == 'all':
+            save_raw_frame(image_path, jpg_buffer)
+
+    def queue_full_stitch(self, seq):
+        '''
+        Queue a background full resolution stitch of a closed preview
+        sequence once all of its full resolution frames have arrived.
+        '''
+        if (seq.full_queued or seq in self.open_seqs or not seq.full_frames or
+                set(seq.full_frames) < set(seq.frames)):
+            return
+        seq.full_queued = True
+        SEQ_MANIFEST.record_full_frames(seq)
+        stitch_path = self.pano_path(seq)
+        self.stitch_queue.put_background(seq.seq_num, seq.ordered_frames(seq.full_frames),
+                                         stitch_path, len(seq.full_frames) < self.cams_in_net,
+                                         False, seq.manifest_id)
+        seq.release_buffers(seq.full_frames)
+        print('panohub.py: Seq %i Full Resolution Queued for Stitching. Queue Depth %i' %
+              (seq.seq_num, self.stitch_queue.depth()))
+
+    def close_sequence(self, seq):
+        '''
+        Queue a closed sequence for stitching if it has enough frames.
+        Recent closed sequences are kept so late frames can reopen them.
+        '''
+        self.open_seqs.remove(seq)
+        frame_cnt = len(seq.frames)
+        if frame_cnt:
+            self.recent_seqs[seq.trigger_time] = seq
+            while len(self.recent_seqs) > RECV_RECENT_SEQS:
+                self.recent_seqs.popitem(last=False)
+        skews = [(rpi_name, frame['skew']) for rpi_name, frame in sorted(seq.frames.items())
+                 if frame.get('skew') is not None]
+        if skews:
+            # measured by each sender as capture time minus trigger time
+            spread = max(skew for rpi_name, skew in skews) - min(skew for rpi_name, skew in skews)
+            print('panohub.py: Seq %i Trigger Skew %s  Spread %.1f ms' %
+                  (seq.seq_num, '  '.join('%s %+.1f ms' % (rpi_name, skew * 1000)
+                                          for rpi_name, skew in skews), spread * 1000))
+        HUB_STATUS.update(image_seq_num=self.image_seq_num,
+                          open_seqs=len(self.open_seqs),
+                          last_seq_num=seq.seq_num,
+                          last_seq_frames=frame_cnt,
+                          cams_in_net=self.cams_in_net)
+        HUB_METRICS.set('panohub_open_sequences', len(self.open_seqs))
+        if frame_cnt == 0:
+            print('panohub.py: WARN No Frames Received for Trigger at %s' %
+                  timestamp_to_string(seq.trigger_time))
+            HUB_METRICS.inc('panohub_sequences_total', result='empty')
+            return
+        partial = frame_cnt < self.cams_in_net
+        queued = frame_cnt >= RECV_SEQ_MIN_FRAMES or not partial
+        HUB_METRICS.inc('panohub_sequences_total',
+                        result='degraded' if not queued else 'partial' if partial else 'complete')
+        HUB_METRICS.observe('panohub_sequence_seconds',
+                            max(frame['recv_time'] for frame in seq.frames.values()) -
+                            seq.trigger_time)
+        SEQ_MANIFEST.record_sequence(seq, self.image_seq_num, self.cams_in_net, partial, queued)
+        if partial:
+            missing = [host_name for host_name in CAM_HOST_NAMES
+                       if host_name.split('.')[0] not in seq.frames]
+            print('panohub.py: WARN Seq %i Partial %i/%i Frames. Missing %s' %
+                  (seq.seq_num, frame_cnt, self.cams_in_net, ', '.join(missing)))
+            if not queued:
+                print('panohub.py: WARN Seq %i Degraded. Not Stitched. RECV_SEQ_MIN_FRAMES=%i' %
+                      (seq.seq_num, RECV_SEQ_MIN_FRAMES))
+                seq.release_buffers()
+                return
+        stitch_path = self.pano_path(seq, seq.preview)
+        self.stitch_queue.put(seq.seq_num, seq.ordered_frames(), stitch_path, partial,
+                              seq.preview, seq.manifest_id)
+        seq.release_buffers()  # the stitch job holds them now
+        print('panohub.py: Seq %i %s for Stitching. Queue Depth %i' %
+              (seq.seq_num, 'Preview Queued' if seq.preview else 'Queued',
+               self.stitch_queue.depth()))
+        if seq.preview:
+            self.queue_full_stitch(seq)
+
+    def run(self):
+        ''' Receive and group frames until Ctrl-C pressed '''
+        print('panohub.py: Time Now is %s' % datetime.datetime.now())
+        print('panohub.py: Next timelapse is at %s in %i sec' %
+              (timestamp_to_string(self.scheduler.next_wall_time()), TIMELAPSE_TIMER))
+        print('panohub.py: Seq %i Listening for panosend Images on %s ...' %
+              (self.image_seq_num, ZMQ_HUB_OPEN_PORT))
+        while True:
+            # Sleep until next trigger, next sequence deadline or next frame
+            timeout_sec = self.scheduler.time_to_next()
+            now = time.monotonic()
+            for seq in self.open_seqs:
+                timeout_sec = min(timeout_sec, max(0.0, seq.close_deadline - now))
+            for identity, info, jpg_buffer in self.receiver.recv(timeout_sec):
+                self.add_frame(identity, info, jpg_buffer)
+            if self.scheduler.time_to_next() <= 0:
+                self.trigger()
+            now = time.monotonic()
+            for seq in list(self.open_seqs):
+                if len(seq.frames) >= self.cams_in_net or now >= seq.close_deadline:
+                    self.close_sequence(seq)
+
+#---------------------------------------------------------------
+def do_pano_hub():
+    '''
+    Read images sent from pano-send.py via ZMQ and reply with
+    the next timelapse timestamp. Once all images for a sequence are
+    received, or the sequence times out, queue them to be stitched
+    into a panoramic image. Note images need to overlap properly.
+    '''
+    HUB_STATUS.stitch_queue = STITCH_QUEUE
+    HUB_METRICS.stitch_queue = STITCH_QUEUE
+    if STITCH_CHECK is not None:
+        STITCH_CHECK.stitch_queue = STITCH_QUEUE
+    image_seq_num = SEQ_MANIFEST.next_seq_num()
+    HUB_STATUS.update(image_seq_num=image_seq_num, cams_in_net=len(CAM_HOST_NAMES))
+    receive_engine = ReceiveEngine(STITCH_QUEUE, image_seq_num)
+    receive_engine.run()
 
 # Main Program
-print('-----------------------------------------------------------')
-print('%s ver %s written by Claude Pageau' % (PROG_NAME, PROG_VER))
-print('-----------------------------------------------------------')
-print('%s: Version %s Initializing ...' % (PROG_NAME, PROG_VER))
-read_yaml_vars(YAML_FILEPATH, YAML_PANOHUB_SECTION_NAME)
-print('%s: %s modified by Claude Pageau per https://github.com/pageauc/OpenPano' %
-      (PROG_NAME, STITCH_PROGRAM))
-
-notify_senders(CAM_HOST_NAMES, True)  # Send yaml file to panowatch.py
-                                      # and restart panosend.py on remote hosts
-# Create required folder paths if req'd
-if not os.path.isdir(IMAGE_PANO_DIR):
-    os.makedirs(IMAGE_PANO_DIR)
-if not os.path.isdir(IMAGE_DIR):
-    os.makedirs(IMAGE_DIR)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Receive panosend images and stitch pano images')
+    parser.add_argument('--recalibrate', action='store_true',
+                        help='opencv stitch engine. Estimate new camera calibration and '
+                             'remap tables from the next sequence eg after a camera is moved')
+    parser.add_argument('--migrate-media', action='store_true',
+                        help='Move existing frames and panos into MEDIA_LAYOUT folders then exit. '
+                             'Stop panohub first')
+    parser.add_argument('--config', default=YAML_FILEPATH,
+                        help='Settings yaml file. default %s' % YAML_FILEPATH)
+    parser.add_argument('--no-notify', action='store_true',
+                        help='Do not send settings to or restart panosend hosts '
+                             'eg for panobench.py')
+    ARGS = parser.parse_args()
+    YAML_FILEPATH = ARGS.config
+    # an older panohub.dat counter is kept beside its settings file
+    TIMELAPSE_SEQ_COUNTER_PATH = os.path.join(os.path.dirname(os.path.abspath(YAML_FILEPATH)),
+                                              BASE_FILENAME + '.dat')
 
-try:
-    do_pano_hub()
-except KeyboardInterrupt:
-    print('')
-    print('panohub.py: User Exited with keyboard ctrl-c')
-finally:
-    notify_senders(CAM_HOST_NAMES, False)
-    print('panohub.py: ver %s Bye ...' % PROG_VER)
+    print('-----------------------------------------------------------')
+    print('%s ver %s written by Claude Pageau' % (PROG_NAME, PROG_VER))
+    print('-----------------------------------------------------------')
+    print('%s: Version %s Initializing ...' % (PROG_NAME, PROG_VER))
+    read_yaml_vars(YAML_FILEPATH, YAML_PANOHUB_SECTION_NAME)
+    HUB_STATUS = HubStatus(HUB_STATUS_FILEPATH)
+    HUB_METRICS = HubMetrics(METRICS_WINDOW)
+    if RECV_SEQ_TOLERANCE >= TIMELAPSE_TIMER / 2.0:
+        # frames must not be nearer to a neighbouring trigger than to their own
+        print('%s: WARN RECV_SEQ_TOLERANCE=%s Not Less Than Half TIMELAPSE_TIMER=%s. Using %s' %
+              (PROG_NAME, RECV_SEQ_TOLERANCE, TIMELAPSE_TIMER, TIMELAPSE_TIMER / 4.0))
+        RECV_SEQ_TOLERANCE = TIMELAPSE_TIMER / 4.0
+    if MEDIA_LAYOUT not in MEDIA_LAYOUTS:
+        print('%s: WARN MEDIA_LAYOUT=%s Not Valid. Using flat' % (PROG_NAME, MEDIA_LAYOUT))
+        MEDIA_LAYOUT = 'flat'
+    if ARGS.migrate_media:
+        migrate_media()
+        sys.exit(0)
+    STITCH_TILE_POOL = None
+    if STITCH_ENGINE == 'opencv':
+        tile_workers = STITCH_TILE_WORKERS or os.cpu_count() or 1
+        if tile_workers > 1 and panostitch.shared_memory is None:
+            print('%s: WARN STITCH_TILE_WORKERS Needs python 3.8 or later. Using 1' % PROG_NAME)
+        elif tile_workers > 1:
+            # workers are forked so start them before any hub threads
+            STITCH_TILE_POOL = panostitch.TilePool(tile_workers)
+    VIDEO_BUILDER = None
+    if VIDEO_ON:
+        print('%s: Append %s panos to %ix%i video segments in %s' %
+              (PROG_NAME, 'preview' if VIDEO_FROM_PREVIEWS else 'full resolution',
+               VIDEO_WIDTH, VIDEO_HEIGHT, VIDEO_DIR))
+        VIDEO_BUILDER = VideoBuilder(VIDEO_DIR, VIDEO_WIDTH, VIDEO_HEIGHT, VIDEO_FPS,
+                                     VIDEO_FOURCC, VIDEO_SEGMENT_FRAMES, VIDEO_SEGMENT_SEC,
+                                     VIDEO_QUEUE_MAX)
+    if STITCH_ENGINE == 'opencv':
+        print('%s: Stitch in-process using camera calibration %s' %
+              (PROG_NAME, STITCH_CALIB_FILEPATH))
+        stitch_gain_alpha = 0.0
+        if STITCH_GAIN_ON:
+            if not 0.0 < STITCH_GAIN_ALPHA <= 1.0:
+                print('%s: WARN STITCH_GAIN_ALPHA=%s Not Valid. Using 0.3' %
+                      (PROG_NAME, STITCH_GAIN_ALPHA))
+                STITCH_GAIN_ALPHA = 0.3
+            stitch_gain_alpha = STITCH_GAIN_ALPHA
+        STITCH_ENGINE_INSTANCE = panostitch.StitchEngine(STITCH_CALIB_FILEPATH,
+                                                         STITCH_TABLES_DIR,
+                                                         hfov_deg=STITCH_CAMERA_HFOV,
+                                                         jpeg_quality=STITCH_JPEG_QUALITY,
+                                                         gain_alpha=stitch_gain_alpha,
+                                                         tile_pool=STITCH_TILE_POOL)
+        calib_root, calib_ext = os.path.splitext(STITCH_CALIB_FILEPATH)
+        STITCH_PREVIEW_ENGINE_INSTANCE = panostitch.StitchEngine(
+            calib_root + PREVIEW_SUFFIX + calib_ext,
+            STITCH_TABLES_DIR + PREVIEW_SUFFIX,
+            hfov_deg=STITCH_CAMERA_HFOV,
+            jpeg_quality=STITCH_JPEG_QUALITY,
+            gain_alpha=stitch_gain_alpha,
+            tile_pool=STITCH_TILE_POOL)
+        if ARGS.recalibrate:
+            STITCH_ENGINE_INSTANCE.recalibrate()
+            STITCH_PREVIEW_ENGINE_INSTANCE.recalibrate()
+    else:
+        print('%s: %s modified by Claude Pageau per https://github.com/pageauc/OpenPano' %
+              (PROG_NAME, STITCH_PROGRAM))
+        if ARGS.recalibrate:
+            print('%s: WARN --recalibrate only applies to STITCH_ENGINE opencv' % PROG_NAME)
+
+    if not ARGS.no_notify:
+        notify_senders(CAM_HOST_NAMES, True)  # Send yaml file to panowatch.py
+                                              # and restart panosend.py on remote hosts
+    # Create required folder paths if req'd
+    if not os.path.isdir(IMAGE_PANO_DIR):
+        os.makedirs(IMAGE_PANO_DIR)
+    if not os.path.isdir(IMAGE_DIR):
+        os.makedirs(IMAGE_DIR)
+    if IMAGE_KEEP_RAW not in IMAGE_KEEP_RAW_ACTIONS:
+        print('%s: WARN IMAGE_KEEP_RAW=%s Not Valid. Using all' % (PROG_NAME, IMAGE_KEEP_RAW))
+        IMAGE_KEEP_RAW = 'all'
+    if IMAGE_KEEP_RAW != 'all':
+        print('%s: Raw Camera Frames Saved %s' %
+              (PROG_NAME, 'Only if a Stitch Fails' if IMAGE_KEEP_RAW == 'on_failure' else 'Never'))
+    if STITCH_ENGINE != 'opencv' and not os.path.isdir(STITCH_STAGING_DIR):
+        try:
+            os.makedirs(STITCH_STAGING_DIR)
+        except OSError as err_msg:
+            STITCH_STAGING_DIR = tempfile.mkdtemp(prefix=BASE_FILENAME + '-staging-')
+            print('%s: WARN Could Not Create STITCH_STAGING_DIR %s. Using %s' %
+                  (PROG_NAME, err_msg, STITCH_STAGING_DIR))
+    FRAME_WRITER = FrameWriter(IMAGE_WRITE_BUFFER_SIZE, IMAGE_WRITE_QUEUE_MAX)
+    RETENTION = RetentionEngine()
+    SEQ_MANIFEST = SeqManifest(SEQ_MANIFEST_FILEPATH, TIMELAPSE_SEQ_COUNTER_PATH,
+                               TIMELAPSE_SEQ_NUM_START)
+    if METRICS_ON:
+        start_metrics_server(METRICS_BIND_ADDR, METRICS_PORT)
+    STITCH_CHECK = None
+    if STITCH_CHECK_ON:
+        if STITCH_CHECK_FAIL not in STITCH_CHECK_FAIL_ACTIONS:
+            print('%s: WARN STITCH_CHECK_FAIL=%s Not Valid. Using skip' %
+                  (PROG_NAME, STITCH_CHECK_FAIL))
+            STITCH_CHECK_FAIL = 'skip'
+        if STITCH_CHECK_FAIL == 'defer' and IMAGE_KEEP_RAW == 'none':
+            # a deferred sequence is stitched later from its saved raw frames
+            print('%s: WARN STITCH_CHECK_FAIL=defer Needs IMAGE_KEEP_RAW all or on_failure. '
+                  'Using skip' % PROG_NAME)
+            STITCH_CHECK_FAIL = 'skip'
+        STITCH_CHECK = StitchCheck(STITCH_CHECK_WIDTH, STITCH_CHECK_MIN_MATCHES,
+                                   STITCH_CHECK_MIN_OVERLAP, STITCH_CHECK_SEC,
+                                   STITCH_CHECK_DEFER_MAX)
+    STITCH_QUEUE = StitchQueue(stitch_job, STITCH_WORKERS,
+                               STITCH_QUEUE_MAX, STITCH_QUEUE_OVERFLOW)
+    STITCH_QUEUE.on_drop = keep_dropped_frames
+
+    try:
+        do_pano_hub()
+    except KeyboardInterrupt:
+        print('')
+        print('panohub.py: User Exited with keyboard ctrl-c')
+    finally:
+        if STITCH_QUEUE.pending():
+            print('panohub.py: Waiting up to %i sec for %i Stitch Jobs. ctrl-c again to Exit Now' %
+                  (STITCH_EXIT_WAIT_SEC, STITCH_QUEUE.pending()))
+            try:
+                STITCH_QUEUE.join(STITCH_EXIT_WAIT_SEC)
+            except KeyboardInterrupt:
+                print('')
+            if STITCH_QUEUE.pending():
+                print('panohub.py: WARN Abandoned %i Stitch Jobs on Exit' % STITCH_QUEUE.pending())
+                for job in STITCH_QUEUE.abandon():
+                    keep_dropped_frames(job)
+        if STITCH_CHECK is not None and STITCH_CHECK.deferred:
+            print('panohub.py: WARN %i Deferred Sequences Not Stitched. Raw Frames Kept in %s' %
+                  (len(STITCH_CHECK.deferred), IMAGE_DIR))
+        if VIDEO_BUILDER is not None:
+            VIDEO_BUILDER.close(30)
+        if STITCH_TILE_POOL is not None:
+            STITCH_ENGINE_INSTANCE.close()
+            STITCH_PREVIEW_ENGINE_INSTANCE.close()
+            STITCH_TILE_POOL.close()
+        if not FRAME_WRITER.flush(30):
+            print('panohub.py: WARN %i Raw Frames Not Written Before Exit' % FRAME_WRITER.pending())
+        if not ARGS.no_notify:
+            notify_senders(CAM_HOST_NAMES, False)
+        print('panohub.py: ver %s Bye ...' % PROG_VER)
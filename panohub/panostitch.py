@@ -0,0 +1,777 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+'''
+panostitch.py -- written by Claude Pageau https://github.com/pageauc/panopi
+
+Description:
+In-process stitching engine used by panohub.py when STITCH_ENGINE is
+set to 'opencv' in panohub.yaml.  The panosend cameras are fixed to a rig
+so the camera transforms only need to be estimated once.  They are saved
+to a calibration file and each sequence is then only warped and blended.
+
+Images are projected onto a cylinder using the camera horizontal field of
+view then neighbouring cameras are registered with ORB feature matching.
+Cameras must be listed left to right in the panohub.yaml CAM_HOST_NAMES.
+The calibration is turned into cv2.remap lookup tables and blend
+weights saved as .npy files that are memory mapped on startup.
+Run ./panohub.py --recalibrate after a camera is moved.
+'''
+
+from __future__ import print_function
+import os
+import math
+import signal
+import threading
+import multiprocessing
+import numpy as np
+import cv2
+import yaml
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None  # python < 3.8 composes on one core
+
+CALIB_VERSION = 1
+GAIN_SIGMA_N = 10.0  # expected pixel difference in overlaps for gain compensation
+GAIN_SIGMA_G = 0.1  # expected deviation of camera gains from 1
+GAIN_MIN = 0.5
+GAIN_MAX = 2.0
+GAIN_SAMPLE_STEP = 8  # overlap pixels are sampled every this many rows and columns
+
+#---------------------------------------------------------------
+def load_calibration(calib_path):
+    '''
+    Read camera calibration from a yaml file.
+    Return None if the file does not exist or is not valid.
+    '''
+    if not os.path.isfile(calib_path):
+        return None
+    try:
+        with open(calib_path) as calib_file:
+            calib = yaml.safe_load(calib_file)
+    except (IOError, yaml.YAMLError) as err_msg:
+        print('panostitch.py: WARN Could Not Read %s %s' % (calib_path, err_msg))
+        return None
+    if not isinstance(calib, dict) or calib.get('version') != CALIB_VERSION:
+        print('panostitch.py: WARN Ignoring Old or Invalid Calibration %s' % calib_path)
+        return None
+    return calib
+
+#---------------------------------------------------------------
+def save_calibration(calib_path, calib):
+    '''
+    Save camera calibration or a table index to a yaml file. Write to a
+    temporary file first so a crash can not leave a partial file.
+    '''
+    tmp_path = calib_path + '.tmp'
+    with open(tmp_path, 'w') as calib_file:
+        yaml.safe_dump(calib, calib_file, default_flow_style=None)
+    os.rename(tmp_path, calib_path)
+    print('panostitch.py: Saved %s' % calib_path)
+
+#---------------------------------------------------------------
+def get_focal_px(frame_width, hfov_deg):
+    '''
+    Return camera focal length in pixels from image
+    width and camera horizontal field of view in degrees.
+    '''
+    return (frame_width / 2.0) / math.tan(math.radians(hfov_deg) / 2.0)
+
+#---------------------------------------------------------------
+def cylinder_maps(frame_width, frame_height, focal_px):
+    '''
+    Return cv2.remap map_x, map_y tables that project a flat camera
+    image onto a cylinder with radius focal_px, plus a uint8 mask of
+    cylinder pixels that have valid source image data.
+    '''
+    cyl_width = int(2 * focal_px * math.atan(frame_width / (2.0 * focal_px)))
+    theta = (np.arange(cyl_width, dtype=np.float32) - cyl_width / 2.0) / focal_px
+    y_c = np.arange(frame_height, dtype=np.float32) - frame_height / 2.0
+    map_x = np.tile(focal_px * np.tan(theta) + frame_width / 2.0, (frame_height, 1))
+    map_y = y_c[:, None] / np.cos(theta)[None, :] + frame_height / 2.0
+    map_x = map_x.astype(np.float32)
+    map_y = map_y.astype(np.float32)
+    valid = ((map_x >= 0) & (map_x <= frame_width - 1) &
+             (map_y >= 0) & (map_y <= frame_height - 1))
+    return map_x, map_y, valid.astype(np.uint8) * 255
+
+#---------------------------------------------------------------
+def detect_features(image, mask, work_width, max_features):
+    '''
+    Detect ORB features on a downscaled gray copy of image.
+    Return keypoint coordinates scaled back to image size and descriptors.
+    '''
+    scale = min(1.0, float(work_width) / image.shape[1])
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if scale < 1.0:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        mask = cv2.resize(mask, (gray.shape[1], gray.shape[0]),
+                          interpolation=cv2.INTER_NEAREST)
+    orb = cv2.ORB_create(nfeatures=max_features)
+    keypoints, descriptors = orb.detectAndCompute(gray, mask)
+    points = np.float32([kp.pt for kp in keypoints]).reshape(-1, 2) / scale
+    return points, descriptors
+
+#---------------------------------------------------------------
+def match_features(feat_a, feat_b, ratio=0.75):
+    '''
+    Match two sets of ORB features using a ratio test.
+    Return matching point arrays from a and b.
+    '''
+    points_a, desc_a = feat_a
+    points_b, desc_b = feat_b
+    if desc_a is None or desc_b is None or len(desc_a) < 2 or len(desc_b) < 2:
+        return np.empty((0, 2), np.float32), np.empty((0, 2), np.float32)
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+    good = []
+    for pair in matcher.knnMatch(desc_a, desc_b, k=2):
+        if len(pair) == 2 and pair[0].distance < ratio * pair[1].distance:
+            good.append(pair[0])
+    match_a = np.float32([points_a[m.queryIdx] for m in good]).reshape(-1, 2)
+    match_b = np.float32([points_b[m.trainIdx] for m in good]).reshape(-1, 2)
+    return match_a, match_b
+
+#---------------------------------------------------------------
+def estimate_pair_transform(left_cyl, right_cyl, left_valid, right_valid,
+                            overlap_max, work_width, max_features, min_inliers):
+    '''
+    Estimate the similarity transform mapping right camera cylinder
+    coordinates to left camera cylinder coordinates. Features are only
+    searched in the part of each image that can overlap its neighbour.
+    Return a 3x3 matrix and inlier count or None, inlier count on failure.
+    '''
+    left_mask = left_valid.copy()
+    left_mask[:, :int(left_mask.shape[1] * (1.0 - overlap_max))] = 0
+    right_mask = right_valid.copy()
+    right_mask[:, int(right_mask.shape[1] * overlap_max):] = 0
+    feat_left = detect_features(left_cyl, left_mask, work_width, max_features)
+    feat_right = detect_features(right_cyl, right_mask, work_width, max_features)
+    match_left, match_right = match_features(feat_left, feat_right)
+    if len(match_left) < min_inliers:
+        return None, len(match_left)
+    affine, inliers = cv2.estimateAffinePartial2D(match_right, match_left,
+                                                  method=cv2.RANSAC,
+                                                  ransacReprojThreshold=3.0)
+    inlier_cnt = 0 if inliers is None else int(inliers.sum())
+    if affine is None or inlier_cnt < min_inliers:
+        return None, inlier_cnt
+    return np.vstack([affine, [0.0, 0.0, 1.0]]), inlier_cnt
+
+#---------------------------------------------------------------
+def get_crop_rect(coverage, row_fill=0.95):
+    '''
+    Find a rectangle inside the coverage mask with no blank areas.
+    Rows that are mostly covered are kept first then columns that are
+    fully covered within those rows. Return x, y, width, height.
+    '''
+    height, width = coverage.shape
+    rows = coverage.mean(axis=1) >= row_fill
+    y0, y1 = longest_run(rows)
+    if y1 <= y0:
+        return 0, 0, width, height
+    cols = coverage[y0:y1].all(axis=0)
+    x0, x1 = longest_run(cols)
+    if x1 <= x0:
+        return 0, y0, width, y1 - y0
+    return x0, y0, x1 - x0, y1 - y0
+
+#---------------------------------------------------------------
+def longest_run(flags):
+    '''
+    Return start, end index of the longest run of True values
+    '''
+    best_start, best_end = 0, 0
+    start = None
+    for idx, flag in enumerate(list(flags) + [False]):
+        if flag and start is None:
+            start = idx
+        elif not flag and start is not None:
+            if idx - start > best_end - best_start:
+                best_start, best_end = start, idx
+            start = None
+    return best_start, best_end
+
+#---------------------------------------------------------------
+def estimate_calibration(cam_names, images, hfov_deg, overlap_max=0.5,
+                         work_width=800, max_features=2000, min_inliers=20,
+                         max_output_size=8000):
+    '''
+    Estimate camera transforms for a left to right ordered list of
+    images from a fixed rig. Return a calibration dict or None.
+    '''
+    frame_height, frame_width = images[0].shape[:2]
+    for image in images:
+        if image.shape[:2] != (frame_height, frame_width):
+            print('panostitch.py: ERROR Calibration needs same size images from all cameras')
+            return None
+    focal_px = get_focal_px(frame_width, hfov_deg)
+    map_x, map_y, valid = cylinder_maps(frame_width, frame_height, focal_px)
+    cyl_images = [cv2.remap(image, map_x, map_y, cv2.INTER_LINEAR) for image in images]
+
+    # Chain neighbour transforms to the middle camera
+    ref = len(images) // 2
+    pair_transforms = [None]
+    for idx in range(1, len(images)):
+        pair, inlier_cnt = estimate_pair_transform(cyl_images[idx - 1], cyl_images[idx],
+                                                   valid, valid, overlap_max,
+                                                   work_width, max_features, min_inliers)
+        if pair is None:
+            print('panostitch.py: ERROR Calibration Failed between %s and %s. Only %i matches' %
+                  (cam_names[idx - 1], cam_names[idx], inlier_cnt))
+            return None
+        print('panostitch.py: %s to %s Registered with %i inliers' %
+              (cam_names[idx - 1], cam_names[idx], inlier_cnt))
+        pair_transforms.append(pair)
+    transforms = [None] * len(images)
+    transforms[ref] = np.eye(3)
+    for idx in range(ref + 1, len(images)):
+        transforms[idx] = transforms[idx - 1].dot(pair_transforms[idx])
+    for idx in range(ref - 1, -1, -1):
+        transforms[idx] = transforms[idx + 1].dot(np.linalg.inv(pair_transforms[idx + 1]))
+
+    # Shift all cameras onto a canvas that holds every warped image
+    cyl_height, cyl_width = valid.shape
+    corners = np.float32([[0, 0], [cyl_width, 0],
+                          [cyl_width, cyl_height], [0, cyl_height]]).reshape(-1, 1, 2)
+    all_corners = np.vstack([cv2.perspectiveTransform(corners, t) for t in transforms])
+    x_min, y_min = np.floor(all_corners.min(axis=0).ravel())
+    x_max, y_max = np.ceil(all_corners.max(axis=0).ravel())
+    canvas_width, canvas_height = int(x_max - x_min), int(y_max - y_min)
+    if max(canvas_width, canvas_height) > max_output_size:
+        print('panostitch.py: ERROR Calibration Canvas %ix%i Larger Than %i. Check camera overlap' %
+              (canvas_width, canvas_height, max_output_size))
+        return None
+    shift = np.array([[1.0, 0.0, -x_min], [0.0, 1.0, -y_min], [0.0, 0.0, 1.0]])
+    transforms = [shift.dot(t) for t in transforms]
+
+    # Crop canvas to the area covered by camera images
+    coverage = np.zeros((canvas_height, canvas_width), np.uint8)
+    for t in transforms:
+        coverage |= cv2.warpAffine(valid, t[:2], (canvas_width, canvas_height),
+                                   flags=cv2.INTER_NEAREST)
+    crop_x, crop_y, canvas_width, canvas_height = get_crop_rect(coverage > 0)
+    crop = np.array([[1.0, 0.0, -crop_x], [0.0, 1.0, -crop_y], [0.0, 0.0, 1.0]])
+    transforms = [crop.dot(t) for t in transforms]
+    print('panostitch.py: Calibrated %i Cameras Canvas %ix%i' %
+          (len(images), canvas_width, canvas_height))
+    return {'version': CALIB_VERSION,
+            'cameras': list(cam_names),
+            'frame_size': [frame_width, frame_height],
+            'hfov_deg': float(hfov_deg),
+            'focal_px': float(focal_px),
+            'canvas_size': [canvas_width, canvas_height],
+            'transforms': [t[:2].tolist() for t in transforms]}
+
+#---------------------------------------------------------------
+def check_overlap(cam_names, images, hfov_deg, overlap_max=0.5,
+                  work_width=320, max_features=500):
+    '''
+    Quick registration health check of left to right ordered images
+    eg before a slow stitch. Images are scaled to work_width then each
+    neighbour pair is registered like estimate_calibration does.
+    Return a list of dicts per pair with left, right camera names,
+    matches= RANSAC inliers and overlap= fraction of the frame width
+    shared with the neighbour. A pair that can not be registered has
+    overlap 0.
+    '''
+    scale = float(work_width) / images[0].shape[1]
+    small_images = [cv2.resize(image, (work_width, int(image.shape[0] * scale)),
+                               interpolation=cv2.INTER_AREA) for image in images]
+    frame_height, frame_width = small_images[0].shape[:2]
+    map_x, map_y, valid = cylinder_maps(frame_width, frame_height,
+                                        get_focal_px(frame_width, hfov_deg))
+    cyl_images = [cv2.remap(image, map_x, map_y, cv2.INTER_LINEAR) for image in small_images]
+    cyl_width = valid.shape[1]
+    pairs = []
+    for idx in range(1, len(cyl_images)):
+        pair, inlier_cnt = estimate_pair_transform(cyl_images[idx - 1], cyl_images[idx],
+                                                   valid, valid, overlap_max, work_width,
+                                                   max_features, 4)
+        overlap = 0.0
+        if pair is not None:
+            # pair maps right camera x to left camera x so its shift is the left
+            # camera width not covered by the right camera
+            overlap = min(1.0, max(0.0, float(cyl_width - pair[0, 2]) / cyl_width))
+        pairs.append({'left': cam_names[idx - 1],
+                      'right': cam_names[idx],
+                      'matches': inlier_cnt,
+                      'overlap': overlap})
+    return pairs
+
+#---------------------------------------------------------------
+def build_remap_tables(calib):
+    '''
+    Build a cv2.remap lookup table and a blend weight mask for each camera
+    from a calibration. Each table maps the canvas region a camera covers
+    straight back to source camera pixels, so the cylinder projection and
+    camera transform become a single remap. Weights are uint8 feather
+    weights that add up to 255 wherever cameras overlap.
+    Return a list of (roi, map1, map2, weight) per camera.
+    '''
+    frame_width, frame_height = calib['frame_size']
+    canvas_width, canvas_height = calib['canvas_size']
+    focal_px = calib['focal_px']
+    valid = cylinder_maps(frame_width, frame_height, focal_px)[2]
+    cyl_height, cyl_width = valid.shape
+    # Feather weight is highest in the middle of each camera image
+    feather = cv2.distanceTransform(cv2.copyMakeBorder(valid, 1, 1, 1, 1,
+                                                       cv2.BORDER_CONSTANT, value=0),
+                                    cv2.DIST_L2, 3)[1:-1, 1:-1]
+    corners = np.float32([[0, 0], [cyl_width, 0],
+                          [cyl_width, cyl_height], [0, cyl_height]]).reshape(-1, 1, 2)
+    cams = []
+    weight_canvas = []
+    for transform in calib['transforms']:
+        affine = np.array(transform, dtype=np.float64)
+        canvas_corners = cv2.transform(corners, affine).reshape(-1, 2)
+        x0, y0 = np.maximum(np.floor(canvas_corners.min(axis=0)), 0).astype(int)
+        x1 = int(min(np.ceil(canvas_corners[:, 0].max()), canvas_width))
+        y1 = int(min(np.ceil(canvas_corners[:, 1].max()), canvas_height))
+        # canvas pixel -> camera cylinder pixel -> source camera pixel
+        inverse = cv2.invertAffineTransform(affine)
+        grid_x, grid_y = np.meshgrid(np.arange(x0, x1, dtype=np.float32),
+                                     np.arange(y0, y1, dtype=np.float32))
+        cyl_x = (inverse[0, 0] * grid_x + inverse[0, 1] * grid_y + inverse[0, 2]).astype(np.float32)
+        cyl_y = (inverse[1, 0] * grid_x + inverse[1, 1] * grid_y + inverse[1, 2]).astype(np.float32)
+        weight = np.zeros((canvas_height, canvas_width), np.float32)
+        weight[y0:y1, x0:x1] = cv2.remap(feather, cyl_x, cyl_y, cv2.INTER_LINEAR,
+                                         borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        theta = (cyl_x - cyl_width / 2.0) / focal_px
+        map_x = (focal_px * np.tan(theta) + frame_width / 2.0).astype(np.float32)
+        map_y = ((cyl_y - cyl_height / 2.0) / np.cos(theta) + frame_height / 2.0).astype(np.float32)
+        outside = ((cyl_x < 0) | (cyl_x > cyl_width - 1) | (cyl_y < 0) | (cyl_y > cyl_height - 1))
+        map_x[outside] = -1
+        map_y[outside] = -1
+        map1, map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+        cams.append([(int(x0), int(y0), int(x1), int(y1)), map1, map2])
+        weight_canvas.append(weight)
+
+    # Normalize weights then round the running total so overlaps add to 255
+    weight_sum = np.sum(weight_canvas, axis=0)
+    weight_sum[weight_sum == 0] = 1.0
+    prev_total = np.zeros((canvas_height, canvas_width), np.float32)
+    running = np.zeros((canvas_height, canvas_width), np.float32)
+    tables = []
+    for cam, weight in zip(cams, weight_canvas):
+        running += weight / weight_sum
+        total = np.round(running * 255.0)
+        x0, y0, x1, y1 = cam[0]
+        cam_weight = (total - prev_total)[y0:y1, x0:x1].astype(np.uint8)
+        prev_total = total
+        tables.append((cam[0], cam[1], cam[2], cam_weight))
+    return tables
+
+#---------------------------------------------------------------
+def save_remap_tables(tables_dir, calib, tables):
+    '''
+    Save remap tables and blend weights as .npy files with a
+    tables.yaml index that records the calibration they belong to.
+    '''
+    if not os.path.isdir(tables_dir):
+        os.makedirs(tables_dir)
+    rois = []
+    for cam_num, (roi, map1, map2, weight) in enumerate(tables):
+        np.save(os.path.join(tables_dir, 'cam%i-map1.npy' % cam_num), map1)
+        np.save(os.path.join(tables_dir, 'cam%i-map2.npy' % cam_num), map2)
+        np.save(os.path.join(tables_dir, 'cam%i-weight.npy' % cam_num), weight)
+        rois.append(list(roi))
+    # Index is written last so an interrupted save is never loaded
+    save_calibration(os.path.join(tables_dir, 'tables.yaml'),
+                     {'version': CALIB_VERSION, 'calib': calib, 'rois': rois})
+
+#---------------------------------------------------------------
+def load_remap_tables(tables_dir, calib):
+    '''
+    Memory map saved remap tables and blend weights. Return None if the
+    tables are missing or were built from a different calibration.
+    '''
+    index = load_calibration(os.path.join(tables_dir, 'tables.yaml'))
+    if index is None or index.get('calib') != calib:
+        return None
+    tables = []
+    try:
+        for cam_num, roi in enumerate(index['rois']):
+            tables.append((tuple(roi),
+                           np.load(os.path.join(tables_dir, 'cam%i-map1.npy' % cam_num), mmap_mode='r'),
+                           np.load(os.path.join(tables_dir, 'cam%i-map2.npy' % cam_num), mmap_mode='r'),
+                           np.load(os.path.join(tables_dir, 'cam%i-weight.npy' % cam_num), mmap_mode='r')))
+    except (IOError, ValueError) as err_msg:
+        print('panostitch.py: WARN Could Not Load Remap Tables %s' % err_msg)
+        return None
+    print('panostitch.py: Loaded Remap Tables from %s' % tables_dir)
+    return tables
+
+#---------------------------------------------------------------
+def measure_overlaps(strips, sample_step=GAIN_SAMPLE_STEP):
+    '''
+    Return per channel colour sums of each pair of warped camera strips
+    where they overlap on the canvas as a list of
+    (camera a, camera b, pixel count, sum a, sum b). strips is a list of
+    (camera, canvas x, canvas y, warped image, blend weight). Pixels are
+    sampled on canvas rows and columns that are multiples of sample_step
+    so canvas strips measured apart add up to the whole canvas.
+    Near black or saturated pixels are left out since a gain can not
+    correct them.
+    '''
+    overlaps = []
+    for idx_a, (cam_a, ax0, ay0, warped_a, weight_a) in enumerate(strips):
+        for cam_b, bx0, by0, warped_b, weight_b in strips[idx_a + 1:]:
+            x0 = -(-max(ax0, bx0) // sample_step) * sample_step
+            y0 = -(-max(ay0, by0) // sample_step) * sample_step
+            x1 = min(ax0 + warped_a.shape[1], bx0 + warped_b.shape[1])
+            y1 = min(ay0 + warped_a.shape[0], by0 + warped_b.shape[0])
+            if x1 <= x0 or y1 <= y0:
+                continue
+            rows_a = slice(y0 - ay0, y1 - ay0, sample_step)
+            cols_a = slice(x0 - ax0, x1 - ax0, sample_step)
+            rows_b = slice(y0 - by0, y1 - by0, sample_step)
+            cols_b = slice(x0 - bx0, x1 - bx0, sample_step)
+            shared = (weight_a[rows_a, cols_a] > 0) & (weight_b[rows_b, cols_b] > 0)
+            pixels_a = warped_a[rows_a, cols_a][shared]
+            pixels_b = warped_b[rows_b, cols_b][shared]
+            valid = ((pixels_a.min(axis=1) > 8) & (pixels_a.max(axis=1) < 247) &
+                     (pixels_b.min(axis=1) > 8) & (pixels_b.max(axis=1) < 247))
+            count = int(valid.sum())
+            if count:
+                overlaps.append((cam_a, cam_b, count,
+                                 pixels_a[valid].sum(axis=0, dtype=np.float64),
+                                 pixels_b[valid].sum(axis=0, dtype=np.float64)))
+    return overlaps
+
+#---------------------------------------------------------------
+def compose_rows(tables, canvas_width, images, cam_indexes, gain_luts,
+                 row_start, row_end, partial, measure):
+    '''
+    Remap, gain correct and blend canvas rows row_start to row_end.
+    Return the uint8 strip and its measure_overlaps() list if measure
+    is True. Used for the whole canvas or one strip per tile worker.
+    '''
+    pano = np.zeros((row_end - row_start, canvas_width, 3), np.uint16)
+    if partial:
+        weight_sum = np.zeros((row_end - row_start, canvas_width, 1), np.uint16)
+    strips = []
+    for image, cam_num in zip(images, cam_indexes):
+        (x0, y0, x1, y1), map1, map2, weight = tables[cam_num]
+        strip_y0, strip_y1 = max(y0, row_start), min(y1, row_end)
+        if strip_y1 <= strip_y0:
+            continue
+        rows = slice(strip_y0 - y0, strip_y1 - y0)
+        warped = cv2.remap(image, map1[rows], map2[rows], cv2.INTER_LINEAR,
+                           borderMode=cv2.BORDER_CONSTANT)
+        if gain_luts is not None:
+            warped = cv2.LUT(warped, gain_luts[cam_num])
+        cam_weight = weight[rows, :, None].astype(np.uint16)
+        pano[strip_y0 - row_start:strip_y1 - row_start, x0:x1] += warped * cam_weight
+        if partial:
+            weight_sum[strip_y0 - row_start:strip_y1 - row_start, x0:x1] += cam_weight
+        if measure:
+            strips.append((cam_num, x0, strip_y0, warped, weight[rows]))
+    overlaps = measure_overlaps(strips) if measure else []
+    if partial:
+        return (pano // np.maximum(weight_sum, 1)).astype(np.uint8), overlaps
+    return ((pano + 127) // 255).astype(np.uint8), overlaps
+
+#---------------------------------------------------------------
+def estimate_gains(overlaps, cam_count, sigma_n=GAIN_SIGMA_N, sigma_g=GAIN_SIGMA_G,
+                   min_count=100):
+    '''
+    Solve per channel camera gains that make overlapping cameras match
+    while staying close to 1 per Brown and Lowe gain compensation.
+    overlaps is from measure_overlaps(). Overlaps of fewer than
+    min_count pixels are ignored. Return a cam_count x 3 array.
+    '''
+    overlaps = [(cam_a, cam_b, count, sum_a / count, sum_b / count)
+                for cam_a, cam_b, count, sum_a, sum_b in overlaps if count >= min_count]
+    gains = np.ones((cam_count, 3))
+    for channel in range(3):
+        # weak prior on every camera so cameras without overlaps keep gain 1
+        matrix = np.eye(cam_count) / sigma_g ** 2
+        vector = np.ones(cam_count) / sigma_g ** 2
+        for cam_a, cam_b, count, mean_a, mean_b in overlaps:
+            for i, j, mean_i, mean_j in ((cam_a, cam_b, mean_a[channel], mean_b[channel]),
+                                         (cam_b, cam_a, mean_b[channel], mean_a[channel])):
+                matrix[i, i] += count * (mean_i ** 2 / sigma_n ** 2 + 1.0 / sigma_g ** 2)
+                matrix[i, j] -= count * mean_i * mean_j / sigma_n ** 2
+                vector[i] += count / sigma_g ** 2
+        gains[:, channel] = np.linalg.solve(matrix, vector)
+    return gains
+
+#---------------------------------------------------------------
+def build_gain_luts(gains):
+    '''
+    Return a 256 entry uint8 lookup table per camera that applies its
+    per channel gains with cv2.LUT. gains is a cameras x 3 array.
+    '''
+    values = np.arange(256, dtype=np.float64)[:, None]
+    return [np.clip(np.round(values * cam_gains[None, :]), 0, 255).astype(np.uint8).reshape(1, 256, 3)
+            for cam_gains in gains]
+
+#---------------------------------------------------------------
+TILE_WORKER_STATE = {'tables': {}, 'buffers': {}}
+
+def init_tile_worker():
+    ''' Tile pool worker setup. The hub handles Ctrl-C and tiles are already one per core '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    cv2.setNumThreads(1)
+
+def attach_buffer(name):
+    ''' Return a tile worker mapping of a shared memory buffer by name '''
+    buffers = TILE_WORKER_STATE['buffers']
+    if name not in buffers:
+        if len(buffers) >= 8:  # engines reallocated their buffers
+            for old_buffer in buffers.values():
+                old_buffer.close()
+            buffers.clear()
+        buffers[name] = shared_memory.SharedMemory(name=name)
+    return buffers[name]
+
+def compose_tile(task):
+    '''
+    Tile pool worker. Compose one strip of canvas rows from frames in a
+    shared input buffer into a shared output buffer and return its
+    overlap sums. Remap tables are memory mapped from the tables folder
+    once per calibration.
+    '''
+    (calib_path, tables_dir, tables_id, input_name, frame_shape, cam_indexes,
+     output_name, canvas_shape, gain_luts, row_start, row_end, partial, measure) = task
+    tables_id_loaded, tables = TILE_WORKER_STATE['tables'].get(tables_dir, (None, None))
+    if tables_id_loaded != tables_id:
+        tables = load_remap_tables(tables_dir, load_calibration(calib_path))
+        if tables is None:
+            raise IOError('Tile Worker Could Not Load Remap Tables from %s' % tables_dir)
+        TILE_WORKER_STATE['tables'][tables_dir] = (tables_id, tables)
+    images = np.ndarray((len(cam_indexes),) + tuple(frame_shape), np.uint8,
+                        buffer=attach_buffer(input_name).buf)
+    pano = np.ndarray(tuple(canvas_shape), np.uint8, buffer=attach_buffer(output_name).buf)
+    pano[row_start:row_end], overlaps = compose_rows(tables, canvas_shape[1], images,
+                                                     cam_indexes, gain_luts, row_start,
+                                                     row_end, partial, measure)
+    return overlaps
+
+#---------------------------------------------------------------
+class TilePool(object):
+    '''
+    Process pool that composes horizontal canvas strips on every core.
+    Frames and the pano are passed in multiprocessing shared memory so
+    only small task tuples are pickled. Workers are forked when the
+    pool is created so create it before the caller starts any threads.
+    One pool can serve several StitchEngine instances.
+    '''
+    def __init__(self, workers):
+        self.workers = workers
+        # Start the resource tracker before forking so workers share it
+        # and do not unlink buffers they attached to when they exit.
+        resource_tracker.ensure_running()
+        self.pool = multiprocessing.get_context('fork').Pool(workers, init_tile_worker)
+        print('panostitch.py: Started %i Tile Workers' % workers)
+
+    def compose(self, task, canvas_height, measure):
+        '''
+        Split the canvas into one strip of rows per worker and compose
+        them. task holds every compose_tile() item except the rows.
+        Return the merged overlap sums.
+        '''
+        row_edges = np.linspace(0, canvas_height, self.workers + 1).astype(int)
+        tasks = [task[:9] + (int(row_start), int(row_end)) + task[9:]
+                 for row_start, row_end in zip(row_edges[:-1], row_edges[1:])
+                 if row_end > row_start]
+        merged = {}
+        for overlaps in self.pool.map(compose_tile, tasks, chunksize=1):
+            for cam_a, cam_b, count, sum_a, sum_b in overlaps:
+                if (cam_a, cam_b) in merged:
+                    prev_count, prev_a, prev_b = merged[(cam_a, cam_b)]
+                    merged[(cam_a, cam_b)] = (prev_count + count, prev_a + sum_a, prev_b + sum_b)
+                else:
+                    merged[(cam_a, cam_b)] = (count, sum_a, sum_b)
+        return [(cam_a, cam_b) + merged[(cam_a, cam_b)] for cam_a, cam_b in sorted(merged)]
+
+    def close(self):
+        ''' Stop the tile workers '''
+        self.pool.terminate()
+        self.pool.join()
+
+#---------------------------------------------------------------
+class StitchEngine(object):
+    '''
+    Stitch images from a fixed camera rig using saved camera transforms.
+    The rig is calibrated from the first sequence, whenever the camera
+    list or frame size changes, or after recalibrate() is called. The
+    calibration is saved to calib_path and remap tables plus blend weights
+    are built once into tables_dir. Per sequence work is then only one
+    remap per camera and a weighted sum. With a TilePool the canvas is
+    split into strips of rows composed on all cores, reading frames from
+    and writing the pano to shared memory buffers kept between sequences.
+    Cameras auto expose independently so per channel camera gains are
+    applied with cv2.LUT after the remap. The remaining colour mismatch
+    in the overlaps of each full sequence moves the gains gain_alpha of
+    the way towards matching, so gains follow exposure changes smoothly
+    without a full solve per sequence. gain_alpha 0 turns this off.
+    '''
+    def __init__(self, calib_path, tables_dir, hfov_deg=62.2, overlap_max=0.5,
+                 work_width=800, max_features=2000, min_inliers=20,
+                 max_output_size=8000, jpeg_quality=95, gain_alpha=0.0,
+                 tile_pool=None):
+        self.calib_path = calib_path
+        self.tables_dir = tables_dir
+        self.hfov_deg = hfov_deg
+        self.overlap_max = overlap_max
+        self.work_width = work_width
+        self.max_features = max_features
+        self.min_inliers = min_inliers
+        self.max_output_size = max_output_size
+        self.jpeg_quality = jpeg_quality
+        self.gain_alpha = gain_alpha
+        self.gains = None  # cameras x 3 per channel gains
+        self.gain_luts = None
+        self.tile_pool = tile_pool
+        self.input_buffer = None  # shared memory for tile workers
+        self.output_buffer = None
+        self.lock = threading.Lock()
+        self.calib = load_calibration(calib_path)
+        self.tables = None
+        self.tables_id = 0  # tells tile workers when to reload tables
+        if self.calib is not None:
+            self.tables = load_remap_tables(tables_dir, self.calib)
+            self.tables_id += 1
+
+    def recalibrate(self):
+        ''' Estimate new camera transforms and tables on the next stitch '''
+        with self.lock:
+            print('panostitch.py: Recalibrate Cameras on Next Sequence')
+            self.calib = None
+            self.tables = None
+
+    def calibration_matches(self, cam_names, images, partial=False):
+        '''
+        Return True if saved calibration fits these cameras and images.
+        A partial sequence only needs its cameras to be in the calibration.
+        '''
+        if self.calib is None:
+            return False
+        frame_height, frame_width = images[0].shape[:2]
+        if self.calib['frame_size'] != [frame_width, frame_height]:
+            return False
+        if partial:
+            return set(cam_names) <= set(self.calib['cameras'])
+        return self.calib['cameras'] == list(cam_names)
+
+    def calibrate(self, cam_names, images):
+        ''' Estimate and save camera transforms. Return True if successful '''
+        print('panostitch.py: Calibrating Cameras %s' % ', '.join(cam_names))
+        calib = estimate_calibration(cam_names, images, self.hfov_deg,
+                                     self.overlap_max, self.work_width,
+                                     self.max_features, self.min_inliers,
+                                     self.max_output_size)
+        if calib is None:
+            return False
+        save_calibration(self.calib_path, calib)
+        self.calib = calib
+        self.tables = None
+        return True
+
+    def build_tables(self):
+        ''' Build, save and memory map remap tables for the calibration '''
+        print('panostitch.py: Building Remap Tables in %s' % self.tables_dir)
+        save_remap_tables(self.tables_dir, self.calib, build_remap_tables(self.calib))
+        self.tables = load_remap_tables(self.tables_dir, self.calib)
+        self.tables_id += 1
+        self.gains = None
+        self.gain_luts = None
+
+    def update_gains(self, overlaps):
+        '''
+        Move camera gains gain_alpha of the way towards removing the
+        colour mismatch left in the overlaps of gain corrected images.
+        '''
+        if not overlaps:
+            return
+        residual = estimate_gains(overlaps, len(self.tables))
+        self.gains = np.clip(self.gains * residual ** self.gain_alpha, GAIN_MIN, GAIN_MAX)
+        self.gain_luts = build_gain_luts(self.gains)
+
+    def get_buffer(self, buffer, size):
+        ''' Return a shared memory buffer of at least size bytes '''
+        if buffer is not None and buffer.size >= size:
+            return buffer
+        if buffer is not None:
+            buffer.close()
+            buffer.unlink()
+        return shared_memory.SharedMemory(create=True, size=size)
+
+    def compose_tiles(self, images, cam_indexes, partial, measure):
+        '''
+        Compose the pano on the tile pool. Frames are copied once into
+        shared memory and the workers write the pano strips in place.
+        '''
+        canvas_width, canvas_height = self.calib['canvas_size']
+        frame_shape = images[0].shape
+        canvas_shape = (canvas_height, canvas_width, 3)
+        self.input_buffer = self.get_buffer(self.input_buffer,
+                                            len(images) * images[0].nbytes)
+        self.output_buffer = self.get_buffer(self.output_buffer,
+                                             canvas_height * canvas_width * 3)
+        frames = np.ndarray((len(images),) + frame_shape, np.uint8,
+                            buffer=self.input_buffer.buf)
+        for frame_num, image in enumerate(images):
+            frames[frame_num] = image
+        task = (self.calib_path, self.tables_dir, self.tables_id, self.input_buffer.name,
+                frame_shape, list(cam_indexes), self.output_buffer.name, canvas_shape,
+                self.gain_luts, partial, measure)
+        overlaps = self.tile_pool.compose(task, canvas_height, measure)
+        # copy out since the buffer is reused by the next sequence
+        pano = np.ndarray(canvas_shape, np.uint8, buffer=self.output_buffer.buf).copy()
+        return pano, overlaps
+
+    def compose(self, images, cam_indexes=None):
+        '''
+        Remap and blend left to right ordered images into a pano.
+        cam_indexes lists the calibrated camera of each image when
+        some cameras are missing. Their blend weights are renormalized.
+        '''
+        if self.tables is None:
+            self.build_tables()
+        if cam_indexes is None:
+            cam_indexes = range(len(self.tables))
+        canvas_width, canvas_height = self.calib['canvas_size']
+        partial = len(cam_indexes) < len(self.tables)
+        if self.gain_alpha and (self.gains is None or len(self.gains) != len(self.tables)):
+            self.gains = np.ones((len(self.tables), 3))
+            self.gain_luts = None
+        measure = bool(self.gain_alpha) and not partial
+        if self.tile_pool is not None:
+            pano, overlaps = self.compose_tiles(images, cam_indexes, partial, measure)
+        else:
+            pano, overlaps = compose_rows(self.tables, canvas_width, images, cam_indexes,
+                                          self.gain_luts, 0, canvas_height, partial, measure)
+        if measure:
+            self.update_gains(overlaps)
+        return pano
+
+    def close(self):
+        ''' Free shared memory buffers '''
+        with self.lock:
+            for buffer in (self.input_buffer, self.output_buffer):
+                if buffer is not None:
+                    buffer.close()
+                    buffer.unlink()
+            self.input_buffer = None
+            self.output_buffer = None
+
+    def stitch(self, cam_names, images, pano_path, partial=False):
+        '''
+        Stitch left to right ordered images from cam_names and save
+        the pano to pano_path. Return True if the pano was saved.
+        A partial sequence is missing some cameras and is stitched
+        with the existing calibration. It is never used to calibrate.
+        '''
+        with self.lock:
+            if not self.calibration_matches(cam_names, images, partial):
+                if partial:
+                    print('panostitch.py: WARN Partial Sequence Needs a Calibration of All Cameras')
+                    return False
+                if not self.calibrate(cam_names, images):
+                    return False
+            cam_indexes = [self.calib['cameras'].index(cam_name) for cam_name in cam_names]
+            pano = self.compose(images, cam_indexes)
+        return cv2.imwrite(pano_path, pano,
+                           [int(cv2.IMWRITE_JPEG_QUALITY), self.jpeg_quality])
@@ -0,0 +1,207 @@
+'''
+panostitch.py tests. make_rig() renders camera frames from a random
+textured cylinder so the expected camera shift is known.
+'''
+import math
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+PANOHUB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PANOHUB_DIR)
+
+import panostitch
+
+CAM_NAMES = ['cam1', 'cam2', 'cam3']
+HFOV_DEG = 60.0
+
+def make_rig(width=480, height=320, step_deg=35.0):
+    '''
+    Return frames of len(CAM_NAMES) cameras turned step_deg apart and
+    the cylinder pixel shift between neighbouring cameras.
+    '''
+    focal_px = panostitch.get_focal_px(width, HFOV_DEG)
+    rng = np.random.RandomState(1)
+    margin = 20
+    scene_width = int(focal_px * math.radians(HFOV_DEG + step_deg * (len(CAM_NAMES) - 1)))
+    scene_width += 2 * margin
+    scene_height = height + 2 * margin
+    scene = rng.randint(0, 256, (scene_height, scene_width, 3)).astype(np.uint8)
+    scene = cv2.GaussianBlur(scene, (0, 0), 2)
+    for spot_num in range(300):
+        cv2.circle(scene, (rng.randint(0, scene_width), rng.randint(0, scene_height)),
+                   rng.randint(3, 15), [int(c) for c in rng.randint(0, 256, 3)], -1)
+    theta = np.arctan((np.arange(width, dtype=np.float32) - width / 2.0) / focal_px)
+    y_c = np.arange(height, dtype=np.float32) - height / 2.0
+    images = []
+    for cam_num in range(len(CAM_NAMES)):
+        cam_theta = theta + math.radians(HFOV_DEG / 2.0 + step_deg * cam_num)
+        map_x = np.tile(focal_px * cam_theta + margin, (height, 1)).astype(np.float32)
+        map_y = (y_c[:, None] * np.cos(theta)[None, :] + scene_height / 2.0).astype(np.float32)
+        images.append(cv2.remap(scene, map_x, map_y, cv2.INTER_LINEAR))
+    return images, focal_px * math.radians(step_deg)
+
+def get_cyl_width(width=480, height=320):
+    ''' Return the width of a camera frame projected on the cylinder '''
+    focal_px = panostitch.get_focal_px(width, HFOV_DEG)
+    return panostitch.cylinder_maps(width, height, focal_px)[2].shape[1]
+
+class CylinderTest(unittest.TestCase):
+
+    def test_focal_px(self):
+        self.assertAlmostEqual(panostitch.get_focal_px(640, 90.0), 320.0)
+        self.assertAlmostEqual(panostitch.get_focal_px(1000, 60.0), 500.0 * math.sqrt(3))
+
+    def test_cylinder_maps(self):
+        focal_px = panostitch.get_focal_px(480, HFOV_DEG)
+        map_x, map_y, valid = panostitch.cylinder_maps(480, 320, focal_px)
+        cyl_width = int(2 * focal_px * math.atan(240.0 / focal_px))
+        self.assertEqual(map_x.shape, (320, cyl_width))
+        self.assertEqual(map_y.shape, (320, cyl_width))
+        self.assertEqual(map_x.dtype, np.float32)
+        # middle column is not bent and edges reach the frame edges
+        self.assertAlmostEqual(float(map_x[160, cyl_width // 2]), 240.0, delta=1.0)
+        self.assertAlmostEqual(float(map_y[0, cyl_width // 2]), 0.0, delta=1.0)
+        self.assertLess(float(map_x[160, 0]), 1.0)
+        self.assertGreater(float(map_x[160, -1]), 478.0)
+        # corners of the cylinder have no source pixels
+        self.assertEqual(valid[0, 0], 0)
+        self.assertEqual(valid[160, cyl_width // 2], 255)
+        self.assertTrue((map_y[0] <= map_y[0, cyl_width // 2] + 1e-3).all())
+
+class CalibrationTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.images, cls.shift = make_rig()
+
+    def test_pair_transform_recovers_shift(self):
+        focal_px = panostitch.get_focal_px(480, HFOV_DEG)
+        map_x, map_y, valid = panostitch.cylinder_maps(480, 320, focal_px)
+        left, right = [cv2.remap(image, map_x, map_y, cv2.INTER_LINEAR)
+                       for image in self.images[:2]]
+        pair, inlier_cnt = panostitch.estimate_pair_transform(left, right, valid, valid,
+                                                              0.5, 800, 2000, 20)
+        self.assertIsNotNone(pair)
+        self.assertGreaterEqual(inlier_cnt, 20)
+        self.assertAlmostEqual(pair[0, 2], self.shift, delta=2.0)
+        self.assertAlmostEqual(pair[1, 2], 0.0, delta=2.0)
+        self.assertAlmostEqual(pair[0, 0], 1.0, delta=0.01)
+
+    def test_calibration_chains_cameras(self):
+        calib = panostitch.estimate_calibration(CAM_NAMES, self.images, HFOV_DEG)
+        self.assertIsNotNone(calib)
+        self.assertEqual(calib['cameras'], CAM_NAMES)
+        self.assertEqual(calib['frame_size'], [480, 320])
+        transforms = np.array(calib['transforms'])
+        self.assertEqual(transforms.shape, (3, 2, 3))
+        for cam_num in (1, 2):
+            self.assertAlmostEqual(transforms[cam_num, 0, 2] - transforms[cam_num - 1, 0, 2],
+                                   self.shift, delta=2.0)
+        canvas_width, canvas_height = calib['canvas_size']
+        self.assertAlmostEqual(canvas_width, 2 * self.shift + get_cyl_width(), delta=40)
+        self.assertLessEqual(canvas_height, 320)
+
+    def test_calibration_fails_without_features(self):
+        blank = [np.full((320, 480, 3), 128, np.uint8) for cam_name in CAM_NAMES]
+        self.assertIsNone(panostitch.estimate_calibration(CAM_NAMES, blank, HFOV_DEG))
+
+    def test_calibration_needs_same_size_frames(self):
+        images = list(self.images)
+        images[1] = cv2.resize(images[1], (240, 160))
+        self.assertIsNone(panostitch.estimate_calibration(CAM_NAMES, images, HFOV_DEG))
+
+    def test_check_overlap(self):
+        pairs = panostitch.check_overlap(CAM_NAMES, self.images, HFOV_DEG)
+        self.assertEqual([(pair['left'], pair['right']) for pair in pairs],
+                         [('cam1', 'cam2'), ('cam2', 'cam3')])
+        cyl_width = get_cyl_width()
+        for pair in pairs:
+            self.assertGreaterEqual(pair['matches'], 4)
+            self.assertAlmostEqual(pair['overlap'], 1.0 - self.shift / cyl_width, delta=0.03)
+        blank = np.full((320, 480, 3), 128, np.uint8)
+        pairs = panostitch.check_overlap(CAM_NAMES[:2], [self.images[0], blank], HFOV_DEG)
+        self.assertEqual(pairs[0]['overlap'], 0.0)
+
+class RemapTablesTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.images, cls.shift = make_rig()
+        cls.calib = panostitch.estimate_calibration(CAM_NAMES, cls.images, HFOV_DEG)
+        cls.tables = panostitch.build_remap_tables(cls.calib)
+
+    def setUp(self):
+        self.tables_dir = os.path.join(tempfile.mkdtemp(prefix='tables-test-'), 'tables')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.tables_dir), ignore_errors=True)
+
+    def weight_canvas(self, tables):
+        canvas_width, canvas_height = self.calib['canvas_size']
+        weight_sum = np.zeros((canvas_height, canvas_width), np.int32)
+        for (x0, y0, x1, y1), map1, map2, weight in tables:
+            weight_sum[y0:y1, x0:x1] += weight
+        return weight_sum
+
+    def test_tables_cover_canvas(self):
+        self.assertEqual(len(self.tables), len(CAM_NAMES))
+        canvas_width, canvas_height = self.calib['canvas_size']
+        for (x0, y0, x1, y1), map1, map2, weight in self.tables:
+            self.assertTrue(0 <= x0 < x1 <= canvas_width)
+            self.assertTrue(0 <= y0 < y1 <= canvas_height)
+            self.assertEqual(map1.shape[:2], (y1 - y0, x1 - x0))
+            self.assertEqual(weight.shape, (y1 - y0, x1 - x0))
+            self.assertEqual(weight.dtype, np.uint8)
+        # feather weights add up to 255 wherever a camera covers the canvas
+        weight_sum = self.weight_canvas(self.tables)
+        self.assertTrue(np.isin(weight_sum, (0, 255)).all())
+        self.assertGreater((weight_sum == 255).mean(), 0.98)
+
+    def test_flat_images_compose_flat(self):
+        canvas_width, canvas_height = self.calib['canvas_size']
+        images = [np.full((320, 480, 3), 100, np.uint8) for cam_name in CAM_NAMES]
+        pano, overlaps = panostitch.compose_rows(self.tables, canvas_width, images, [0, 1, 2],
+                                                 None, 0, canvas_height, False, False)
+        covered = self.weight_canvas(self.tables) == 255
+        covered[[0, -1], :] = covered[:, [0, -1]] = False  # edge pixels blend with the border
+        self.assertEqual(pano.shape, (canvas_height, canvas_width, 3))
+        self.assertLessEqual(np.abs(pano[covered].astype(int) - 100).max(), 1)
+
+    def test_rig_images_line_up(self):
+        canvas_width, canvas_height = self.calib['canvas_size']
+        strips = []
+        for cam_num, ((x0, y0, x1, y1), map1, map2, weight) in enumerate(self.tables):
+            warped = cv2.remap(self.images[cam_num], map1, map2, cv2.INTER_LINEAR)
+            strips.append((cam_num, x0, y0, warped, weight))
+        overlaps = panostitch.measure_overlaps(strips, sample_step=2)
+        self.assertEqual([overlap[:2] for overlap in overlaps], [(0, 1), (1, 2)])
+        for cam_a, cam_b, count, sum_a, sum_b in overlaps:
+            # same scene so neighbours agree where they overlap
+            self.assertLess(np.abs(sum_a - sum_b).max() / count, 3.0)
+
+    def test_save_and_load(self):
+        panostitch.save_remap_tables(self.tables_dir, self.calib, self.tables)
+        tables = panostitch.load_remap_tables(self.tables_dir, self.calib)
+        self.assertEqual(len(tables), len(self.tables))
+        for saved, loaded in zip(self.tables, tables):
+            self.assertEqual(saved[0], loaded[0])
+            for saved_array, loaded_array in zip(saved[1:], loaded[1:]):
+                self.assertIsInstance(loaded_array, np.memmap)
+                np.testing.assert_array_equal(saved_array, loaded_array)
+
+    def test_load_rejects_other_calibration(self):
+        self.assertIsNone(panostitch.load_remap_tables(self.tables_dir, self.calib))
+        panostitch.save_remap_tables(self.tables_dir, self.calib, self.tables)
+        calib = dict(self.calib, canvas_size=[100, 100])
+        self.assertIsNone(panostitch.load_remap_tables(self.tables_dir, calib))
+        os.remove(os.path.join(self.tables_dir, 'cam1-map2.npy'))
+        self.assertIsNone(panostitch.load_remap_tables(self.tables_dir, self.calib))
+
+if __name__ == '__main__':
+    unittest.main()
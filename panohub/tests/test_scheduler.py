@@ -0,0 +1,62 @@
+'''
+panohub.py TimelapseScheduler tests. Deadlines are moved back instead
+of sleeping so late and missed triggers can be checked quickly.
+'''
+import os
+import sys
+import time
+import unittest
+
+PANOHUB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PANOHUB_DIR)
+
+import panohub
+
+class TimelapseSchedulerTest(unittest.TestCase):
+
+    def test_deadlines_do_not_drift(self):
+        scheduler = panohub.TimelapseScheduler(10)
+        first_deadline = scheduler.next_deadline
+        for fire_num in range(5):
+            scheduler.next_deadline -= 10  # fire a little after each deadline
+            scheduler.fire()
+            scheduler.next_deadline += 10
+        self.assertAlmostEqual(scheduler.next_deadline, first_deadline + 5 * 10, places=6)
+        self.assertEqual(scheduler.fired, 5)
+        self.assertEqual(scheduler.missed, 0)
+
+    def test_late_trigger_reports_lag(self):
+        scheduler = panohub.TimelapseScheduler(10)
+        scheduler.next_deadline = time.monotonic() - 3
+        lag = scheduler.fire()
+        self.assertGreaterEqual(lag, 3)
+        self.assertLess(lag, 4)
+        self.assertEqual(scheduler.missed, 0)
+        self.assertAlmostEqual(scheduler.time_to_next(), 7, delta=1)
+
+    def test_missed_triggers_are_skipped_and_counted(self):
+        scheduler = panohub.TimelapseScheduler(10)
+        scheduler.next_deadline = time.monotonic() - 25
+        scheduler.fire()
+        self.assertEqual(scheduler.fired, 1)
+        self.assertEqual(scheduler.missed, 2)
+        self.assertAlmostEqual(scheduler.time_to_next(), 5, delta=1)
+        scheduler.next_deadline = time.monotonic() - 10
+        scheduler.fire()
+        self.assertEqual(scheduler.missed, 3)
+        self.assertGreater(scheduler.next_deadline, time.monotonic())
+
+    def test_time_to_next_is_never_negative(self):
+        scheduler = panohub.TimelapseScheduler(10)
+        scheduler.next_deadline = time.monotonic() - 1
+        self.assertEqual(scheduler.time_to_next(), 0.0)
+        status = scheduler.status()
+        self.assertEqual(status['next_trigger_sec'], 0.0)
+        self.assertEqual(status['interval_sec'], 10)
+
+    def test_next_wall_time(self):
+        scheduler = panohub.TimelapseScheduler(30)
+        self.assertAlmostEqual(scheduler.next_wall_time(), time.time() + 30, delta=1)
+
+if __name__ == '__main__':
+    unittest.main()
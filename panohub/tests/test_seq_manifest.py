@@ -0,0 +1,113 @@
+'''
+panohub.py SeqManifest tests for the saved seq num, its recovery when
+a new manifest is made and moving a corrupt manifest aside.
+'''
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+PANOHUB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PANOHUB_DIR)
+
+import panohub
+
+class SeqManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='manifest-test-')
+        self.db_path = os.path.join(self.work_dir, 'panohub.db')
+        self.counter_path = os.path.join(self.work_dir, 'panohub.dat')
+        panohub.IMAGE_DIR = os.path.join(self.work_dir, 'media', 'timelapse')
+        panohub.IMAGE_PANO_DIR = os.path.join(self.work_dir, 'media', 'pano-images')
+        panohub.IMAGE_PREFIX = 'pano-tl-'
+        panohub.TIMELAPSE_SEQ_NUM_START = 1000
+        panohub.TIMELAPSE_SEQ_NUM_MAX = 0
+        panohub.TIMELAPSE_SEQ_NUM_RECYCLE_ON = False
+        os.makedirs(panohub.IMAGE_DIR)
+        os.makedirs(panohub.IMAGE_PANO_DIR)
+        self.manifests = []
+
+    def tearDown(self):
+        for manifest in self.manifests:
+            manifest.db.close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def open_manifest(self):
+        manifest = panohub.SeqManifest(self.db_path, self.counter_path, 1000)
+        self.manifests.append(manifest)
+        return manifest
+
+    def make_sequence(self, seq_num):
+        seq = panohub.Sequence(1700000000.0 + seq_num, 0.0)
+        seq.seq_num = seq_num
+        for rpi_name in ('cam1', 'cam2'):
+            seq.frames[rpi_name] = {'capture_time': seq.trigger_time, 'recv_time': seq.trigger_time,
+                                    'skew': 0.01, 'bytes': 100,
+                                    'image_path': 'pano-tl-%s-%i.jpg' % (rpi_name, seq_num)}
+        return seq
+
+    def touch(self, path):
+        with open(path, 'wb') as media_file:
+            media_file.write(b'\xff\xd8\xff\xd9')
+
+    def test_new_manifest_starts_at_seq_num_start(self):
+        self.assertEqual(self.open_manifest().next_seq_num(), 1000)
+
+    def test_seq_num_kept_after_restart(self):
+        manifest = self.open_manifest()
+        seq = self.make_sequence(1000)
+        manifest.record_sequence(seq, 1001, 2, False, True)
+        manifest.record_stitch(seq.manifest_id, 'pano-tl-1000.jpg', False, False, 1.5, True)
+        manifest.db.close()
+        self.manifests.remove(manifest)
+        manifest = self.open_manifest()
+        self.assertEqual(manifest.next_seq_num(), 1001)
+        self.assertEqual(manifest.db.execute('SELECT count(*) FROM frames').fetchone()[0], 2)
+        self.assertEqual(manifest.db.execute('SELECT stitch_ok FROM stitches').fetchone()[0], 1)
+
+    def test_reopened_sequence_replaces_its_rows(self):
+        manifest = self.open_manifest()
+        seq = self.make_sequence(1000)
+        manifest.record_sequence(seq, 1001, 3, True, True)
+        manifest_id = seq.manifest_id
+        seq.frames['cam3'] = dict(seq.frames['cam1'], image_path='pano-tl-cam3-1000.jpg')
+        manifest.record_sequence(seq, 1001, 3, False, True)
+        self.assertEqual(seq.manifest_id, manifest_id)
+        self.assertEqual(manifest.db.execute('SELECT count(*) FROM sequences').fetchone()[0], 1)
+        self.assertEqual(manifest.db.execute('SELECT count(*) FROM frames').fetchone()[0], 3)
+        self.assertEqual(manifest.db.execute('SELECT partial FROM sequences').fetchone()[0], 0)
+
+    def test_seq_num_migrated_from_counter_file(self):
+        with open(self.counter_path, 'w') as counter_file:
+            counter_file.write('1234')
+        self.assertEqual(self.open_manifest().next_seq_num(), 1234)
+        self.assertFalse(os.path.exists(self.counter_path))
+        self.assertTrue(os.path.exists(self.counter_path + '.migrated'))
+
+    def test_seq_num_recovered_from_newest_media(self):
+        with open(self.counter_path, 'w') as counter_file:
+            counter_file.write('not a number')
+        self.touch(os.path.join(panohub.IMAGE_DIR, 'pano-tl-cam1-1500.jpg'))
+        newest_path = os.path.join(panohub.IMAGE_PANO_DIR, 'pano-tl-1501-preview.jpg')
+        self.touch(newest_path)
+        os.utime(newest_path, (2000000000, 2000000000))
+        notes_path = os.path.join(panohub.IMAGE_PANO_DIR, 'notes.txt')
+        self.touch(notes_path)
+        os.utime(notes_path, (2000000100, 2000000100))  # newest but has no seq num
+        self.assertEqual(self.open_manifest().next_seq_num(), 1502)
+
+    def test_corrupt_manifest_moved_aside(self):
+        with open(self.db_path, 'wb') as db_file:
+            db_file.write(b'this is not a sqlite database' * 100)
+        with open(self.counter_path, 'w') as counter_file:
+            counter_file.write('1100')
+        manifest = self.open_manifest()
+        self.assertEqual(manifest.next_seq_num(), 1100)
+        corrupt_names = [name for name in os.listdir(self.work_dir) if '.corrupt-' in name]
+        self.assertEqual(len(corrupt_names), 1)
+        self.assertEqual(manifest.db.execute('PRAGMA quick_check').fetchone()[0], 'ok')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+'''
+panohub.py StitchQueue tests. The stitch function waits on an event so
+jobs pile up in the queue and each overflow policy can be checked.
+'''
+import os
+import sys
+import threading
+import time
+import unittest
+
+PANOHUB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PANOHUB_DIR)
+
+import panohub
+
+class StitchQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        panohub.HUB_METRICS = panohub.HubMetrics(100)
+        self.release = threading.Event()
+        self.started = []
+        self.stitched = []
+        self.dropped = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.release.set()
+
+    def stitch(self, seq_num):
+        with self.lock:
+            self.started.append(seq_num)
+        self.release.wait(10)
+        with self.lock:
+            self.stitched.append(seq_num)
+
+    def make_queue(self, overflow, max_depth=2):
+        stitch_queue = panohub.StitchQueue(self.stitch, 1, max_depth, overflow)
+        stitch_queue.on_drop = lambda job: self.dropped.append(job[0])
+        return stitch_queue
+
+    def wait_started(self, count):
+        end_time = time.time() + 5
+        while len(self.started) < count and time.time() < end_time:
+            time.sleep(0.01)
+        self.assertEqual(len(self.started), count)
+
+    def test_drop_oldest(self):
+        stitch_queue = self.make_queue('drop_oldest')
+        stitch_queue.put(1)
+        self.wait_started(1)
+        self.assertTrue(stitch_queue.put(2))
+        self.assertTrue(stitch_queue.put(3))
+        self.assertTrue(stitch_queue.put(4))
+        self.assertEqual(self.dropped, [2])
+        self.assertEqual(stitch_queue.dropped, 1)
+        self.assertEqual(stitch_queue.depth(), 2)
+        self.release.set()
+        self.assertTrue(stitch_queue.join(5))
+        self.assertEqual(self.stitched, [1, 3, 4])
+
+    def test_drop_newest(self):
+        stitch_queue = self.make_queue('drop_newest')
+        stitch_queue.put(1)
+        self.wait_started(1)
+        self.assertTrue(stitch_queue.put(2))
+        self.assertTrue(stitch_queue.put(3))
+        self.assertFalse(stitch_queue.put(4))
+        self.assertEqual(self.dropped, [4])
+        self.release.set()
+        self.assertTrue(stitch_queue.join(5))
+        self.assertEqual(self.stitched, [1, 2, 3])
+
+    def test_block_waits_for_a_worker(self):
+        stitch_queue = self.make_queue('block', max_depth=1)
+        stitch_queue.put(1)
+        self.wait_started(1)
+        stitch_queue.put(2)
+        put_done = threading.Event()
+
+        def put_blocked():
+            stitch_queue.put(3)
+            put_done.set()
+
+        threading.Thread(target=put_blocked, daemon=True).start()
+        self.assertFalse(put_done.wait(0.3))
+        self.release.set()
+        self.assertTrue(put_done.wait(5))
+        self.assertTrue(stitch_queue.join(5))
+        self.assertEqual(self.stitched, [1, 2, 3])
+        self.assertEqual(self.dropped, [])
+
+    def test_not_valid_policy_uses_drop_oldest(self):
+        stitch_queue = self.make_queue('drop_random')
+        self.assertEqual(stitch_queue.overflow, 'drop_oldest')
+
+    def test_background_jobs_run_after_normal_jobs(self):
+        stitch_queue = self.make_queue('drop_oldest')
+        stitch_queue.put(1)
+        self.wait_started(1)
+        self.assertTrue(stitch_queue.put_background(10))
+        self.assertTrue(stitch_queue.put_background(11))
+        self.assertFalse(stitch_queue.put_background(12))
+        stitch_queue.put(2)
+        self.assertEqual(self.dropped, [10])
+        self.assertEqual(stitch_queue.background_depth(), 2)
+        self.assertEqual(stitch_queue.depth(), 3)
+        self.release.set()
+        self.assertTrue(stitch_queue.join(5))
+        self.assertEqual(self.stitched, [1, 2, 11, 12])
+
+    def test_join_timeout_and_abandon(self):
+        stitch_queue = self.make_queue('drop_oldest')
+        stitch_queue.put(1)
+        self.wait_started(1)
+        stitch_queue.put(2)
+        stitch_queue.put_background(10)
+        self.assertEqual(stitch_queue.pending(), 3)
+        self.assertFalse(stitch_queue.join(0.2))
+        self.assertEqual(sorted(job[0] for job in stitch_queue.abandon()), [1, 2, 10])
+        self.assertEqual(stitch_queue.depth(), 0)
+        self.release.set()
+        self.assertTrue(stitch_queue.join(5))
+        self.assertEqual(self.stitched, [1])
+
+    def test_failed_job_does_not_stop_worker(self):
+        stitch_queue = panohub.StitchQueue(self.fail_stitch, 1, 2, 'drop_oldest')
+        self.release.set()
+        stitch_queue.put(1)
+        stitch_queue.put(2)
+        self.assertTrue(stitch_queue.join(5))
+        self.assertEqual(self.stitched, [2])
+
+    def fail_stitch(self, seq_num):
+        if seq_num == 1:
+            raise RuntimeError('stitch failed')
+        self.stitch(seq_num)
+
+if __name__ == '__main__':
+    unittest.main()
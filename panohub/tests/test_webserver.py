@@ -0,0 +1,299 @@
+'''
+webserver.py tests. Each test runs webserver.py as a separate
+process from a copy in a temporary folder with its own panohub.yaml
+since webserver.py starts serving when it is run.
+'''
+import base64
+import http.client
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import urllib.request
+
+import cv2
+import numpy as np
+
+PANOHUB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def get_free_port():
+    ''' Return a tcp port nothing is listening on '''
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class WebServerTestCase(unittest.TestCase):
+    '''
+    Run webserver.py on a free port with media/timelapse as a frame
+    folder. settings are panohub.yaml lines to replace.
+    '''
+    settings = {'web_preview_on : True': 'web_preview_on : False'}
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='webserver-test-')
+        shutil.copy(os.path.join(PANOHUB_DIR, 'webserver.py'), self.work_dir)
+        with open(os.path.join(PANOHUB_DIR, 'panohub.yaml')) as yaml_file:
+            settings = yaml_file.read()
+        self.port = get_free_port()
+        settings = settings.replace('web_server_port : 8080', 'web_server_port : %i' % self.port)
+        for old, new in self.settings.items():
+            settings = settings.replace(old, new)
+        with open(os.path.join(self.work_dir, 'panohub.yaml'), 'w') as yaml_file:
+            yaml_file.write(settings)
+        self.frame_dir = os.path.join(self.work_dir, 'media', 'timelapse')
+        os.makedirs(self.frame_dir)
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.kill()
+            self.server.wait()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def start_server(self):
+        self.server = subprocess.Popen([sys.executable, 'webserver.py'], cwd=self.work_dir,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        end_time = time.time() + 20
+        while time.time() < end_time:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 0.5).close()
+                return
+            except OSError:
+                if self.server.poll() is not None:
+                    self.fail('webserver.py exited %s' % self.server.stderr.read().decode())
+                time.sleep(0.1)
+        self.fail('webserver.py did not start listening on port %i' % self.port)
+
+    def make_frames(self, frame_cnt):
+        for frame_num in range(frame_cnt):
+            with open(os.path.join(self.frame_dir, 'pano-tl-cam1-%i.jpg' % frame_num), 'wb') as frame:
+                frame.write(b'\xff\xd8\xff\xd9')
+
+    def make_image(self, name, width=640, height=320):
+        ''' Save a real jpeg that opencv can read and return its path '''
+        image = np.zeros((height, width, 3), dtype='uint8')
+        cv2.rectangle(image, (width // 4, height // 4), (width // 2, height // 2), (0, 200, 255), -1)
+        image_path = os.path.join(self.frame_dir, name)
+        cv2.imwrite(image_path, image)
+        return image_path
+
+    def get(self, path):
+        with urllib.request.urlopen('http://127.0.0.1:%i%s' % (self.port, path),
+                                    timeout=10) as response:
+            return response.status, response.read().decode('utf-8')
+
+    def request(self, path, headers=None):
+        ''' Return status, headers and body bytes of a GET including 304 and 4xx replies '''
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        try:
+            conn.request('GET', path, headers=headers or {})
+            response = conn.getresponse()
+            return response.status, response, response.read()
+        finally:
+            conn.close()
+
+class ListDirectoryTest(WebServerTestCase):
+
+    def test_list_more_than_one_page(self):
+        self.make_frames(151)
+        self.start_server()
+        status, body = self.get('/timelapse/')
+        self.assertEqual(status, 200)
+        self.assertIn('var nextCursor = ', body)
+        self.assertNotIn('var nextCursor = null', body)
+
+    def test_list_one_page(self):
+        self.make_frames(5)
+        self.start_server()
+        status, body = self.get('/timelapse/')
+        self.assertEqual(status, 200)
+        self.assertNotIn('var nextCursor', body)
+
+class ApiListTest(WebServerTestCase):
+
+    def get_page(self, cursor=None, limit=7):
+        path = '/api/list?path=/timelapse/&limit=%i' % limit
+        if cursor is not None:
+            path += '&cursor=' + cursor
+        status, response, body = self.request(path)
+        return status, json.loads(body.decode('utf-8')) if status == 200 else None
+
+    def make_cursor(self, sort_key):
+        return base64.urlsafe_b64encode(json.dumps(sort_key).encode('utf-8')).decode('ascii')
+
+    def test_pages_list_each_file_once(self):
+        self.make_frames(20)
+        self.start_server()
+        names = []
+        cursor = None
+        for page_num in range(10):
+            status, page = self.get_page(cursor)
+            self.assertEqual(status, 200)
+            self.assertEqual(page['total'], 20)
+            names.extend(entry['name'] for entry in page['entries'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(page_num, 2)
+        self.assertEqual(sorted(names), sorted(os.listdir(self.frame_dir)))
+
+    def test_files_added_between_pages_do_not_shift_pages(self):
+        self.make_frames(10)
+        self.start_server()
+        status, first = self.get_page(limit=5)
+        with open(os.path.join(self.frame_dir, 'pano-tl-new.jpg'), 'wb') as frame:
+            frame.write(b'\xff\xd8\xff\xd9')
+        status, second = self.get_page(first['next_cursor'], limit=5)
+        self.assertEqual(status, 200)
+        names = [entry['name'] for entry in first['entries'] + second['entries']]
+        self.assertEqual(len(set(names)), 10)
+        self.assertNotIn('pano-tl-new.jpg', names)
+
+    def test_cursor_past_last_file(self):
+        self.make_frames(3)
+        self.start_server()
+        status, page = self.get_page(self.make_cursor([0.0, '']))
+        self.assertEqual(status, 200)
+        self.assertEqual(page['entries'], [])
+        self.assertIsNone(page['next_cursor'])
+
+    def test_bad_cursors(self):
+        self.make_frames(3)
+        self.start_server()
+        for cursor in ('not-base64!', self.make_cursor({'a': 1}), self.make_cursor([1.0]),
+                       self.make_cursor(['pano', 'pano']), self.make_cursor([1.0, 5]),
+                       self.make_cursor([True, 'pano']), self.make_cursor([float('nan'), 'pano'])):
+            status, page = self.get_page(cursor)
+            self.assertEqual(status, 400, cursor)
+        status, page = self.get_page(limit=5)
+        self.assertEqual(status, 200)
+
+class SendFileTest(WebServerTestCase):
+
+    def setUp(self):
+        WebServerTestCase.setUp(self)
+        self.data = bytes(range(256)) * 4
+        with open(os.path.join(self.frame_dir, 'pano-tl-1.jpg'), 'wb') as frame:
+            frame.write(self.data)
+        self.start_server()
+
+    def test_validators_and_not_modified(self):
+        status, response, body = self.request('/timelapse/pano-tl-1.jpg')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, self.data)
+        self.assertEqual(response.getheader('Accept-Ranges'), 'bytes')
+        etag = response.getheader('ETag')
+        last_modified = response.getheader('Last-Modified')
+        self.assertTrue(etag.startswith('"'))
+        status, response, body = self.request('/timelapse/pano-tl-1.jpg', {'If-None-Match': etag})
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b'')
+        self.assertEqual(response.getheader('ETag'), etag)
+        status, response, body = self.request('/timelapse/pano-tl-1.jpg',
+                                              {'If-Modified-Since': last_modified})
+        self.assertEqual(status, 304)
+        status, response, body = self.request('/timelapse/pano-tl-1.jpg',
+                                              {'If-None-Match': '"other"',
+                                               'If-Modified-Since': last_modified})
+        self.assertEqual(status, 200)
+        self.assertEqual(body, self.data)
+
+    def test_changed_file_gets_new_etag(self):
+        status, first, body = self.request('/timelapse/pano-tl-1.jpg')
+        file_path = os.path.join(self.frame_dir, 'pano-tl-1.jpg')
+        with open(file_path, 'ab') as frame:
+            frame.write(b'more')
+        status, response, body = self.request('/timelapse/pano-tl-1.jpg',
+                                              {'If-None-Match': first.getheader('ETag')})
+        self.assertEqual(status, 200)
+        self.assertEqual(len(body), len(self.data) + 4)
+
+    def test_ranges(self):
+        status, response, body = self.request('/timelapse/pano-tl-1.jpg', {'Range': 'bytes=10-19'})
+        self.assertEqual(status, 206)
+        self.assertEqual(body, self.data[10:20])
+        self.assertEqual(response.getheader('Content-Range'), 'bytes 10-19/1024')
+        status, response, body = self.request('/timelapse/pano-tl-1.jpg', {'Range': 'bytes=1000-'})
+        self.assertEqual(status, 206)
+        self.assertEqual(body, self.data[1000:])
+        status, response, body = self.request('/timelapse/pano-tl-1.jpg', {'Range': 'bytes=-24'})
+        self.assertEqual(status, 206)
+        self.assertEqual(body, self.data[-24:])
+        self.assertEqual(response.getheader('Content-Range'), 'bytes 1000-1023/1024')
+        status, response, body = self.request('/timelapse/pano-tl-1.jpg',
+                                              {'Range': 'bytes=1020-5000'})
+        self.assertEqual(status, 206)
+        self.assertEqual(body, self.data[1020:])
+
+    def test_unsatisfiable_and_ignored_ranges(self):
+        status, response, body = self.request('/timelapse/pano-tl-1.jpg', {'Range': 'bytes=2000-'})
+        self.assertEqual(status, 416)
+        self.assertEqual(response.getheader('Content-Range'), 'bytes */1024')
+        for range_header in ('bytes=0-1,5-6', 'bytes=20-10', 'lines=1-2', 'bytes=a-b'):
+            status, response, body = self.request('/timelapse/pano-tl-1.jpg',
+                                                  {'Range': range_header})
+            self.assertEqual(status, 200, range_header)
+            self.assertEqual(body, self.data)
+
+    def test_if_range(self):
+        status, response, body = self.request('/timelapse/pano-tl-1.jpg')
+        etag = response.getheader('ETag')
+        status, response, body = self.request('/timelapse/pano-tl-1.jpg',
+                                              {'Range': 'bytes=0-9', 'If-Range': etag})
+        self.assertEqual(status, 206)
+        self.assertEqual(body, self.data[:10])
+        status, response, body = self.request('/timelapse/pano-tl-1.jpg',
+                                              {'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+        self.assertEqual(status, 200)
+        self.assertEqual(body, self.data)
+
+    def test_missing_file(self):
+        status, response, body = self.request('/timelapse/pano-tl-2.jpg')
+        self.assertEqual(status, 404)
+
+class ThumbCacheTest(WebServerTestCase):
+    settings = {}  # previews on so the thumb cache is made
+
+    def test_thumb_is_reduced(self):
+        self.make_image('pano-tl-1.jpg')
+        self.start_server()
+        status, response, body = self.request('/timelapse/pano-tl-1.jpg?thumb')
+        self.assertEqual(status, 200)
+        image = cv2.imdecode(np.frombuffer(body, dtype='uint8'), cv2.IMREAD_COLOR)
+        self.assertEqual(image.shape[1], 240)
+
+    def test_thumb_validators_stable_across_hits(self):
+        self.make_image('pano-tl-1.jpg')
+        self.start_server()
+        status, first, body = self.request('/timelapse/pano-tl-1.jpg?thumb')
+        self.assertEqual(status, 200)
+        time.sleep(0.05)
+        status, second, body = self.request('/timelapse/pano-tl-1.jpg?thumb')
+        self.assertEqual(status, 200)
+        self.assertEqual(first.getheader('ETag'), second.getheader('ETag'))
+        self.assertEqual(first.getheader('Last-Modified'), second.getheader('Last-Modified'))
+        status, response, body = self.request('/timelapse/pano-tl-1.jpg?thumb',
+                                              {'If-None-Match': first.getheader('ETag')})
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b'')
+
+    def test_changed_image_gets_new_thumb(self):
+        image_path = self.make_image('pano-tl-1.jpg')
+        self.start_server()
+        status, first, body = self.request('/timelapse/pano-tl-1.jpg?thumb')
+        self.make_image('pano-tl-1.jpg', width=800)
+        os.utime(image_path, (time.time() + 5, time.time() + 5))
+        status, response, body = self.request('/timelapse/pano-tl-1.jpg?thumb',
+                                              {'If-None-Match': first.getheader('ETag')})
+        self.assertEqual(status, 200)
+        self.assertNotEqual(response.getheader('ETag'), first.getheader('ETag'))
+
+if __name__ == '__main__':
+    unittest.main()
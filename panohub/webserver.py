@@ -1,6 +1,6 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 '''
- SimpleHTTPServer python program to allow selection of images from right panel and display in an iframe left panel
+ http.server python3 program to allow selection of images from right panel and display in an iframe left panel
  Use for local network use only since this is not guaranteed to be a secure web server.
  based on original code by zeekay and modified by Claude Pageau Nov-2015 for use with pi-timolo.py on a Raspberry Pi
  from http://stackoverflow.com/questions/8044873/python-how-to-override-simplehttpserver-to-show-timestamp-in-directory-listing
@@ -23,20 +23,27 @@
 
  Variable Settings are imported from config.py
 '''
-from __future__ import print_function
 print('webserver: Loading ...')
-import cgi
+import base64
+import binascii
+import bisect
+import collections
+import email.utils
+import hashlib
+import html
+import io
+import json
+import math
 import os
-import subprocess
 import socket
+import sqlite3
 import fcntl
 import struct
-import SocketServer
 import sys
+import threading
 import time
-import urllib
-from SimpleHTTPServer import SimpleHTTPRequestHandler
-from StringIO import StringIO
+import urllib.parse
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 try:
     import yaml
 except ImportError:
@@ -48,6 +55,10 @@ except ImportError:
 
     ''')
     sys.exit(1)
+try:
+    import cv2
+except ImportError:
+    cv2 = None  # image previews and thumbnails are turned off
 
 PROG_VER = "ver 0.5 written by Claude Pageau"
 
@@ -58,6 +69,34 @@ PROG_NAME = os.path.basename(__file__)    # Name of this program
 
 YAML_FILEPATH = './panohub.yaml'
 YAML_SECTION_NAME = 'webserver_settings'
+YAML_PANOHUB_SECTION_NAME = 'panohub_settings'
+
+# Default panohub settings in case older panohub.yaml does not have them
+IMAGE_PREFIX = 'pano-tl-'
+PREVIEW_REQUEST_DIR = './fullres-requests'
+PREVIEW_SUFFIX = '-preview'  # panohub adds this to preview pano file names
+HUB_STATUS_FILEPATH = './panohub-status.json'
+SEQ_MANIFEST_FILEPATH = './panohub-manifest.db'
+web_list_cache_sec = 10  # defaults in case older panohub.yaml does not have them
+web_list_cache_dirs = 32
+web_list_page_size = 100
+web_status_sec = 15
+web_preview_on = True
+web_preview_width = 1280
+web_thumb_width = 240
+web_list_thumbs = False
+web_thumb_cache_dir = './thumb-cache'
+web_thumb_cache_mb = 100
+web_thumb_quality = 80
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png')  # files that get previews and thumbnails
+API_LIST_MAX_LIMIT = 1000  # most entries returned by one /api/list request
+API_SEQ_MAX_LIMIT = 200  # most sequences returned by one /api/sequences request
+
+# One cached directory entry. mtime and size are from the os.scandir pass.
+# seq, camera and preview are parsed from panohub media file names
+ListEntry = collections.namedtuple('ListEntry',
+                                   'name is_dir is_link mtime size seq camera preview')
 
 #---------------------------------------------------------------
 def read_yaml_file(yaml_file_path, yaml_section_name):
@@ -105,51 +144,752 @@ def get_ip_address(ifname):
         return None
 
 #-------------------------------------------------------------------------------
-def df(drive_mnt):
+def human_size(num_bytes):
+    ''' Return num_bytes as a short string like df -h eg 12G '''
+    for unit in ('B', 'K', 'M', 'G'):
+        if num_bytes < 1024:
+            break
+        num_bytes /= 1024.0
+    else:
+        unit = 'T'
+    if num_bytes < 10 and unit != 'B':
+        return '%.1f%s' % (num_bytes, unit)
+    return '%i%s' % (num_bytes, unit)
+
+#-------------------------------------------------------------------------------
+class StatusSampler(object):
     '''
-       function to read disk drive data using unix df command
-       for the specified mount point.
-       Returns a formatted string of Disk Status
+    Disk, system and panohub status sampled every interval_sec by a
+    background thread. Disk use is read with os.statvfs and hub state
+    from the status json file panohub.py saves. Requests only read the
+    latest sample from memory so no process is spawned per page view.
     '''
+    def __init__(self, drive_path, hub_status_path, interval_sec=15):
+        self.drive_path = drive_path
+        self.hub_status_path = hub_status_path
+        self.interval_sec = max(1, interval_sec)
+        self.lock = threading.Lock()
+        self.hub_status_mtime = None
+        self.hub_status = None
+        self.status = {}
+        self.sample()
+        thread = threading.Thread(target=self._run, name='StatusSampler')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval_sec)
+            self.sample()
+
+    def sample(self):
+        ''' Read disk, load and hub status into a new status dict '''
+        status = {'sampled': time.time()}
+        try:
+            stat = os.statvfs(self.drive_path)
+            total = stat.f_blocks * stat.f_frsize
+            avail = stat.f_bavail * stat.f_frsize
+            used = total - stat.f_bfree * stat.f_frsize
+            status['disk'] = {'path': self.drive_path,
+                              'total_bytes': total,
+                              'used_bytes': used,
+                              'avail_bytes': avail,
+                              'used_percent': round(100.0 * used / max(1, used + avail), 1)}
+        except OSError:
+            status['disk'] = None
+        try:
+            status['load'] = os.getloadavg()
+        except OSError:
+            status['load'] = None
+        try:
+            hub_status_mtime = os.stat(self.hub_status_path).st_mtime_ns
+            if hub_status_mtime != self.hub_status_mtime:
+                with open(self.hub_status_path) as f:
+                    self.hub_status = json.load(f)
+                self.hub_status_mtime = hub_status_mtime
+        except (IOError, OSError, ValueError):
+            self.hub_status = None
+            self.hub_status_mtime = None
+        status['hub'] = self.hub_status
+        with self.lock:
+            self.status = status
+
+    def get(self):
+        ''' Return the latest status sample '''
+        with self.lock:
+            return self.status
+
+    def drive_status(self):
+        ''' Return a formatted string of disk status '''
+        disk = self.get().get('disk')
+        if disk is None:
+            return "No drive status avail"
+        return ("Drive [ %s ] Space_Used [ %s%% %s of %s ] Space_Avail [ %s ]" %
+                (disk['path'], disk['used_percent'], human_size(disk['used_bytes']),
+                 human_size(disk['total_bytes']), human_size(disk['avail_bytes'])))
+
+    def hub_summary(self):
+        ''' Return a formatted string of panohub status '''
+        hub = self.get().get('hub')
+        if not hub:
+            return "panohub Status Not Avail"
+        summary = "panohub Next Seq [ %s ]" % hub.get('image_seq_num')
+        if hub.get('last_stitch_sec') is not None:
+            summary += " Last Stitch [ Seq %s %.1f sec %s ]" % (
+                hub.get('last_stitch_seq'), hub['last_stitch_sec'],
+                'OK' if hub.get('last_stitch_ok') else 'Failed')
+        summary += " Stitch Queue [ %s ]" % hub.get('stitch_queue_depth', 0)
+        if time.time() - hub.get('updated', 0) > 3 * hub.get('schedule', {}).get('interval_sec', 60):
+            summary += " Not Updated Since %s" % time.strftime(
+                '%H:%M:%S %d-%b-%Y', time.localtime(hub.get('updated', 0)))
+        return summary
+
+# Loads the next /api/list page into the right panel list when scrolled near the end
+LAZY_LIST_SCRIPT = '''<script>
+var listPath = %s;
+var nextCursor = %s;
+var listLoading = false;
+function loadListPage() {
+    var pane = document.getElementById('listpane');
+    if (nextCursor === null || listLoading ||
+        pane.scrollTop + pane.clientHeight < pane.scrollHeight - 200) {
+        return;
+    }
+    listLoading = true;
+    fetch('/api/list?html=1&path=' + encodeURIComponent(listPath) +
+          '&cursor=' + encodeURIComponent(nextCursor))
+        .then(function (response) { return response.json(); })
+        .then(function (page) {
+            var menu = document.getElementById('menu');
+            page.entries.forEach(function (entry) {
+                menu.insertAdjacentHTML('beforeend', entry.html);
+            });
+            nextCursor = page.next_cursor;
+            listLoading = false;
+            loadListPage();
+        })
+        .catch(function () { listLoading = false; });
+}
+document.getElementById('listpane').addEventListener('scroll', loadListPage);
+loadListPage();
+</script>'''
+
+#-------------------------------------------------------------------------------
+def read_manifest(db_path, seq_num=None, before_id=None, limit=20):
+    '''
+    Return the newest panohub manifest sequences with their frames and
+    stitch results, newest first. seq_num selects sequences with that
+    seq num and before_id continues from the previous page. The manifest
+    is opened read only so panohub can keep writing.
+    '''
+    db = sqlite3.connect('file:%s?mode=ro' % urllib.parse.quote(db_path), uri=True)
+    db.row_factory = sqlite3.Row
     try:
-        df = subprocess.Popen(["df", "-h", drive_mnt], stdout=subprocess.PIPE)
-        output = df.communicate()[0]
-        device, size, used, available, percent, mountpoint = output.split("\n")[1].split()
-        drive_status = ("Drive [ %s ] Mount_Point [ %s ] Space_Used [ %s %s of %s ] Space_Avail [ %s ]" %
-                        (device, mountpoint, percent, used, size, available))
-    except:
-        drive_status = "df command Error. No drive status avail"
-    return drive_status
+        where, args = [], []
+        if seq_num is not None:
+            where.append('seq_num = ?')
+            args.append(seq_num)
+        if before_id is not None:
+            where.append('id < ?')
+            args.append(before_id)
+        sql = 'SELECT * FROM sequences'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        rows = db.execute(sql + ' ORDER BY id DESC LIMIT ?', args + [limit]).fetchall()
+        sequences = []
+        for row in rows:
+            sequence = dict(row)
+            sequence['frames'] = [dict(frame) for frame in db.execute(
+                'SELECT camera, rendition, capture_time, recv_time, skew, bytes, image_path'
+                ' FROM frames WHERE sequence_id = ? ORDER BY rendition, camera', (row['id'],))]
+            sequence['stitches'] = [dict(stitch) for stitch in db.execute(
+                'SELECT pano_path, preview, partial, stitch_sec, stitch_ok, stitch_time,'
+                ' skip_reason FROM stitches WHERE sequence_id = ? ORDER BY stitch_time', (row['id'],))]
+            sequences.append(sequence)
+        next_seq_num = db.execute('SELECT next_seq_num FROM counter').fetchone()
+    finally:
+        db.close()
+    return {'next_seq_num': next_seq_num[0] if next_seq_num else None,
+            'sequences': sequences,
+            'next_before': rows[-1]['id'] if len(rows) == limit else None}
+
+#-------------------------------------------------------------------------------
+def parse_media_name(name):
+    '''
+    Return seq num, camera name and preview flag parsed from a panohub
+    media file name eg pano-tl-1001.jpg or pano-tl-rpi-thing1-1001-preview.jpg
+    Stitched panos have no camera. seq num and camera are None if not found.
+    '''
+    name_root = os.path.splitext(name)[0]
+    if not name_root.startswith(IMAGE_PREFIX):
+        return None, None, False
+    name_root = name_root[len(IMAGE_PREFIX):]
+    preview = name_root.endswith(PREVIEW_SUFFIX)
+    if preview:
+        name_root = name_root[:-len(PREVIEW_SUFFIX)]
+    if name_root.isdigit():
+        return int(name_root), None, preview
+    camera, sep, seq_num = name_root.rpartition('-')
+    if camera and seq_num.isdigit():
+        return int(seq_num), camera, preview
+    return None, None, preview
+
+#-------------------------------------------------------------------------------
+def get_sort_key(entry):
+    ''' Return the listing sort key of a ListEntry per web_list_by_datetime '''
+    if web_list_by_datetime:
+        return [entry.mtime, entry.name]
+    return [entry.name.lower(), entry.name]
+
+#-------------------------------------------------------------------------------
+def encode_cursor(sort_key):
+    ''' Return an opaque url safe listing cursor for a sort key '''
+    return base64.urlsafe_b64encode(json.dumps(sort_key).encode('utf-8')).decode('ascii')
+
+#-------------------------------------------------------------------------------
+def decode_cursor(cursor):
+    '''
+    Return the sort key of a listing cursor. Raises ValueError if not
+    valid or its key types do not match get_sort_key, since comparing
+    them with the listing keys would raise TypeError.
+    '''
+    try:
+        sort_key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (TypeError, UnicodeError, binascii.Error) as err_msg:
+        raise ValueError(err_msg)
+    if not isinstance(sort_key, list) or len(sort_key) != 2:
+        raise ValueError('cursor is not a sort key')
+    first, name = sort_key
+    if web_list_by_datetime:
+        valid = (isinstance(first, (int, float)) and not isinstance(first, bool) and
+                 math.isfinite(first))
+    else:
+        valid = isinstance(first, str)
+    if not valid or not isinstance(name, str):
+        raise ValueError('cursor does not match the listing sort')
+    return sort_key
+
+#-------------------------------------------------------------------------------
+class Listing(object):
+    '''
+    Cached index of one directory. entries are in display order per
+    web_list_by_datetime and web_list_sort_descending. Pages start after
+    a cursor holding the sort key of the last entry already shown, so
+    files added or removed between requests do not shift the pages.
+    '''
+    def __init__(self, entries):
+        self.ascending = sorted(entries, key=get_sort_key)
+        self.keys = [get_sort_key(entry) for entry in self.ascending]
+        self.entries = self.ascending[::-1] if web_list_sort_descending else self.ascending
+        self.names = set(entry.name for entry in entries)
+
+    def page(self, sort_key=None, limit=100, max_entries=0):
+        '''
+        Return up to limit entries in display order following sort_key
+        and the sort key to continue from or None at the end.
+        max_entries above 1 caps the number of entries listed in total.
+        '''
+        if web_list_sort_descending:
+            end = len(self.keys) if sort_key is None else bisect.bisect_left(self.keys, sort_key)
+            shown = len(self.keys) - end
+        else:
+            start = 0 if sort_key is None else bisect.bisect_right(self.keys, sort_key)
+            shown = start
+        if max_entries > 1:
+            limit = min(limit, max_entries - shown)
+        if limit <= 0:
+            return [], None
+        if web_list_sort_descending:
+            start = max(0, end - limit)
+            entries = self.ascending[start:end][::-1]
+            more = start > 0
+        else:
+            end = start + limit
+            entries = self.ascending[start:end]
+            more = end < len(self.ascending)
+        if max_entries > 1 and shown + len(entries) >= max_entries:
+            more = False
+        if not more or not entries:
+            return entries, None
+        return entries, get_sort_key(entries[-1])
+
+#-------------------------------------------------------------------------------
+def get_jpeg_width(image_path):
+    '''
+    Return the pixel width of a jpeg read from its SOF header
+    without decoding the image. Returns None if not a readable jpeg.
+    '''
+    try:
+        with open(image_path, 'rb') as f:
+            if f.read(2) != b'\xff\xd8':
+                return None
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xff:
+                    return None
+                seg_len = struct.unpack('>H', f.read(2))[0]
+                # SOF0 to SOF15 except DHT, JPG and DAC markers
+                if 0xc0 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8, 0xcc):
+                    return struct.unpack('>xHH', f.read(5))[1]
+                f.seek(seg_len - 2, 1)
+    except (IOError, OSError, struct.error):
+        return None
+
+#-------------------------------------------------------------------------------
+class ThumbCache(object):
+    '''
+    Reduced size jpeg copies of images kept in cache_dir up to max_bytes.
+    Copies are named by a hash of image path, mtime, size and width so a
+    changed image gets a new copy. Least recently used copies are removed
+    first. A cache hit sets the access time of the copy so the order
+    survives restarts. Its mtime is left alone since the ETag and
+    Last-Modified validators of the copy are made from it.
+    Jpegs are decoded at 1/2, 1/4 or 1/8 scale by libjpeg where possible.
+    '''
+    def __init__(self, cache_dir, max_bytes, quality=80):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.lock = threading.Lock()
+        self.copies = collections.OrderedDict()  # copy file name: bytes. Oldest used first
+        self.total_bytes = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with os.scandir(cache_dir) as dir_entries:
+            stats = [(dir_entry.name, dir_entry.stat()) for dir_entry in dir_entries
+                     if dir_entry.is_file() and dir_entry.name.endswith('.jpg')]
+        for name, stat in sorted(stats, key=lambda item: item[1].st_atime):
+            self.copies[name] = stat.st_size
+            self.total_bytes += stat.st_size
+        with self.lock:
+            self.evict()
+
+    def get(self, image_path, width):
+        '''
+        Return the path of a copy of image_path at most width px wide.
+        The copy is made on the first request. Returns None if
+        the image can not be read.
+        '''
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+        key = ('%s|%i|%i|%i' % (image_path, stat.st_mtime_ns, stat.st_size, width))
+        name = hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest() + '.jpg'
+        copy_path = os.path.join(self.cache_dir, name)
+        with self.lock:
+            hit = name in self.copies
+            if hit:
+                self.copies.move_to_end(name)
+        if hit:
+            try:
+                os.utime(copy_path, ns=(time.time_ns(), os.stat(copy_path).st_mtime_ns))
+                return copy_path
+            except OSError:
+                pass  # removed outside the cache so make it again
+        image = self.read_reduced(image_path, width)
+        if image is None:
+            return None
+        height, image_width = image.shape[:2]
+        if image_width > width:
+            image = cv2.resize(image, (width, height * width // image_width),
+                               interpolation=cv2.INTER_AREA)
+        ret_code, jpg_buffer = cv2.imencode('.jpg', image,
+                                            [int(cv2.IMWRITE_JPEG_QUALITY), self.quality])
+        if not ret_code:
+            return None
+        tmp_path = '%s.%i.tmp' % (copy_path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(jpg_buffer)
+        os.replace(tmp_path, copy_path)
+        with self.lock:
+            self.total_bytes += len(jpg_buffer) - self.copies.get(name, 0)
+            self.copies[name] = len(jpg_buffer)
+            self.copies.move_to_end(name)
+            self.evict()
+        return copy_path
+
+    def read_reduced(self, image_path, width):
+        ''' Decode image_path at the smallest libjpeg scale still at least width px wide '''
+        read_flag = cv2.IMREAD_COLOR
+        image_width = get_jpeg_width(image_path)
+        if image_width is not None:
+            for scale, reduced_flag in ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                                        (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                        (2, cv2.IMREAD_REDUCED_COLOR_2)):
+                if image_width // scale >= width:
+                    read_flag = reduced_flag
+                    break
+        return cv2.imread(image_path, read_flag)
+
+    def evict(self):
+        ''' Remove least recently used copies until under max_bytes. Call with lock held '''
+        while self.total_bytes > self.max_bytes and len(self.copies) > 1:
+            name, size = self.copies.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+
+#-------------------------------------------------------------------------------
+class ListingCache(object):
+    '''
+    Sorted directory listings built with one os.scandir pass and kept
+    for the most recent max_dirs directories. A listing is rebuilt when
+    the directory mtime changes, eg a file is added, removed or renamed,
+    or when it is older than ttl_sec so in place file updates show up.
+    Each request then only renders html from the cached Listing index.
+    '''
+    def __init__(self, max_dirs=32, ttl_sec=10):
+        self.max_dirs = max(1, max_dirs)
+        self.ttl_sec = ttl_sec
+        self.lock = threading.Lock()
+        self.listings = collections.OrderedDict()  # path: (dir mtime_ns, build time, Listing)
+
+    def get(self, path):
+        '''
+        Return the Listing of directory path.
+        Raises OSError if the directory can not be read.
+        '''
+        dir_mtime = os.stat(path).st_mtime_ns
+        now = time.monotonic()
+        with self.lock:
+            listing = self.listings.get(path)
+            if listing is not None and listing[0] == dir_mtime and now - listing[1] < self.ttl_sec:
+                self.listings.move_to_end(path)
+                return listing[2]
+        listing = Listing(self.scan(path))
+        with self.lock:
+            self.listings[path] = (dir_mtime, now, listing)
+            self.listings.move_to_end(path)
+            while len(self.listings) > self.max_dirs:
+                self.listings.popitem(last=False)
+        return listing
+
+    def scan(self, path):
+        ''' Return ListEntry list from a single os.scandir pass '''
+        entries = []
+        with os.scandir(path) as dir_entries:
+            for dir_entry in dir_entries:
+                if dir_entry.name.startswith('.'):
+                    continue  # hidden eg a video segment still being encoded
+                try:
+                    stat = dir_entry.stat()  # follows links like the old os.stat sort key
+                    is_dir = dir_entry.is_dir()
+                except OSError:
+                    continue  # removed since scandir read it or a broken link
+                seq_num, camera, preview = parse_media_name(dir_entry.name)
+                entries.append(ListEntry(dir_entry.name, is_dir, dir_entry.is_symlink(),
+                                         stat.st_mtime, stat.st_size, seq_num, camera, preview))
+        return entries
 
 #-------------------------------------------------------------------------------
 class DirectoryHandler(SimpleHTTPRequestHandler):
 
+    def do_GET(self):
+        '''
+        Save a panohub full resolution request, serve a reduced size
+        image for ?preview or ?thumb or serve a file
+        '''
+        path, query = (self.path.split('?', 1) + [''])[:2]
+        if path == '/fullres':
+            self.request_fullres(query)
+        elif path == '/api/list':
+            self.send_api_list(query)
+        elif path == '/api/status':
+            self.send_json(STATUS_SAMPLER.get())
+        elif path == '/api/sequences':
+            self.send_api_sequences(query)
+        elif query in ('preview', 'thumb') and THUMB_CACHE is not None:
+            self.send_reduced(path, query)
+        else:
+            self.send_path()
+
+    def do_HEAD(self):
+        ''' Send headers only for a file or folder listing '''
+        self.send_path(head=True)
+
+    def send_path(self, head=False):
+        ''' Send a file per the request path. Folders use the stock listing logic '''
+        file_path = self.translate_path(self.path)
+        if os.path.isdir(file_path):
+            if head:
+                SimpleHTTPRequestHandler.do_HEAD(self)
+            else:
+                SimpleHTTPRequestHandler.do_GET(self)
+        else:
+            self.send_file(file_path, self.guess_type(file_path), head)
+
+    def send_reduced(self, path, query):
+        ''' Send a cached preview or thumbnail. Send the original if one can not be made '''
+        image_path = self.translate_path(path)
+        copy_path = None
+        if os.path.splitext(image_path)[1].lower() in IMAGE_EXTS and os.path.isfile(image_path):
+            width = web_thumb_width if query == 'thumb' else web_preview_width
+            copy_path = THUMB_CACHE.get(image_path, width)
+        if copy_path is None:
+            self.send_path()
+        else:
+            self.send_file(copy_path, 'image/jpeg')
+
+    def send_file(self, file_path, ctype, head=False):
+        '''
+        Send a file with ETag and Last-Modified validators. A matching
+        If-None-Match or If-Modified-Since gets 304 Not Modified and a
+        single byte Range gets 206 Partial Content. The body goes from
+        the file to the socket with sendfile instead of through python.
+        '''
+        try:
+            f = open(file_path, 'rb')
+        except OSError:
+            self.send_error(404, "File not found")
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            etag = '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+            last_modified = self.date_time_string(stat.st_mtime)
+            if self.not_modified(etag, stat.st_mtime):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", last_modified)
+                self.end_headers()
+                return
+            byte_range = self.get_range(stat.st_size, etag, last_modified)
+            if byte_range == 'unsatisfiable':
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%i" % stat.st_size)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if byte_range is None:
+                start, end = 0, stat.st_size - 1
+                self.send_response(200)
+            else:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes %i-%i/%i" % (start, end, stat.st_size))
+            self.send_header("Content-type", ctype)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Last-Modified", last_modified)
+            self.send_header("ETag", etag)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Cache-Control", "no-cache")  # revalidate since seq numbers recycle
+            self.end_headers()
+            if not head and end >= start:
+                self.connection.sendfile(f, start, end - start + 1)
+
+    def not_modified(self, etag, mtime):
+        ''' Return True if the client copy is current per its validators '''
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+            return int(mtime) <= since
+        return False
+
+    def get_range(self, size, etag, last_modified):
+        '''
+        Return start, end byte offsets of a single Range request,
+        'unsatisfiable' if it is outside the file or None to send the
+        whole file eg no Range, multiple ranges or a stale If-Range.
+        '''
+        range_header = self.headers.get('Range')
+        if range_header is None or not range_header.startswith('bytes='):
+            return None
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and if_range.strip() not in (etag, last_modified):
+            return None
+        spec = range_header[len('bytes='):].strip()
+        if ',' in spec or '-' not in spec:
+            return None
+        first, last = [part.strip() for part in spec.split('-', 1)]
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else size - 1
+            else:
+                start = size - int(last)  # suffix range eg last 500 bytes
+                end = size - 1
+        except ValueError:
+            return None
+        if start < 0:
+            start = 0
+        if start >= size:
+            return 'unsatisfiable'
+        if end < start:
+            return None
+        return start, min(end, size - 1)
+
+    def image_link(self, name):
+        '''
+        Return the href of a listed file. Images link to their
+        cached preview when previews are on.
+        '''
+        link = urllib.parse.quote(name)
+        if THUMB_CACHE is not None and os.path.splitext(name)[1].lower() in IMAGE_EXTS:
+            link += '?preview'
+        return link
+
+    def request_fullres(self, query):
+        '''
+        Ask panohub for the full resolution pano of a preview sequence.
+        panohub checks PREVIEW_REQUEST_DIR for files named by seq num
+        and requests the full resolution frames from panosend.
+        '''
+        seq_num = urllib.parse.parse_qs(query).get('seq', [''])[0]
+        if not seq_num.isdigit():
+            self.send_error(400, "Missing seq number")
+            return
+        request_dir = os.path.join(BASE_DIR, PREVIEW_REQUEST_DIR)
+        try:
+            if not os.path.isdir(request_dir):
+                os.makedirs(request_dir)
+            open(os.path.join(request_dir, seq_num), 'w').close()
+        except (IOError, OSError):
+            self.send_error(500, "Could not save full resolution request")
+            return
+        body = ('<html><body>Full Resolution Requested for Seq %s.<br>'
+                'It is stitched after the cameras send their next frames.</body></html>' % seq_num)
+        self.send_response(200)
+        self.send_header("Content-type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def fullres_link(self, entry, names):
+        '''
+        Return the full resolution request link for a preview pano
+        that has no full resolution pano yet, otherwise ''.
+        '''
+        if not entry.preview or entry.seq is None or entry.camera is not None:
+            return ''
+        if IMAGE_PREFIX + str(entry.seq) + os.path.splitext(entry.name)[1] in names:
+            return ''
+        return ' <a href="/fullres?seq=%i" target="imgbox">[full res]</a>' % entry.seq
+
+    def send_json(self, data):
+        ''' Send data as a json response '''
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_api_list(self, query):
+        '''
+        Send one page of a folder listing as json. Query parameters are
+        path= folder url path, cursor= next_cursor from the previous page,
+        limit= entries per page and html=1 to add each rendered list item.
+        '''
+        params = urllib.parse.parse_qs(query)
+        dir_path = params.get('path', ['/'])[0]
+        if not dir_path.endswith('/'):
+            dir_path += '/'
+        try:
+            limit = min(int(params.get('limit', [web_list_page_size])[0]), API_LIST_MAX_LIMIT)
+            sort_key = None
+            if params.get('cursor', [''])[0]:
+                sort_key = decode_cursor(params['cursor'][0])
+        except ValueError:
+            self.send_error(400, "Bad limit or cursor")
+            return
+        try:
+            listing = LISTING_CACHE.get(self.translate_path(dir_path))
+        except OSError:
+            self.send_error(404, "No permission to list directory")
+            return
+        entries, next_key = listing.page(sort_key, limit, web_max_list_entries)
+        with_html = params.get('html', ['0'])[0] == '1'
+        page_entries = []
+        for entry in entries:
+            page_entry = {'name': entry.name,
+                          'size': entry.size,
+                          'mtime': entry.mtime,
+                          'is_dir': entry.is_dir,
+                          'seq': entry.seq,
+                          'camera': entry.camera,
+                          'preview': entry.preview}
+            if with_html:
+                page_entry['html'] = self.render_entry(entry, dir_path, listing.names)
+            page_entries.append(page_entry)
+        self.send_json({'path': dir_path,
+                        'total': len(listing.entries),
+                        'entries': page_entries,
+                        'next_cursor': None if next_key is None else encode_cursor(next_key)})
+
+    def send_api_sequences(self, query):
+        '''
+        Send panohub manifest sequences as json. Query parameters are
+        seq= seq num to look up, before= next_before from the previous
+        page and limit= sequences per page.
+        '''
+        params = urllib.parse.parse_qs(query)
+        try:
+            seq_num = int(params['seq'][0]) if 'seq' in params else None
+            before_id = int(params['before'][0]) if 'before' in params else None
+            limit = max(1, min(int(params.get('limit', [20])[0]), API_SEQ_MAX_LIMIT))
+        except ValueError:
+            self.send_error(400, "Bad seq, before or limit")
+            return
+        try:
+            self.send_json(read_manifest(os.path.join(BASE_DIR, SEQ_MANIFEST_FILEPATH),
+                                         seq_num, before_id, limit))
+        except sqlite3.Error as err_msg:
+            self.send_error(503, "Manifest Not Available %s" % err_msg)
+
+    def render_entry(self, entry, dir_path, names):
+        ''' Return the right panel list item html of a ListEntry '''
+        name = entry.name
+        displayname = linkname = name
+        date_modified = time.strftime('%H:%M:%S %d-%b-%Y', time.localtime(entry.mtime))
+        # Append / for directories or @ for symbolic links
+        if entry.is_link:
+            displayname = name + "@"  # symbolic link found
+        if entry.is_dir:   # check if entry is a directory
+            displayname = name + "/"
+            linkname = os.path.join(dir_path, displayname)
+            return ('<li><a href="%s" >%s</a></li>\n'
+                    % (urllib.parse.quote(linkname), html.escape(displayname, quote=False)))
+        if THUMB_CACHE is not None and os.path.splitext(name)[1].lower() in IMAGE_EXTS:
+            # Link to the preview with the original one click away
+            thumb = ''
+            if web_list_thumbs:
+                thumb = ('<img src="%s?thumb" width="%i" loading="lazy" alt=""> '
+                         % (urllib.parse.quote(name), web_thumb_width // 2))
+            return ('<li>%s<a href="%s" target="imgbox">%s</a> - %s'
+                    ' <a href="%s" target="imgbox">[orig]</a>%s</li>\n'
+                    % (thumb, self.image_link(name), html.escape(displayname, quote=False),
+                       date_modified, urllib.parse.quote(linkname),
+                       self.fullres_link(entry, names)))
+        return ('<li><a href="%s" target="imgbox">%s</a> - %s%s</li>\n'
+                % (urllib.parse.quote(linkname), html.escape(displayname, quote=False),
+                   date_modified, self.fullres_link(entry, names)))
+
     def list_directory(self, path):
         try:
-            list = os.listdir(path)
-            all_entries = len(list)
-        except os.error:
+            listing = LISTING_CACHE.get(path)
+            all_entries = len(listing.entries)
+        except OSError:
             self.send_error(404, "No permission to list directory")
             return None
-
-        if web_list_by_datetime:
-            # Sort by most recent modified date/time first
-            list.sort(key=lambda x: os.stat(os.path.join(path, x)).st_mtime, reverse=web_list_sort_descending)
-        else:
-            # Sort by File Name
-            list.sort(key=lambda a: a.lower(), reverse=web_list_sort_descending)
-        f = StringIO()
-        displaypath = cgi.escape(urllib.unquote(self.path))
-        # find index of first file or hyperlink
-
-        file_found = False
-        cnt = 0
-        for entry in list:  # See if there is a file for initializing iframe
-            fullname = os.path.join(path, entry)
-            if os.path.islink(fullname) or os.path.isfile(fullname):
-                file_found = True
+        f = io.StringIO()
+        dir_path = urllib.parse.unquote(self.path.split('?', 1)[0])
+        displaypath = html.escape(dir_path, quote=False)
+        # find first file or hyperlink for initializing iframe
+        first_file = None
+        for entry in listing.entries:
+            if entry.is_link or not entry.is_dir:
+                first_file = entry.name
                 break
-            cnt += 1
 
         # Start HTML formatting code
         f.write('<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">')
@@ -167,16 +907,17 @@ class DirectoryHandler(SimpleHTTPRequestHandler):
         # Start Left iframe Image Panel
         f.write('<iframe width="%s" height="%s" align="left"'
                 % (web_iframe_width_usage, web_image_height))
-        if file_found:  # file was display it in left pane
+        if first_file is not None:  # file was display it in left pane
             f.write('src="%s" name="imgbox" id="imgbox" alt="%s">'
-                    % (list[cnt], web_page_title))
+                    % (self.image_link(first_file), web_page_title))
         else:  # No files found so blank left pane
             f.write('src="%s" name="imgbox" id="imgbox" alt="%s">'
                     % ("about:blank", web_page_title))
 
         f.write('<p>iframes are not supported by your browser.</p></iframe>')
         # Start Right File selection List Panel
-        list_style = '<div style="height: ' + web_list_height + 'px; overflow: auto; white-space: nowrap;">'
+        list_style = ('<div id="listpane" style="height: ' + web_list_height +
+                      'px; overflow: auto; white-space: nowrap;">')
         f.write(list_style)
         # f.write('<center><b>%s</b></center>' % (self.path))
         # Show a refresh button at top of right pane listing
@@ -185,37 +926,24 @@ VALUE="Refresh">&nbsp;&nbsp;<b>%s</b></FORM>''' % list_title)
         f.write('%s' % refresh_button)
         f.write('<ul name="menu" id="menu" style="list-style-type:none; padding-left: 4px">')
         # Create the formatted list of right panel hyper-links to files in the specified directory
-        if not self.path is "/":   # Display folder Back arrow navigation if not in web root
+        if self.path != "/":   # Display folder Back arrow navigation if not in web root
             f.write('<li><a href="%s" >%s</a></li>\n'
-                    % (urllib.quote(".."), cgi.escape("< BACK")))
-        display_entries = 0
-        file_found = False
-        for name in list:
-            display_entries += 1
-            if web_max_list_entries > 1:
-                if display_entries >= web_max_list_entries:
-                    break
-            fullname = os.path.join(path, name)
-            displayname = linkname = name
-            date_modified = time.strftime('%H:%M:%S %d-%b-%Y', time.localtime(os.path.getmtime(fullname)))
-            # Append / for directories or @ for symbolic links
-            if os.path.islink(fullname):
-                displayname = name + "@"  # symbolic link found
-            if os.path.isdir(fullname):   # check if entry is a directory
-                displayname = name + "/"
-                linkname = os.path.join(displaypath, displayname)
-                f.write('<li><a href="%s" >%s</a></li>\n'
-                        % (urllib.quote(linkname), cgi.escape(displayname)))
-            else:
-                f.write('<li><a href="%s" target="imgbox">%s</a> - %s</li>\n'
-                        % (urllib.quote(linkname), cgi.escape(displayname), date_modified))
-
-        if (not self.path is "/") and display_entries > 35:   # Display folder Back arrow navigation if not in web root
-            f.write('<li><a href="%s" >%s</a></li>\n' % (urllib.quote(".."), cgi.escape("< BACK")))
-        f.write('</ul></div><p><b>')
-        drive_status = df(MNT_POINT)
-        f.write('<div style="float: left; padding-left: 40px;">Web Root is [ %s ]  %s</div>' %
-                (web_server_root, drive_status))
+                    % (urllib.parse.quote(".."), html.escape("< BACK", quote=False)))
+        # Only the first page is rendered here. The rest is loaded from
+        # /api/list as the list is scrolled so large folders stay fast
+        entries, next_key = listing.page(None, web_list_page_size, web_max_list_entries)
+        for entry in entries:
+            f.write(self.render_entry(entry, dir_path, listing.names))
+        f.write('</ul>')
+        if self.path != "/" and all_entries > 35:   # Display folder Back arrow navigation if not in web root
+            f.write('<a href="%s" >%s</a>\n'
+                    % (urllib.parse.quote(".."), html.escape("< BACK", quote=False)))
+        f.write('</div>')
+        if next_key is not None:
+            f.write(LAZY_LIST_SCRIPT % (json.dumps(dir_path), json.dumps(encode_cursor(next_key))))
+        f.write('<p><b>')
+        f.write('<div style="float: left; padding-left: 40px;">Web Root is [ %s ]  %s<br>%s</div>' %
+                (web_server_root, STATUS_SAMPLER.drive_status(), STATUS_SAMPLER.hub_summary()))
         f.write('<div style="text-align: center;">%s</div>' % web_page_title)
 
         if web_page_refresh_on:
@@ -223,20 +951,19 @@ VALUE="Refresh">&nbsp;&nbsp;<b>%s</b></FORM>''' % list_title)
 
         if web_max_list_entries > 1:
             f.write('<div style="text-align: right; padding-right: 40px;">Listing Only %i of %i Files in %s</div>'
-                    % (display_entries, all_entries, self.path))
+                    % (min(web_max_list_entries, all_entries), all_entries, self.path))
         else:
             f.write('<div style="text-align: right; padding-right: 50px;">Listing All %i Files in %s</div>'
                     % (all_entries, self.path))
         # Display web refresh info only if setting is turned on
         f.write('</b></p>')
-        length = f.tell()
-        f.seek(0)
-        self.send_response(200)
         encoding = sys.getfilesystemencoding()
+        page = f.getvalue().encode(encoding, 'surrogateescape')
+        self.send_response(200)
         self.send_header("Content-type", "text/html; charset=%s" % encoding)
-        self.send_header("Content-Length", str(length))
+        self.send_header("Content-Length", str(len(page)))
         self.end_headers()
-        return f
+        return io.BytesIO(page)
 
 # Read variable settings from yaml file.
 print("----------------------------------------------------------------")
@@ -245,12 +972,12 @@ print("----------------------------------------------------------------")
 print('webserver: Import Settings from %s %s' %
       (YAML_FILEPATH, YAML_SECTION_NAME))
 read_yaml_file(YAML_FILEPATH, YAML_SECTION_NAME)
+read_yaml_file(YAML_FILEPATH, YAML_PANOHUB_SECTION_NAME)
 web_list_height = web_image_height
 
 os.chdir(web_server_root)
 web_root = os.getcwd()
 os.chdir(BASE_DIR)
-MNT_POINT = "./"
 
 if web_list_by_datetime:
     dir_sort = 'Sort DateTime'
@@ -264,9 +991,22 @@ else:
 
 list_title = "%s %s" % (dir_sort, dir_order)
 
+LISTING_CACHE = ListingCache(web_list_cache_dirs, web_list_cache_sec)
+STATUS_SAMPLER = StatusSampler(web_root, os.path.join(BASE_DIR, HUB_STATUS_FILEPATH),
+                               web_status_sec)
+THUMB_CACHE = None
+if web_preview_on and cv2 is None:
+    print('webserver: WARN opencv Not Installed. Image Previews Off. To install')
+    print('           sudo apt-get install python3-opencv')
+elif web_preview_on:
+    THUMB_CACHE = ThumbCache(os.path.join(BASE_DIR, web_thumb_cache_dir),
+                             web_thumb_cache_mb * 1024 * 1024, web_thumb_quality)
+    print('webserver: Image Previews %i px Cached in %s  Max %i MB' %
+          (web_preview_width, web_thumb_cache_dir, web_thumb_cache_mb))
 os.chdir(web_server_root)
-SocketServer.TCPServer.allow_reuse_address = True
-httpd = SocketServer.TCPServer(("", web_server_port), DirectoryHandler)
+ThreadingHTTPServer.allow_reuse_address = True
+ThreadingHTTPServer.daemon_threads = True
+httpd = ThreadingHTTPServer(("", web_server_port), DirectoryHandler)
 
 net_interface_names = [ b'eth0', b'wlan0' ]   # byte string list of interface names to check
 ip_list = []
@@ -297,7 +1037,3 @@ except KeyboardInterrupt:
     httpd.socket.close()
 except IOError as e:
     print("I/O error({0}): {1}".format(e.errno, e.strerror))
-
-
-
-
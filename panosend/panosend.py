@@ -25,6 +25,8 @@ import sys
 import time
 import datetime
 import socket
+import json
+import collections
 import numpy as np
 
 try:
@@ -42,23 +44,20 @@ except ImportError:
 try:
     import picamera
 except ImportError:
-    print('''panosend.py: You need to install picamera library per
-
-    sudo apt install -y python-picamera
-    sudo apt install -y python3-picamera
-
-    ''')
-    sys.exit(1)
+    picamera = None  # checked in take_stitch_image so the spool can be tested off a RPI
 
 try:
     import cv2
 except ImportError:
-    print('''panosend.py: You need to install opencv library per
+    cv2 = None  # only needed for CAM_CAPTURE_MODE bgr and PREVIEW_ON
 
-    sudo apt install -y python-opencv
-    sudo apt install -y python3-opencv
+try:
+    import zmq
+except ImportError:
+    print('''panosend.py: You need to install zmq library per
+
+    sudo pip3 install pyzmq
 
-    Note you may need stretch or buster for python3-opencv install
     ''')
     sys.exit(1)
 
@@ -72,6 +71,300 @@ except ImportError:
     ''')
     sys.exit(1)
 
+# Default Settings. These are overridden by panosend.yaml sent from
+# panohub.py so an older panohub.yaml without newer variables will still work.
+CAM_CAPTURE_MODE = 'jpeg'
+CLOCK_SYNC_PINGS = 3
+HUB_REPLY_TIMEOUT_SEC = 10
+SPOOL_MAX_FRAMES = 100
+SPOOL_MAX_MB = 50
+SPOOL_MAX_AGE_SEC = 86400
+SPOOL_DIR = ''
+SPOOL_BATCH_SIZE = 5
+SPOOL_UPLOAD_MARGIN_SEC = 2  # stop spool upload this many seconds before a trigger
+PREVIEW_ON = False
+PREVIEW_WIDTH = 640
+PREVIEW_JPEG_QUALITY = 80
+PREVIEW_FULLRES_KEEP = 20
+PREVIEW_MATCH_SEC = 1.0  # hub and sender copies of a trigger time differ slightly
+
+PANOHUB_PROTOCOL = 2  # panohub replies with json sub-second trigger times
+
+#---------------------------------------------------------------
+class JpegBuffer(object):
+    ''' Reusable in-memory output for picamera jpeg captures.
+    picamera writes the GPU encoded jpeg using write() calls.
+    A new larger buffer is only allocated when a capture does not fit.
+    '''
+    def __init__(self, size):
+        self.buffer = bytearray(size)
+        self.length = 0
+
+    def reset(self):
+        ''' Start a new capture at the beginning of the buffer '''
+        self.length = 0
+
+    def write(self, data):
+        end = self.length + len(data)
+        if end > len(self.buffer):
+            # Replace rather than resize since a previous view may still be exported
+            new_buffer = bytearray(max(end, len(self.buffer) * 3 // 2))
+            new_buffer[:self.length] = self.buffer[:self.length]
+            self.buffer = new_buffer
+        self.buffer[self.length:end] = data
+        self.length = end
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def view(self):
+        ''' Return a memoryview of the captured jpeg bytes without copying '''
+        return memoryview(self.buffer)[:self.length]
+
+#---------------------------------------------------------------
+class ClockSync(object):
+    ''' Estimate the offset between the panohub clock and this sender
+    clock from request/reply round trips. offset is added to local time
+    to get hub time. The sample with the shortest round trip of the last
+    max_samples is used since it has the least network delay error.
+    '''
+    def __init__(self, max_samples=8):
+        self.samples = collections.deque(maxlen=max_samples)
+        self.offset = 0.0
+        self.rtt = None
+
+    def add_sample(self, send_time, hub_time, recv_time):
+        rtt = recv_time - send_time
+        self.samples.append((rtt, hub_time - (send_time + recv_time) / 2.0))
+        self.rtt, self.offset = min(self.samples)
+
+#---------------------------------------------------------------
+class FrameSpool(object):
+    ''' Bounded spool of frames captured while panohub is unreachable.
+    Frames are kept oldest first with the message sent to the hub, which
+    holds their trigger and capture time. The oldest frames are dropped
+    when max_frames, max_bytes or max_age_sec is exceeded. If spool_dir
+    is set frames are also saved there and reloaded after a restart.
+    '''
+    def __init__(self, max_frames, max_bytes, max_age_sec, spool_dir=''):
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.max_age_sec = max_age_sec
+        self.spool_dir = spool_dir
+        self.frames = collections.deque()  # (msg, jpg bytes or file path)
+        self.total_bytes = 0
+        if self.spool_dir:
+            if not os.path.isdir(self.spool_dir):
+                os.makedirs(self.spool_dir)
+            self.load()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def load(self):
+        ''' Reload frames left in spool_dir by a previous run '''
+        for filename in sorted(os.listdir(self.spool_dir)):
+            if not filename.endswith('.json'):
+                continue
+            msg_path = os.path.join(self.spool_dir, filename)
+            jpg_path = msg_path[:-len('.json')] + '.jpg'
+            try:
+                with open(msg_path) as msg_file:
+                    msg = json.load(msg_file)
+                self.frames.append((msg, jpg_path))
+                self.total_bytes += os.path.getsize(jpg_path)
+            except (IOError, OSError, ValueError):
+                self.delete_files(jpg_path)
+        if self.frames:
+            print('panosend.py: Reloaded %i Spooled Frames from %s' %
+                  (len(self.frames), self.spool_dir))
+        self.evict()
+
+    def add(self, msg, jpg_buffer):
+        ''' Add a copy of a captured frame to the spool '''
+        msg = dict(msg, spooled=True, spool_time=time.time())
+        data = bytes(jpg_buffer)
+        if self.spool_dir:
+            jpg_path = os.path.join(self.spool_dir, '%.3f.jpg' % msg['capture_time'])
+            with open(jpg_path, 'wb') as jpg_file:
+                jpg_file.write(data)
+            with open(jpg_path[:-len('.jpg')] + '.json', 'w') as msg_file:
+                json.dump(msg, msg_file)
+            self.frames.append((msg, jpg_path))
+        else:
+            self.frames.append((msg, data))
+        self.total_bytes += len(data)
+        self.evict()
+
+    def oldest(self):
+        ''' Return the oldest msg and jpeg bytes without removing them '''
+        self.evict()
+        if not self.frames:
+            return None, None
+        msg, data = self.frames[0]
+        if self.spool_dir:
+            with open(data, 'rb') as jpg_file:
+                data = jpg_file.read()
+        return msg, data
+
+    def remove_oldest(self):
+        ''' Remove the oldest frame eg after it was uploaded '''
+        msg, data = self.frames.popleft()
+        if self.spool_dir:
+            if os.path.isfile(data):
+                self.total_bytes -= os.path.getsize(data)
+            self.delete_files(data)
+        else:
+            self.total_bytes -= len(data)
+
+    def evict(self):
+        ''' Drop oldest frames that are past the size, count or age limits '''
+        too_old = time.time() - self.max_age_sec
+        dropped = 0
+        while self.frames and (len(self.frames) > self.max_frames or
+                               self.total_bytes > self.max_bytes or
+                               self.frames[0][0]['spool_time'] < too_old):
+            self.remove_oldest()
+            dropped += 1
+        if dropped:
+            print('panosend.py: WARN Spool Limit Reached. Dropped %i Oldest Frames' % dropped)
+
+    def delete_files(self, jpg_path):
+        for path in (jpg_path, jpg_path[:-len('.jpg')] + '.json'):
+            if os.path.isfile(path):
+                os.remove(path)
+
+#---------------------------------------------------------------
+def read_hub_reply(hub_reply, clock_sync=None, send_time=None, recv_time=None):
+    ''' Return the next trigger time in hub clock seconds, the timelapse
+    interval and the triggers of preview frames panohub wants at full
+    resolution from a panohub reply. A json reply also updates clock_sync.
+    An older panohub replies with a '%Y/%m/%d %H:%M:%S' string with one
+    second resolution and no interval.
+    '''
+    if hub_reply[:1] == b'{':
+        reply = json.loads(hub_reply.decode('utf-8'))
+        if clock_sync is not None:
+            clock_sync.add_sample(send_time, reply['hub_time'], recv_time)
+        return reply['trigger'], reply.get('interval'), reply.get('full', [])
+    return time.mktime(datetime.datetime.strptime(hub_reply.decode('utf-8'),
+                                                  '%Y/%m/%d %H:%M:%S').timetuple()), None, []
+
+#---------------------------------------------------------------
+class HubLink(object):
+    ''' imagezmq connection to panohub that gives up waiting for a reply
+    after timeout_sec. A zmq REQ socket can not be used again after a
+    missed reply so the connection is closed and opened again.
+    '''
+    def __init__(self, connect_to, timeout_sec):
+        self.connect_to = connect_to
+        self.timeout_ms = int(timeout_sec * 1000)
+        self.frames_sent = 0
+        self.timeouts = 0
+        self.last_rtt = None  # seconds for the last frame send and reply
+        self.connect()
+
+    def connect(self):
+        self.sender = imagezmq.ImageSender(connect_to=self.connect_to)
+        self.sender.zmq_socket.setsockopt(zmq.LINGER, 0)
+        self.sender.zmq_socket.setsockopt(zmq.SNDTIMEO, self.timeout_ms)
+        self.sender.zmq_socket.setsockopt(zmq.RCVTIMEO, self.timeout_ms)
+
+    def send(self, msg, jpg_buffer, clock_sync):
+        ''' Send msg and jpg_buffer to panohub and time the round trip.
+        Return the next trigger time, interval and wanted full resolution
+        triggers from the hub reply or None, None, [] if the hub did not
+        reply in time. send_time in hub clock seconds is added to frames
+        so panohub can time the transmit.
+        '''
+        send_time = time.time()
+        if len(jpg_buffer):
+            msg = dict(msg, send_time=send_time + clock_sync.offset)
+        try:
+            hub_reply = self.sender.send_jpg(msg, jpg_buffer)
+        except zmq.Again:
+            print('panosend.py: WARN No Reply from %s after %i ms' %
+                  (self.connect_to, self.timeout_ms))
+            self.timeouts += 1
+            self.sender.zmq_socket.close()
+            self.connect()
+            return None, None, []
+        recv_time = time.time()
+        if len(jpg_buffer):
+            self.frames_sent += 1
+            self.last_rtt = recv_time - send_time
+        return read_hub_reply(hub_reply, clock_sync, send_time, recv_time)
+
+#---------------------------------------------------------------
+def upload_spool(hub_link, spool, clock_sync, next_trigger):
+    ''' Upload up to SPOOL_BATCH_SIZE spooled frames oldest first while
+    there is at least SPOOL_UPLOAD_MARGIN_SEC before the next trigger.
+    '''
+    uploaded = 0
+    while len(spool) and uploaded < SPOOL_BATCH_SIZE:
+        if next_trigger - clock_sync.offset - time.time() < SPOOL_UPLOAD_MARGIN_SEC:
+            break
+        msg, jpg_buffer = spool.oldest()
+        if msg is None:
+            break
+        if hub_link.send(msg, jpg_buffer, clock_sync)[0] is None:
+            break
+        spool.remove_oldest()
+        uploaded += 1
+    if uploaded:
+        print('panosend.py: Uploaded %i Spooled Frames. %i Remaining' % (uploaded, len(spool)))
+
+#---------------------------------------------------------------
+def encode_preview(image):
+    ''' Return image resized to PREVIEW_WIDTH and jpeg encoded '''
+    height, width = image.shape[:2]
+    if width > PREVIEW_WIDTH:
+        image = cv2.resize(image, (PREVIEW_WIDTH, height * PREVIEW_WIDTH // width),
+                           interpolation=cv2.INTER_AREA)
+    ret_code, preview_buffer = cv2.imencode('.jpg', image,
+                                            [int(cv2.IMWRITE_JPEG_QUALITY),
+                                             PREVIEW_JPEG_QUALITY])
+    return preview_buffer
+
+#---------------------------------------------------------------
+def make_preview(jpg_buffer, frame_width):
+    ''' Return a PREVIEW_WIDTH jpeg made from a full resolution jpeg.
+    libjpeg can decode at 1/2, 1/4 or 1/8 scale so only the largest
+    reduction still wider than PREVIEW_WIDTH is decoded.
+    '''
+    read_flag = cv2.IMREAD_COLOR
+    for scale, reduced_flag in ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                                (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if frame_width // scale >= PREVIEW_WIDTH:
+            read_flag = reduced_flag
+            break
+    return encode_preview(cv2.imdecode(np.frombuffer(jpg_buffer, dtype=np.uint8), read_flag))
+
+#---------------------------------------------------------------
+def send_full_frames(hub_link, full_frames, want_full, clock_sync, next_trigger):
+    ''' Send kept full resolution frames whose preview triggers panohub
+    listed in want_full while there is at least SPOOL_UPLOAD_MARGIN_SEC
+    before the next trigger. full_frames is keyed by trigger time.
+    '''
+    sent = 0
+    while want_full:
+        if next_trigger - clock_sync.offset - time.time() < SPOOL_UPLOAD_MARGIN_SEC:
+            break
+        keys = [key for key in full_frames
+                if any(abs(key - trigger) < PREVIEW_MATCH_SEC for trigger in want_full)]
+        if not keys:
+            break
+        msg, jpg_buffer = full_frames.pop(keys[0])
+        hub_trigger, hub_interval, want_full = hub_link.send(msg, jpg_buffer, clock_sync)
+        if hub_trigger is None:
+            full_frames[keys[0]] = (msg, jpg_buffer)  # try again after next trigger
+            break
+        sent += 1
+    if sent:
+        print('panosend.py: Sent %i Full Resolution Frames. %i Kept' % (sent, len(full_frames)))
+
 #---------------------------------------------------------------
 def read_yaml_file(yaml_file_path, yaml_section_name):
     ''' Read configuration variables from a yaml file
@@ -110,43 +403,147 @@ def take_stitch_image():
     This will ensure all panosend.py cameras take images at the same time.
     '''
     RPI_NAME = socket.gethostname()
+    if picamera is None:
+        print('''panosend.py: You need to install picamera library per
+
+    sudo apt install -y python-picamera
+    sudo apt install -y python3-picamera
+
+    ''')
+        sys.exit(1)
+    if cv2 is None and (CAM_CAPTURE_MODE != 'jpeg' or PREVIEW_ON):
+        print('''panosend.py: CAM_CAPTURE_MODE=%s PREVIEW_ON=%s Need the opencv library per
+
+    sudo apt install -y python-opencv
+    sudo apt install -y python3-opencv
+
+    Note you may need stretch or buster for python3-opencv install
+    ''' % (CAM_CAPTURE_MODE, PREVIEW_ON))
+        sys.exit(1)
     print('panosend.py: %s Initializing PiCamera' % RPI_NAME)
     ZMQ_PROTOCOL = 'tcp://'
     ZMQ_HUB = ZMQ_PROTOCOL + ZMQ_PANOHUB_IP + ":" + str(ZMQ_PANOHUB_PORT)
     print('panosend.py: Connect %s to %s' % (RPI_NAME, ZMQ_HUB))
-    sender = imagezmq.ImageSender(connect_to=ZMQ_HUB)
+    hub_link = HubLink(ZMQ_HUB, HUB_REPLY_TIMEOUT_SEC)
+    spool = FrameSpool(SPOOL_MAX_FRAMES, SPOOL_MAX_MB * 1024 * 1024,
+                       SPOOL_MAX_AGE_SEC, SPOOL_DIR)
+    full_frames = collections.OrderedDict()  # trigger: full resolution msg, jpeg kept for panohub
+    if PREVIEW_ON:
+        print('panosend.py: Send %i px wide previews first. Keep %i full resolution frames' %
+              (PREVIEW_WIDTH, PREVIEW_FULLRES_KEEP))
 
-    # fix rounding problems with picamera resolution
-    fwidth = (CAM_WIDTH + 31) // 32 * 32
-    fheight = (CAM_HEIGHT + 15) // 16 * 16
-    print('panosend.py: Adjusted camera resolution roundup from %ix%i to %ix%i' %
-          (CAM_WIDTH, CAM_HEIGHT, fwidth, fheight))
+    if CAM_CAPTURE_MODE == 'jpeg':
+        # GPU encodes the jpeg so no resolution roundup is needed
+        fwidth, fheight = CAM_WIDTH, CAM_HEIGHT
+        print('panosend.py: Capture GPU encoded jpeg images %ix%i' % (fwidth, fheight))
+    else:
+        # fix rounding problems with picamera resolution
+        fwidth = (CAM_WIDTH + 31) // 32 * 32
+        fheight = (CAM_HEIGHT + 15) // 16 * 16
+        print('panosend.py: Adjusted camera resolution roundup from %ix%i to %ix%i' %
+              (CAM_WIDTH, CAM_HEIGHT, fwidth, fheight))
 
     with picamera.PiCamera() as camera:
         camera.resolution = (fwidth, fheight)
         camera.hflip = CAM_HFLIP
         camera.vflip = CAM_VFLIP
-        image_buf = np.empty((fheight, fwidth, 3), dtype=np.uint8)
+        if CAM_CAPTURE_MODE == 'jpeg':
+            jpg_output = JpegBuffer(fwidth * fheight // 2)
+        else:
+            image_buf = np.empty((fheight, fwidth, 3), dtype=np.uint8)
         time.sleep(2)  # Allow Camera to Warm Up
-        next_timelapse = datetime.datetime.now()
+        clock_sync = ClockSync()
+        next_trigger = None  # hub clock. None sends first image right away
+        interval = None
         while True:
-            if datetime.datetime.now() > next_timelapse:
+            if next_trigger is not None:
+                # Sleep until the trigger converted to this sender clock
+                sleep_sec = next_trigger - clock_sync.offset - time.time()
+                if sleep_sec > 0:
+                    time.sleep(sleep_sec)
+            capture_time = time.time() + clock_sync.offset
+            start_time = time.monotonic()
+            if CAM_CAPTURE_MODE == 'jpeg':
+                jpg_output.reset()
+                camera.capture(jpg_output, 'jpeg', quality=CAM_JPEG_QUALITY)
+                jpg_buffer = jpg_output.view()
+                capture_sec = time.monotonic() - start_time
+            else:
+                # BGR capture for when opencv processing is needed
                 camera.capture(image_buf, 'bgr')
+                capture_sec = time.monotonic() - start_time
                 ret_code, jpg_buffer = cv2.imencode(".jpg",
                                                     image_buf,
                                                     [int(cv2.IMWRITE_JPEG_QUALITY),
                                                      CAM_JPEG_QUALITY])
-                print('panosend.py: %s ZMQ Transmit Image to Hub at %s' %
-                      (ZMQ_HUB, datetime.datetime.now()))
-
-                hub_reply = sender.send_jpg(RPI_NAME, jpg_buffer)
+            skew = None
+            if next_trigger is not None:
+                skew = capture_time - next_trigger
+            print('panosend.py: %s ZMQ Transmit Image to Hub at %s Trigger Skew %s ms' %
+                  (ZMQ_HUB, datetime.datetime.now(),
+                   'n/a' if skew is None else '%+.1f' % (skew * 1000)))
 
-                # Convert reply_from zmq hub reply message to time format
-                next_timelapse = datetime.datetime.strptime(hub_reply.decode('utf-8'),
-                                                            '%Y/%m/%d %H:%M:%S')
-                print('panosend.py: Waiting for next_timelapse at %s' %
-                       hub_reply.decode('utf-8'))
-            time.sleep(0.01)  # slow looping a bit to reduce cpu usage
+            # panohub groups frames into sequences by trigger and capture_time
+            # Times are hub clock seconds
+            msg = {'name': RPI_NAME,
+                   'proto': PANOHUB_PROTOCOL,
+                   'capture_time': capture_time,
+                   'trigger': next_trigger,
+                   'skew': skew,
+                   'clock_offset': clock_sync.offset,
+                   'rtt': clock_sync.rtt}
+            send_msg, send_buffer = msg, jpg_buffer
+            if PREVIEW_ON and next_trigger is not None:
+                # Send a small preview now. panohub asks for the full frame when wanted
+                if CAM_CAPTURE_MODE == 'jpeg':
+                    send_buffer = make_preview(jpg_buffer, fwidth)
+                else:
+                    send_buffer = encode_preview(image_buf)
+                send_msg = dict(msg, rendition='preview')
+            # Stage timings for panohub metrics. send_sec is the previous frame round trip
+            send_msg['stats'] = {'capture_sec': capture_sec,
+                                 'encode_sec': time.monotonic() - start_time - capture_sec,
+                                 'send_sec': hub_link.last_rtt,
+                                 'frames_sent': hub_link.frames_sent,
+                                 'timeouts': hub_link.timeouts,
+                                 'spooled': len(spool),
+                                 'full_kept': len(full_frames)}
+            hub_trigger, hub_interval, want_full = hub_link.send(send_msg, send_buffer, clock_sync)
+            if hub_trigger is None:
+                # Hub unreachable. Keep capturing on schedule and spool frames
+                if next_trigger is None or not interval:
+                    continue  # no schedule from hub yet so just retry
+                spool.add(msg, jpg_buffer)
+                now = time.time() + clock_sync.offset
+                while next_trigger <= now:
+                    next_trigger += interval
+                print('panosend.py: Spooled Frame %i. Next timelapse at %s' %
+                      (len(spool), timestamp_to_string(next_trigger)))
+                continue
+            if send_msg is not msg:
+                full_frames[next_trigger] = (dict(msg, rendition='full', deferred=True),
+                                             bytes(jpg_buffer))
+                while len(full_frames) > PREVIEW_FULLRES_KEEP:
+                    full_frames.popitem(last=False)
+            next_trigger, interval = hub_trigger, hub_interval
+            # Small round trips give better clock offset estimates than the image send
+            for ping_num in range(CLOCK_SYNC_PINGS):
+                ping_reply = hub_link.send({'name': RPI_NAME,
+                                            'proto': PANOHUB_PROTOCOL,
+                                            'type': 'ping'},
+                                           b'', clock_sync)
+                if ping_reply[0] is not None:
+                    next_trigger, hub_interval, want_full = ping_reply
+            if full_frames and want_full:
+                send_full_frames(hub_link, full_frames, want_full, clock_sync, next_trigger)
+            if len(spool):
+                upload_spool(hub_link, spool, clock_sync, next_trigger)
+            print('panosend.py: Waiting for next_timelapse at %s  Clock Offset %+.1f ms  RTT %s ms' %
+                  (timestamp_to_string(next_trigger), clock_sync.offset * 1000,
+                   'n/a' if clock_sync.rtt is None else '%.1f' % (clock_sync.rtt * 1000)))
+            print('panosend.py: Capture %.1f ms  Encode %.1f ms  Send %.1f ms' %
+                  (send_msg['stats']['capture_sec'] * 1000,
+                   send_msg['stats']['encode_sec'] * 1000, hub_link.last_rtt * 1000))
 
 #---------------------------------------------------------------
 if __name__ == '__main__':
@@ -0,0 +1,95 @@
+'''
+panosend.py FrameSpool tests for the memory spool and the spool_dir
+copy that is reloaded after a restart.
+'''
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+PANOSEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PANOSEND_DIR)
+
+import panosend
+
+def make_msg(capture_time):
+    return {'cam': 'cam1', 'trigger': capture_time, 'capture_time': capture_time}
+
+class FrameSpoolTest(unittest.TestCase):
+
+    def test_max_frames_drops_oldest(self):
+        spool = panosend.FrameSpool(3, 1000, 3600)
+        for frame_num in range(5):
+            spool.add(make_msg(1000.0 + frame_num), b'jpg%i' % frame_num)
+        self.assertEqual(len(spool), 3)
+        msg, data = spool.oldest()
+        self.assertEqual(msg['capture_time'], 1002.0)
+        self.assertEqual(data, b'jpg2')
+        self.assertTrue(msg['spooled'])
+
+    def test_max_bytes_drops_oldest(self):
+        spool = panosend.FrameSpool(100, 25, 3600)
+        for frame_num in range(4):
+            spool.add(make_msg(1000.0 + frame_num), b'x' * 10)
+        self.assertEqual(len(spool), 2)
+        self.assertEqual(spool.total_bytes, 20)
+        self.assertEqual(spool.oldest()[0]['capture_time'], 1002.0)
+
+    def test_max_age_drops_old_frames(self):
+        spool = panosend.FrameSpool(100, 1000, 60)
+        spool.add(make_msg(1000.0), b'old')
+        spool.add(make_msg(1001.0), b'new')
+        spool.frames[0][0]['spool_time'] = time.time() - 120
+        msg, data = spool.oldest()
+        self.assertEqual(data, b'new')
+        self.assertEqual(len(spool), 1)
+        self.assertEqual(spool.total_bytes, 3)
+
+    def test_remove_oldest_in_order(self):
+        spool = panosend.FrameSpool(100, 1000, 3600)
+        spool.add(make_msg(1000.0), b'first')
+        spool.add(make_msg(1001.0), b'second')
+        spool.remove_oldest()
+        self.assertEqual(spool.oldest()[1], b'second')
+        spool.remove_oldest()
+        self.assertEqual(spool.oldest(), (None, None))
+        self.assertEqual(spool.total_bytes, 0)
+
+class FrameSpoolDirTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spool_dir = os.path.join(tempfile.mkdtemp(prefix='spool-test-'), 'spool')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.spool_dir), ignore_errors=True)
+
+    def test_frames_reloaded_after_restart(self):
+        spool = panosend.FrameSpool(100, 1000, 3600, self.spool_dir)
+        spool.add(make_msg(1000.0), b'first')
+        spool.add(make_msg(1001.0), b'second')
+        self.assertEqual(len(os.listdir(self.spool_dir)), 4)
+        spool = panosend.FrameSpool(100, 1000, 3600, self.spool_dir)
+        self.assertEqual(len(spool), 2)
+        self.assertEqual(spool.total_bytes, 11)
+        msg, data = spool.oldest()
+        self.assertEqual(msg['capture_time'], 1000.0)
+        self.assertEqual(data, b'first')
+        spool.remove_oldest()
+        self.assertEqual(sorted(os.listdir(self.spool_dir)), ['1001.000.jpg', '1001.000.json'])
+
+    def test_reload_applies_limits_and_skips_broken_frames(self):
+        spool = panosend.FrameSpool(100, 1000, 3600, self.spool_dir)
+        for frame_num in range(3):
+            spool.add(make_msg(1000.0 + frame_num), b'jpg')
+        with open(os.path.join(self.spool_dir, '999.000.json'), 'w') as msg_file:
+            msg_file.write('{not json')
+        spool = panosend.FrameSpool(2, 1000, 3600, self.spool_dir)
+        self.assertEqual(len(spool), 2)
+        self.assertEqual(spool.oldest()[0]['capture_time'], 1001.0)
+        self.assertEqual(sorted(os.listdir(self.spool_dir)),
+                         ['1001.000.jpg', '1001.000.json', '1002.000.jpg', '1002.000.json'])
+
+if __name__ == '__main__':
+    unittest.main()